@@ -0,0 +1,126 @@
+"""
+Benchmark the memory held by the embedded chunks of one document between chunking and the vector database.
+
+Compares the previous representation, a list of pydantic DocumentChunk models with List[float] embeddings plus the
+(id, embedding, metadata) tuples that PineconeDataStore._upsert built from them, against the DocumentChunks record
+with one float32 embeddings matrix.
+
+The record path includes what the current code does around the matrix: every embeddings response passes through the
+in-process embedding cache, which keeps the float32 rows of each response and hands the batch back as a float32
+matrix, and PineconeDataStore._upsert converts the rows of its concurrent batches back to lists for the client. The cache is
+reported separately because it outlives the document: it holds up to EMBEDDING_CACHE_SIZE embeddings, about 25 MB
+at the default of 4096, across warm invocations.
+
+Usage:
+    python benchmarks/bench_chunk_memory.py [--chunks 500]
+"""
+import argparse
+import os
+import sys
+import tracemalloc
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-func"))
+
+from models.models import DocumentChunk, DocumentChunkMetadata  # noqa: E402
+from models.records import DocumentChunks  # noqa: E402
+from services.embedding_cache import EmbeddingCache  # noqa: E402
+
+EMBEDDING_DIMENSION = 1536
+BATCH_SIZE = 40  # The number of 200 token chunks in one embeddings request of EMBEDDINGS_BATCH_TOKENS
+UPSERT_BATCH_SIZE = 100  # PineconeDataStore.UPSERT_BATCH_SIZE
+PINECONE_CONCURRENCY = 8  # PineconeDataStore.PINECONE_CONCURRENCY, the upsert batches converted at a time
+EMBEDDING_MODEL = "text-embedding-ada-002"
+CHUNK_TEXT = "So the gradient of the loss with respect to the weights tells us which direction to move. " * 10
+
+
+def random_embedding_lists(num_chunks):
+    # Embeddings as the OpenAI client returns them: lists of Python floats
+    rng = np.random.default_rng(0)
+    return rng.standard_normal((num_chunks, EMBEDDING_DIMENSION)).tolist()
+
+
+def build_legacy(num_chunks):
+    metadata = DocumentChunkMetadata(document_id="doc")
+    chunks = [
+        DocumentChunk(id=f"doc_{i}", text=CHUNK_TEXT, metadata=metadata, embedding=embedding)
+        for i, embedding in enumerate(random_embedding_lists(num_chunks))
+    ]
+    vectors = [
+        (chunk.id, chunk.embedding, {"text": chunk.text, "document_id": "doc"})
+        for chunk in chunks
+    ]
+    return chunks, vectors
+
+
+def build_records(num_chunks):
+    # Distinct texts, so that every chunk gets its own embedding cache entry
+    texts = [f"{CHUNK_TEXT}{i}" for i in range(num_chunks)]
+    chunks = DocumentChunks(
+        "doc",
+        [f"doc_{i}" for i in range(num_chunks)],
+        texts,
+        ["hash"] * num_chunks,
+        DocumentChunkMetadata(document_id="doc"),
+    )
+    cache = EmbeddingCache(path=None, bucket_name=None)
+    batches = []
+    for start in range(0, num_chunks, BATCH_SIZE):
+        batch_texts = texts[start : start + BATCH_SIZE]
+        # aget_embeddings looks the texts up, converts the lists of the response to float32 right away, caches the
+        # rows and returns the float32 matrix
+        cache.get_many(EMBEDDING_MODEL, batch_texts)
+        response = random_embedding_lists(len(batch_texts))
+        batch = np.asarray(response, dtype=np.float32)
+        del response
+        cache.put_many(EMBEDDING_MODEL, batch_texts, batch)
+        batches.append(batch)
+    chunks.embeddings = np.concatenate(batches)
+    del batches
+
+    # PineconeDataStore._upsert converts the rows of the batches in flight back to lists for the client
+    rows_in_flight = UPSERT_BATCH_SIZE * PINECONE_CONCURRENCY
+    for start in range(0, num_chunks, rows_in_flight):
+        vectors = [row.tolist() for row in chunks.embeddings[start : start + rows_in_flight]]
+        del vectors
+    return chunks, cache
+
+
+def cache_mb(result):
+    if not isinstance(result, tuple) or not isinstance(result[-1], EmbeddingCache):
+        return 0.0
+    return sum(embedding.nbytes for embedding in result[-1].memory.values()) / 2**20
+
+
+def measure(build, num_chunks):
+    """
+    Returns the MB still allocated by the built representation, the part of it held by the embedding cache, and the
+    peak MB while building it.
+    """
+    tracemalloc.start()
+    result = build(num_chunks)
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    cached = cache_mb(result)
+    del result
+    return current / 2**20, cached, peak / 2**20
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--chunks", type=int, default=500)
+    args = parser.parse_args()
+
+    print(f"{args.chunks} chunks of {EMBEDDING_DIMENSION} dimensions")
+    print(f"{'representation':<32} {'held MB':>8} {'of which cache':>14} {'peak MB':>8}")
+    for name, build in [
+        ("pydantic chunks + upsert tuples", build_legacy),
+        ("DocumentChunks + embedding cache", build_records),
+    ]:
+        held, cached, peak = measure(build, args.chunks)
+        print(f"{name:<32} {held:>8.1f} {cached:>14.1f} {peak:>8.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,145 @@
+"""
+Benchmark services.chunks.get_text_chunks on long lecture transcripts.
+
+Compares the single-tokenization chunker against the previous implementation, which re-encoded every chunk and
+re-sliced the remaining tokens, and checks that both produce the same chunks, including on texts whose chunks start
+in the middle of a word, where re-encoding a chunk can give other tokens than those of the whole text.
+
+Usage:
+    python benchmarks/bench_chunks.py [--hours 3] [--repeat 3]
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-func"))
+
+from services.chunks import (  # noqa: E402
+    CHUNK_SIZE,
+    MAX_NUM_CHUNKS,
+    MIN_CHUNK_LENGTH_TO_EMBED,
+    MIN_CHUNK_SIZE_CHARS,
+    get_text_chunks,
+    tokenizer,
+)
+
+WORDS_PER_HOUR = 9000  # A lecturer speaks roughly 150 words per minute
+VOCABULARY = (
+    "the a of to and in is that for it as with was on be by this are we gradient function model "
+    "network layer matrix vector probability distribution theorem proof lemma example lecture "
+    "today so basically um okay right let's consider equation derivative integral über naïve"
+).split()
+# Long words that are split into several tokens, so chunks of a fixed number of tokens end inside them
+LONG_WORDS = (
+    "antidisestablishmentarianism internationalization electroencephalography backpropagation "
+    "hyperparameterization Donaudampfschifffahrtsgesellschaft counterrevolutionaries https://example.com/lectures"
+).split()
+
+
+def legacy_get_text_chunks(text, chunk_token_size):
+    """The chunker as it was before tokenizing once: quadratic re-slicing and a re-encode per chunk."""
+    if not text or text.isspace():
+        return []
+    tokens = tokenizer.encode(text, disallowed_special=())
+    chunks = []
+    chunk_size = chunk_token_size or CHUNK_SIZE
+    num_chunks = 0
+    while tokens and num_chunks < MAX_NUM_CHUNKS:
+        chunk = tokens[:chunk_size]
+        chunk_text = tokenizer.decode(chunk)
+        if not chunk_text or chunk_text.isspace():
+            tokens = tokens[len(chunk) :]
+            continue
+        last_punctuation = max(
+            chunk_text.rfind("."),
+            chunk_text.rfind("?"),
+            chunk_text.rfind("!"),
+            chunk_text.rfind("\n"),
+        )
+        if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
+            chunk_text = chunk_text[: last_punctuation + 1]
+        chunk_text_to_append = chunk_text.replace("\n", " ").strip()
+        if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
+            chunks.append(chunk_text_to_append)
+        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        num_chunks += 1
+    if tokens:
+        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+        if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
+            chunks.append(remaining_text)
+    return chunks
+
+
+def make_transcript(hours, seed=0):
+    """Generate a transcript-like text: caption segments of a few words, sparse punctuation."""
+    rng = random.Random(seed)
+    words = []
+    for i in range(int(hours * WORDS_PER_HOUR)):
+        words.append(rng.choice(VOCABULARY))
+        roll = rng.random()
+        if roll < 0.03:
+            words[-1] += rng.choice([".", "?", "!"])
+        elif roll < 0.12:
+            words[-1] += "\n"
+    return " ".join(words)
+
+
+def make_midword_texts(count, seed=0):
+    """Generate texts of long words with few spaces, so that chunks start in the middle of a word."""
+    rng = random.Random(seed)
+    texts = []
+    for _ in range(count):
+        words = [
+            rng.choice(LONG_WORDS + VOCABULARY) + rng.choice(["", "", "", " ", ".", "\n"])
+            for _ in range(rng.randint(50, 600))
+        ]
+        texts.append("".join(words))
+    return texts
+
+
+def check_midword_chunks(count):
+    """Check that both chunkers produce the same chunks on texts whose chunks start in the middle of a word."""
+    for i, text in enumerate(make_midword_texts(count)):
+        for chunk_token_size in (None, 7, 13, 50):
+            assert get_text_chunks(text, chunk_token_size) == legacy_get_text_chunks(text, chunk_token_size), (
+                f"chunker output differs from the previous implementation on mid-word text {i}, "
+                f"chunk size {chunk_token_size}"
+            )
+
+
+def best_time(func, text, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(text, None)
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument("--hours", type=float, default=3.0, help="Length of the longest transcript in hours")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs per measurement")
+    parser.add_argument("--midword-texts", type=int, default=200, help="Number of mid-word texts to check")
+    args = parser.parse_args()
+
+    check_midword_chunks(args.midword_texts)
+    print(f"{args.midword_texts} mid-word texts: same chunks as the previous implementation")
+
+    print(f"{'hours':>6} {'tokens':>8} {'chunks':>7} {'legacy s':>9} {'new s':>8} {'speedup':>8}")
+    for hours in (args.hours / 4, args.hours / 2, args.hours):
+        text = make_transcript(hours)
+        num_tokens = len(tokenizer.encode(text, disallowed_special=()))
+        legacy_time, legacy_chunks = best_time(legacy_get_text_chunks, text, args.repeat)
+        new_time, new_chunks = best_time(get_text_chunks, text, args.repeat)
+        assert new_chunks == legacy_chunks, "chunker output differs from the previous implementation"
+        print(
+            f"{hours:>6.2f} {num_tokens:>8} {len(new_chunks):>7} "
+            f"{legacy_time:>9.3f} {new_time:>8.3f} {legacy_time / new_time:>7.1f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
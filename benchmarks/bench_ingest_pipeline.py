@@ -0,0 +1,70 @@
+"""
+Benchmark importing a course of videos one at a time, as /add_video does, against the staged ingestion pipeline.
+
+Each stage is simulated by a sleep of its typical latency, scaled down by --scale, so the benchmark measures how
+the pipeline overlaps the stages of different videos and how its bounded queues limit the videos held in memory.
+
+Usage:
+    python benchmarks/bench_ingest_pipeline.py [--videos 50] [--scale 0.05]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-func"))
+
+from ingest import INGEST_CONCURRENCY, IngestItem, IngestPipeline  # noqa: E402
+
+# Seconds per video: oEmbed metadata, transcript download, chunking, embedding requests and vector upserts
+STAGE_LATENCY = {"metadata": 0.4, "transcript": 2.0, "chunk": 0.3, "embed": 3.0, "upsert": 1.0}
+
+
+def fake_stages(scale, in_flight):
+    def stage(name):
+        async def _stage(item):
+            if name == "metadata":
+                in_flight["now"] += 1
+                in_flight["peak"] = max(in_flight["peak"], in_flight["now"])
+            await asyncio.sleep(STAGE_LATENCY[name] * scale)
+            if name == "upsert":
+                in_flight["now"] -= 1
+            return True
+
+        return _stage
+
+    return {name: stage(name) for name in STAGE_LATENCY}
+
+
+async def sequential(video_ids, stages):
+    for video_id in video_ids:
+        item = IngestItem(video_id)
+        for stage in stages.values():
+            await stage(item)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--videos", type=int, default=50)
+    parser.add_argument("--scale", type=float, default=0.05, help="fraction of the real stage latencies to sleep")
+    args = parser.parse_args()
+
+    video_ids = [f"video{i:07d}" for i in range(args.videos)]
+    loop = asyncio.get_event_loop()
+    print(f"{args.videos} videos, stage latencies scaled by {args.scale}, concurrency {INGEST_CONCURRENCY}")
+    print(f"{'mode':<12} {'seconds':>8} {'real minutes':>12} {'peak videos in flight':>21}")
+    for name in ["sequential", "pipeline"]:
+        in_flight = {"now": 0, "peak": 0}
+        stages = fake_stages(args.scale, in_flight)
+        start = time.perf_counter()
+        if name == "sequential":
+            loop.run_until_complete(sequential(video_ids, stages))
+        else:
+            loop.run_until_complete(IngestPipeline(stages).run(video_ids))
+        elapsed = time.perf_counter() - start
+        print(f"{name:<12} {elapsed:>8.2f} {elapsed / args.scale / 60:>12.1f} {in_flight['peak']:>21}")
+
+
+if __name__ == "__main__":
+    main()
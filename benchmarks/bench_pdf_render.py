@@ -0,0 +1,98 @@
+"""
+Benchmark rendering a summary to PDF with the in-process renderer against the wkhtmltopdf binary.
+
+Each renderer runs in a fresh Python process, so its peak RSS is not mixed up with the other's. The peak RSS of the
+wkhtmltopdf processes, which run next to the Python process, is reported separately.
+
+Usage:
+    python benchmarks/bench_pdf_render.py [--sections 8] [--repeat 5] [--wkhtmltopdf /opt/bin/wkhtmltopdf]
+"""
+import argparse
+import json
+import os
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-func"))
+
+SECTION = """## Part {i}: Gradient descent
+
+The **loss function** measures how far the predictions of the model are from the labels. Training follows the
+*negative gradient* of the loss with respect to the weights, one small step at a time.
+
+- **Learning rate**: how large each step is, too large and training diverges
+- **Batch size**: how many examples are averaged for one gradient estimate
+  - smaller batches give noisier but cheaper steps
+1. Compute the predictions of a batch
+2. Backpropagate the loss to every weight
+3. Update the weights
+
+Momentum keeps a running average of past gradients, which smooths the path through narrow valleys of the loss.
+"""
+
+
+def summary_markdown(sections):
+    # Shaped like the output of agenerate_summary_pdf: one formatted section per transcript slice
+    return "# Neural networks, explained\n\n" + "\n\n".join(SECTION.format(i=i + 1) for i in range(sections))
+
+
+def max_rss_mb(who):
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(who).ru_maxrss / 1024
+
+
+def child(backend, sections, repeat, wkhtmltopdf_path):
+    """Renders in this process and prints the timings and peak RSS as JSON."""
+    from pdf_renderer import SimplePDFRenderer, WkhtmltopdfRenderer
+
+    renderer = SimplePDFRenderer() if backend == "simple" else WkhtmltopdfRenderer(wkhtmltopdf_path)
+    markdown_string = summary_markdown(sections)
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        pdf = renderer.render(markdown_string)
+        times.append(time.perf_counter() - start)
+
+    print(json.dumps({
+        "render_ms": statistics.median(times) * 1000,
+        "pdf_kb": len(pdf) / 1024,
+        "python_mb": max_rss_mb(resource.RUSAGE_SELF),
+        "subprocess_mb": max_rss_mb(resource.RUSAGE_CHILDREN),
+    }))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sections", type=int, default=8, help="summary sections, one per transcript slice")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--wkhtmltopdf", default=os.environ.get("WKHTMLTOPDF_PATH", "/opt/bin/wkhtmltopdf"))
+    parser.add_argument("--child", choices=["simple", "wkhtmltopdf"], help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child, args.sections, args.repeat, args.wkhtmltopdf)
+        return
+
+    print(f"{args.sections} sections, median of {args.repeat} renders")
+    print(f"{'renderer':<12} {'render ms':>9} {'PDF KB':>7} {'python MB':>9} {'subprocess MB':>13}")
+    for backend in ["simple", "wkhtmltopdf"]:
+        if backend == "wkhtmltopdf" and not os.path.exists(args.wkhtmltopdf):
+            print(f"{backend:<12} skipped, {args.wkhtmltopdf} not found")
+            continue
+        output = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), "--child", backend, "--sections", str(args.sections),
+             "--repeat", str(args.repeat), "--wkhtmltopdf", args.wkhtmltopdf],
+            check=True, capture_output=True, text=True,
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            f"{backend:<12} {result['render_ms']:>9.1f} {result['pdf_kb']:>7.1f} "
+            f"{result['python_mb']:>9.1f} {result['subprocess_mb']:>13.1f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,124 @@
+"""
+Benchmark PineconeDataStore._query and _upsert against a local fake index with a fixed request latency.
+
+Runs a multi-query request and a large upsert at several executor sizes, to show how PINECONE_CONCURRENCY
+overlaps the index requests. No network access or Pinecone account is used.
+
+Usage:
+    python benchmarks/bench_pinecone_concurrency.py [--latency 0.05] [--queries 8] [--chunks 2000]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from types import SimpleNamespace
+from unittest import mock
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-func"))
+
+# Importing the provider initializes the Pinecone client, which must not reach the network here
+with mock.patch("pinecone.init"):
+    from datastore.providers.pinecone_datastore import UPSERT_BATCH_SIZE, PineconeDataStore  # noqa: E402
+import numpy as np  # noqa: E402
+
+from models.models import DocumentChunkMetadata  # noqa: E402
+from models.records import DocumentChunks, QueryWithEmbedding  # noqa: E402
+
+EMBEDDING_DIMENSION = 1536
+
+
+class FakeIndex:
+    """Answers like a Pinecone index after sleeping for the given latency, and records the peak concurrency."""
+
+    def __init__(self, latency):
+        self.latency = latency
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.lock = threading.Lock()
+
+    def _request(self):
+        with self.lock:
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        time.sleep(self.latency)
+        with self.lock:
+            self.in_flight -= 1
+
+    def query(self, top_k, vector, filter, include_metadata):
+        self._request()
+        match = SimpleNamespace(id="chunk", score=1.0, metadata={"text": "text", "document_id": "doc"})
+        return SimpleNamespace(matches=[match] * top_k)
+
+    def upsert(self, vectors):
+        self._request()
+
+
+def make_store(index, concurrency):
+    # Skip __init__, which connects to Pinecone
+    store = PineconeDataStore.__new__(PineconeDataStore)
+    store.index = index
+    store.executor = ThreadPoolExecutor(max_workers=concurrency)
+    return store
+
+
+def run_queries(store, num_queries):
+    queries = [
+        QueryWithEmbedding(f"question {i}", np.zeros(EMBEDDING_DIMENSION, dtype=np.float32), top_k=3)
+        for i in range(num_queries)
+    ]
+    return asyncio.get_event_loop().run_until_complete(store._query(queries))
+
+
+def make_chunks(num_chunks):
+    return {
+        "doc": DocumentChunks(
+            "doc",
+            [f"doc_{i}" for i in range(num_chunks)],
+            ["text"] * num_chunks,
+            ["hash"] * num_chunks,
+            DocumentChunkMetadata(document_id="doc"),
+            np.zeros((num_chunks, EMBEDDING_DIMENSION), dtype=np.float32),
+        )
+    }
+
+
+def run_upsert(store, chunks):
+    return asyncio.get_event_loop().run_until_complete(store._upsert(chunks))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--latency", type=float, default=0.05, help="seconds per fake index request")
+    parser.add_argument("--queries", type=int, default=8)
+    parser.add_argument("--chunks", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, nargs="+", default=[1, 2, 4, 8, 16])
+    args = parser.parse_args()
+
+    batches = -(-args.chunks // UPSERT_BATCH_SIZE)
+    print(f"{args.queries} queries, {args.chunks} chunks in {batches} upsert batches, {args.latency * 1000:.0f} ms per request")
+    chunks = make_chunks(args.chunks)
+    print(f"{'concurrency':>11} {'query s':>8} {'peak':>5} {'upsert s':>9} {'peak':>5}")
+    for concurrency in args.concurrency:
+        index = FakeIndex(args.latency)
+        store = make_store(index, concurrency)
+
+        start = time.perf_counter()
+        results = run_queries(store, args.queries)
+        query_seconds = time.perf_counter() - start
+        query_peak = index.max_in_flight
+        assert len(results) == args.queries
+
+        index.max_in_flight = 0
+        start = time.perf_counter()
+        run_upsert(store, chunks)
+        upsert_seconds = time.perf_counter() - start
+
+        print(f"{concurrency:>11} {query_seconds:>8.3f} {query_peak:>5} {upsert_seconds:>9.3f} {index.max_in_flight:>5}")
+        store.executor.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,97 @@
+"""
+Benchmark the time until a /start_chat answer shows up in Telegram, with and without streaming.
+
+A fake OpenAI stream yields the answer token by token after a first-token latency, and a fake bot records when
+messages are sent and edited. Streaming sends a placeholder at once and edits it as tokens arrive, at most every
+TELEGRAM_EDIT_INTERVAL seconds. Without streaming the answer is sent once the whole completion is done.
+
+Usage:
+    python benchmarks/bench_streaming_reply.py [--first-token 0.6] [--token-interval 0.03] [--tokens 150]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "lambda-func"))
+
+import chat_utils  # noqa: E402
+from telegram_stream import StreamingReply  # noqa: E402
+
+TELEGRAM_LATENCY = 0.05  # seconds per fake Bot API request
+
+
+class FakeBot:
+    """Records the time of every message and edit, relative to start."""
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.events = []
+
+    def send_message(self, chat_id, text, reply_to_message_id=None):
+        time.sleep(TELEGRAM_LATENCY)
+        self.events.append((time.perf_counter() - self.start, "send", text))
+        return SimpleNamespace(message_id=len(self.events))
+
+    def edit_message_text(self, text, chat_id, message_id):
+        time.sleep(TELEGRAM_LATENCY)
+        self.events.append((time.perf_counter() - self.start, "edit", text))
+
+
+def fake_completion(first_token, token_interval, num_tokens):
+    """Returns a replacement for openai.ChatCompletion.acreate that streams num_tokens words."""
+
+    async def acreate(stream=False, **kwargs):
+        await asyncio.sleep(first_token)
+        if not stream:
+            await asyncio.sleep(token_interval * num_tokens)
+            answer = " ".join(f"word{i}" for i in range(num_tokens))
+            return {"choices": [{"message": {"content": answer}}]}
+
+        async def _chunks():
+            for i in range(num_tokens):
+                if i > 0:
+                    await asyncio.sleep(token_interval)
+                yield {"choices": [{"delta": {"content": f" word{i}"}}]}
+
+        return _chunks()
+
+    return acreate
+
+
+async def streamed(bot):
+    reply = StreamingReply(bot, chat_id=1)
+    await reply.start()
+    async for delta in chat_utils.stream_chatgpt_api("question", ["context"]):
+        await reply.feed(delta)
+    await reply.finish()
+
+
+async def not_streamed(bot):
+    response = await chat_utils.call_chatgpt_api("question", ["context"])
+    await asyncio.to_thread(bot.send_message, 1, response["choices"][0]["message"]["content"])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--first-token", type=float, default=0.6, help="seconds until the first token")
+    parser.add_argument("--token-interval", type=float, default=0.03, help="seconds between tokens")
+    parser.add_argument("--tokens", type=int, default=150)
+    args = parser.parse_args()
+
+    chat_utils.openai.ChatCompletion.acreate = fake_completion(args.first_token, args.token_interval, args.tokens)
+    loop = asyncio.get_event_loop()
+
+    print(f"{'mode':<14} {'first msg s':>11} {'first text s':>12} {'complete s':>10} {'requests':>8}")
+    for name, answer in [("not streamed", not_streamed), ("streamed", streamed)]:
+        bot = FakeBot()
+        loop.run_until_complete(answer(bot))
+        first_message = bot.events[0][0]
+        first_text = next(at for at, _, text in bot.events if "word" in text)
+        print(f"{name:<14} {first_message:>11.3f} {first_text:>12.3f} {bot.events[-1][0]:>10.3f} {len(bot.events):>8}")
+
+
+if __name__ == "__main__":
+    main()
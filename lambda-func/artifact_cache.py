@@ -0,0 +1,202 @@
+import os
+import threading
+from collections import Counter, OrderedDict
+
+from s3_storage_handler import bucket_name, get_s3_key, upload_file_to_s3, file_exists_in_s3
+
+ARTIFACT_CACHE_DIR = os.environ.get('ARTIFACT_CACHE_DIR', '/tmp/artifacts')
+ARTIFACT_CACHE_MEMORY_BYTES = int(os.environ.get('ARTIFACT_CACHE_MEMORY_BYTES', str(32 * 1024 * 1024)))
+ARTIFACT_CACHE_DISK_BYTES = int(os.environ.get('ARTIFACT_CACHE_DISK_BYTES', str(256 * 1024 * 1024)))
+
+
+class ArtifactCache:
+    """
+    Caches the artifacts of a bucket folder, e.g. the transcripts and summaries of videos, in three tiers:
+
+    - an in-memory LRU of file contents, bounded by ARTIFACT_CACHE_MEMORY_BYTES,
+    - an LRU of files under ARTIFACT_CACHE_DIR, bounded by ARTIFACT_CACHE_DISK_BYTES, so /tmp does not fill up
+      across warm invocations,
+    - the S3 bucket, which stores every artifact.
+
+    Whether an artifact exists in S3 is checked with head_object, without downloading it.
+    """
+
+    def __init__(self, client, folder, memory_bytes=ARTIFACT_CACHE_MEMORY_BYTES, disk_bytes=ARTIFACT_CACHE_DISK_BYTES,
+                 cache_dir=ARTIFACT_CACHE_DIR):
+        self.client = client
+        self.folder = folder
+        self.memory_bytes = memory_bytes
+        self.disk_bytes = disk_bytes
+        self.cache_dir = os.path.join(cache_dir, folder)
+        self.memory = OrderedDict()  # s3 key -> file contents
+        self.disk = OrderedDict()  # s3 key -> file size
+        self.in_s3 = set()  # s3 keys known to exist in the bucket
+        self.pins = Counter()  # s3 key -> lookups in progress, whose files are not evicted from disk
+        self.hits = {'memory': 0, 'disk': 0, 's3': 0}
+        self.misses = 0
+        # The cache is used from the threads of to_thread, the lock guards the tiers and the counters. Files are read,
+        # written and downloaded outside of it.
+        self.lock = threading.Lock()
+
+    def stats(self):
+        with self.lock:
+            hits = dict(self.hits)
+            misses = self.misses
+        lookups = sum(hits.values()) + misses
+        return {
+            **{f'{tier}_hit_rate': tier_hits / lookups if lookups else 0.0 for tier, tier_hits in hits.items()},
+            **{f'{tier}_hits': tier_hits for tier, tier_hits in hits.items()},
+            'misses': misses,
+        }
+
+    def report(self):
+        stats = self.stats()
+        rates = ', '.join(f'{tier} {stats[f"{tier}_hit_rate"]:.0%}' for tier in self.hits)
+        return f'Artifact cache {self.folder}: {rates}, {stats["misses"]} misses'
+
+    def local_path(self, item_id, file_name):
+        return os.path.join(self.cache_dir, str(item_id), file_name)
+
+    def exists(self, item_id, file_name):
+        """Returns whether an artifact exists in any tier, looking it up in S3 by its metadata only."""
+        key = get_s3_key(item_id, file_name, self.folder)
+        with self.lock:
+            if key in self.memory or key in self.disk or key in self.in_s3:
+                return True
+        if file_exists_in_s3(self.client, item_id, file_name, self.folder):
+            with self.lock:
+                self.in_s3.add(key)
+            return True
+        return False
+
+    def open_file(self, item_id, file_name, mode='rb'):
+        """
+        Opens a local copy of an artifact, downloading it from S3 if no tier above holds it, or returns None if it
+        does not exist. The file is not evicted from disk before it is open, and stays readable after it is evicted.
+        """
+        key = get_s3_key(item_id, file_name, self.folder)
+        self._pin(key)
+        try:
+            path = self._get_path(key, item_id, file_name)
+            return open(path, mode) if path else None
+        finally:
+            self._unpin(key)
+
+    def _get_path(self, key, item_id, file_name):
+        """
+        Returns the path of a local copy of a pinned artifact, downloading it from S3 if no tier above holds it,
+        or None if it does not exist.
+        """
+        path = self.local_path(item_id, file_name)
+
+        with self.lock:
+            contents = self.memory.get(key)
+            if contents is not None:
+                self.hits['memory'] += 1
+                self.memory.move_to_end(key)
+                if key in self.disk:
+                    self.disk.move_to_end(key)
+                    return path
+            elif key in self.disk:
+                self.hits['disk'] += 1
+                self.disk.move_to_end(key)
+            in_memory, on_disk, in_s3 = contents is not None, key in self.disk, key in self.in_s3
+
+        if in_memory:
+            self._write_file(path, contents)
+            with self.lock:
+                self._put_disk(key, len(contents))
+            return path
+
+        if on_disk:
+            self._put_memory(key, path)
+            return path
+
+        if not in_s3 and not file_exists_in_s3(self.client, item_id, file_name, self.folder):
+            with self.lock:
+                self.misses += 1
+            print(f'Artifact {key} not found. {self.report()}')
+            return None
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # The file is downloaded to a temporary name and renamed, so readers never see part of it
+        self.client.download_file(bucket_name, key, path)
+        print(f'The file {key} was downloaded to path: {path}')
+        with self.lock:
+            self.hits['s3'] += 1
+            self.in_s3.add(key)
+            self._put_disk(key, os.path.getsize(path))
+        self._put_memory(key, path)
+        return path
+
+    def put_file(self, item_id, file_path):
+        """
+        Uploads a local file as an artifact and moves it into the disk tier. Returns the new path of the file, which
+        may be evicted by later artifacts, read it with open_file.
+        """
+        file_name = os.path.basename(file_path)
+        key = get_s3_key(item_id, file_name, self.folder)
+        upload_file_to_s3(self.client, file_path, item_id, self.folder)
+
+        self._pin(key)
+        try:
+            path = self.local_path(item_id, file_name)
+            if os.path.abspath(file_path) != path:
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                os.replace(file_path, path)
+            with self.lock:
+                self.in_s3.add(key)
+                self.memory.pop(key, None)
+                self._put_disk(key, os.path.getsize(path))
+            self._put_memory(key, path)
+        finally:
+            self._unpin(key)
+        return path
+
+    def _pin(self, key):
+        with self.lock:
+            self.pins[key] += 1
+
+    def _unpin(self, key):
+        with self.lock:
+            self.pins[key] -= 1
+            if not self.pins[key]:
+                del self.pins[key]
+
+    def _put_memory(self, key, path):
+        size = os.path.getsize(path)
+        if size > self.memory_bytes:
+            return
+        with open(path, 'rb') as f:
+            contents = f.read()
+        with self.lock:
+            self.memory[key] = contents
+            self.memory.move_to_end(key)
+            memory_size = sum(len(contents) for contents in self.memory.values())
+            while memory_size > self.memory_bytes:
+                _, contents = self.memory.popitem(last=False)
+                memory_size -= len(contents)
+
+    def _put_disk(self, key, size):
+        # Called with the lock held
+        self.disk[key] = size
+        self.disk.move_to_end(key)
+        disk_size = sum(self.disk.values())
+        # Never evict the file that was just added or one that is being looked up, they are about to be used
+        for evicted_key in [k for k in self.disk if k != key and k not in self.pins]:
+            if disk_size <= self.disk_bytes:
+                break
+            disk_size -= self.disk.pop(evicted_key)
+            item_id, file_name = evicted_key.split('/')[-2:]
+            try:
+                os.remove(self.local_path(item_id, file_name))
+            except OSError as e:
+                print(f'Could not remove cached artifact {evicted_key}: {e}')
+
+    @staticmethod
+    def _write_file(path, contents):
+        # Written to a temporary name and renamed, so readers never see part of the file
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f'{path}.{threading.get_ident()}.tmp'
+        with open(temp_path, 'wb') as f:
+            f.write(contents)
+        os.replace(temp_path, path)
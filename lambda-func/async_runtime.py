@@ -0,0 +1,26 @@
+import asyncio
+
+# The event loop of this container, reused by every invocation
+_loop = None
+
+
+def get_loop():
+    """Returns the event loop of this container, creating it on first use."""
+    global _loop
+    if _loop is None or _loop.is_closed():
+        _loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(_loop)
+    return _loop
+
+
+def run(coro):
+    """
+    Runs a coroutine to completion on the event loop of this container. This is the one place where the
+    synchronous entry points (telebot handlers, the job worker) enter async code.
+    """
+    return get_loop().run_until_complete(coro)
+
+
+async def to_thread(func, *args, **kwargs):
+    """Runs a blocking call, e.g. a boto3 or telebot request, in a worker thread so other I/O can overlap it."""
+    return await asyncio.to_thread(func, *args, **kwargs)
@@ -1,14 +1,23 @@
-from typing import Any, List, Dict
+from typing import Any, AsyncIterator, List, Dict, Optional, Tuple
 import openai
 import logging
-from datastore.factory import get_datastore
+from datastore.factory import get_shared_datastore, invalidate_shared_datastore
 from models.models import Query, Document, DocumentMetadata, DocumentMetadataFilter
+from services.answer_cache import answer_cache
+from services.context import count_tokens, pack_context
+from services.openai import aget_embeddings
+from openai_client import OPENAI_HEDGE_AFTER, acall
 import ntpath
 import asyncio
+import os
+
+CONTEXT_TOP_K = int(os.environ.get("CONTEXT_TOP_K", "3"))  # Chunks retrieved per question, packed by pack_context
+CHAT_MODEL = "gpt-3.5-turbo"
+ANSWER_MAX_TOKENS = 200
 
 async def startup():
     global datastore
-    datastore = await get_datastore()
+    datastore = await get_shared_datastore()
 
 async def query_database(query_prompt: str, document_id: str) -> Dict[str, Any]:
     """
@@ -19,7 +28,7 @@ async def query_database(query_prompt: str, document_id: str) -> Dict[str, Any]:
         filter= DocumentMetadataFilter(
             document_id=document_id
         ),
-        top_k=3,
+        top_k=CONTEXT_TOP_K,
     )
     
     queries = []
@@ -39,10 +48,15 @@ async def upsert(id: str, content: str):
     documents = []
     documents.append(Document(id=id, text=content))
 
-    response_ids = await datastore.upsert(documents)
+    try:
+        response_ids = await datastore.upsert(documents)
+    except Exception as e:
+        invalidate_shared_datastore(e)
+        raise e
     return response_ids
 
 async def upsert_file(file_path: str):
+    await startup()
     documents = []
     with open(file_path, "rb") as f:
         file_content = f.read()
@@ -52,6 +66,7 @@ async def upsert_file(file_path: str):
     return response_ids
 
 async def delete(id: str, delete_all: bool):
+    await startup()
     ids = []
     ids.append(id)
     success = await datastore.delete(
@@ -71,11 +86,10 @@ def apply_prompt_template(question: str) -> str:
     return prompt
 
 
-def call_chatgpt_api(user_question: str, chunks: List[str]) -> Dict[str, Any]:
+def create_chatgpt_messages(user_question: str, chunks: List[str]) -> List[Dict[str, str]]:
     """
-    Call chatgpt api with user's question and retrieved chunks.
+    Create the chat messages for user's question and the passages packed from the retrieved chunks.
     """
-    # Send a request to the GPT-3 API
     messages = list(
         map(lambda chunk: {
             "role": "user",
@@ -83,32 +97,122 @@ def call_chatgpt_api(user_question: str, chunks: List[str]) -> Dict[str, Any]:
         }, chunks))
     question = apply_prompt_template(user_question)
     messages.append({"role": "user", "content": question})
-    response = openai.ChatCompletion.create(
-        model="gpt-3.5-turbo",
+    return messages
+
+
+def count_chatgpt_tokens(messages: List[Dict[str, str]]) -> int:
+    """
+    Return the tokens of the prompt and the longest answer, which a call takes from the rate limits of the user's key.
+    """
+    prompt_tokens = count_tokens([message["content"] for message in messages])
+    print(f"Prompt of {prompt_tokens} tokens in {len(messages)} messages")
+    return prompt_tokens + ANSWER_MAX_TOKENS
+
+
+async def call_chatgpt_api(user_question: str, chunks: List[str]) -> Dict[str, Any]:
+    """
+    Call chatgpt api with user's question and the passages packed from the retrieved chunks.
+    """
+    messages = create_chatgpt_messages(user_question, chunks)
+    # Send a request to the GPT-3 API, hedged since the user is waiting for the answer
+    response = await acall(
+        "chat",
+        openai.ChatCompletion.acreate,
+        tokens=count_chatgpt_tokens(messages),
+        hedge_after=OPENAI_HEDGE_AFTER,
+        model=CHAT_MODEL,
         messages=messages,
-        max_tokens=200,
+        max_tokens=ANSWER_MAX_TOKENS,
         temperature=0.7,  # High temperature leads to a more creative response.
     )
     return response
 
 
-async def ask(user_question: str, document_id: str) -> Dict[str, Any]:
+async def stream_chatgpt_api(user_question: str, chunks: List[str]) -> AsyncIterator[str]:
     """
-    Handle user's questions.
+    Call chatgpt api like call_chatgpt_api, yielding the text of the answer as it is generated.
+    """
+    messages = create_chatgpt_messages(user_question, chunks)
+    # Retries and hedging cover the request until the stream starts
+    response = await acall(
+        "chat",
+        openai.ChatCompletion.acreate,
+        tokens=count_chatgpt_tokens(messages),
+        hedge_after=OPENAI_HEDGE_AFTER,
+        model=CHAT_MODEL,
+        messages=messages,
+        max_tokens=ANSWER_MAX_TOKENS,
+        temperature=0.7,  # High temperature leads to a more creative response.
+        stream=True,
+    )
+    async for chunk in response:
+        delta = chunk["choices"][0].get("delta", {}).get("content")
+        if delta:
+            yield delta
+
+
+async def prepare_question(user_question: str, document_id: str) -> Tuple[List[str], List[str], List[float], Optional[str]]:
+    """
+    Retrieve the chunks for user's question and look up the answer cache.
+    Returns the packed passages, the retrieved chunk ids, the question embedding and the cached answer or None.
     """
     await startup()
     # Get chunks from database.
-    chunks_response = await query_database(user_question, document_id)
-    chunks = []
+    try:
+        chunks_response = await query_database(user_question, document_id)
+    except Exception as e:
+        invalidate_shared_datastore(e)
+        raise e
+    retrieved_chunks = []
+    chunk_ids = []
     for result in chunks_response:
         for inner_result in result.results:
-            chunks.append(inner_result.text)
+            retrieved_chunks.append(inner_result)
+            chunk_ids.append(inner_result.id)
     
     logging.info("User's questions: %s", user_question)
-    logging.info("Retrieved chunks: %s", chunks)
+    logging.info("Retrieved chunks: %s", [chunk.text for chunk in retrieved_chunks])
+
+    # The datastore embedded the question already, so this is an embedding cache hit
+    question_embedding = (await aget_embeddings([user_question]))[0]
+    answer = answer_cache.get(document_id, question_embedding, chunk_ids)
+    if answer is not None:
+        print(f"Answer cache hit: {answer_cache.stats()}")
+        return [], chunk_ids, question_embedding, answer
+
+    return pack_context(retrieved_chunks), chunk_ids, question_embedding, None
+
+
+async def ask(user_question: str, document_id: str) -> Dict[str, Any]:
+    """
+    Handle user's questions.
+    """
+    chunks, chunk_ids, question_embedding, answer = await prepare_question(user_question, document_id)
+    if answer is not None:
+        return answer
     
-    response = call_chatgpt_api(user_question, chunks)
+    response = await call_chatgpt_api(user_question, chunks)
     logging.info("Response: %s", response)
     
-    return response["choices"][0]["message"]["content"]
+    answer = response["choices"][0]["message"]["content"]
+    answer_cache.put(document_id, question_embedding, chunk_ids, answer)
+    print(f"Answer cache miss: {answer_cache.stats()}")
+    return answer
+
+
+async def ask_stream(user_question: str, document_id: str) -> AsyncIterator[str]:
+    """
+    Handle user's questions, yielding the answer as it is generated. A cached answer is yielded at once.
+    """
+    chunks, chunk_ids, question_embedding, answer = await prepare_question(user_question, document_id)
+    if answer is not None:
+        yield answer
+        return
+
+    answer = ""
+    async for delta in stream_chatgpt_api(user_question, chunks):
+        answer += delta
+        yield delta
 
+    answer_cache.put(document_id, question_embedding, chunk_ids, answer)
+    print(f"Answer cache miss: {answer_cache.stats()}")
@@ -1,26 +1,120 @@
 from abc import ABC, abstractmethod
 from typing import Dict, List, Optional
 import asyncio
+import os
 
 from models.models import (
     Document,
-    DocumentChunk,
     DocumentMetadataFilter,
     Query,
     QueryResult,
-    QueryWithEmbedding,
 )
-from services.chunks import get_document_chunks
-from services.openai import get_embeddings
+from models.records import DocumentChunks, QueryWithEmbedding
+from services.chunks import create_chunks, embed_chunks, get_document_chunks
+from services.openai import aget_embeddings
+
+# Re-upsert documents by writing only the chunks that changed, see DataStore.upsert
+INCREMENTAL_UPSERT = os.environ.get("INCREMENTAL_UPSERT", "true").lower() == "true"
 
 
 class DataStore(ABC):
     async def upsert(
-        self, documents: List[Document], chunk_token_size: Optional[int] = None
+        self,
+        documents: List[Document],
+        chunk_token_size: Optional[int] = None,
+        incremental: bool = INCREMENTAL_UPSERT,
     ) -> List[str]:
         """
         Takes in a list of documents and inserts them into the database.
-        First deletes all the existing vectors with the document id (if necessary, depends on the vector db), then inserts the new ones.
+        Embeds the documents, then deletes all the existing vectors with the document id (if necessary, depends on the vector db) and inserts the new ones.
+        With incremental set and a database that stores chunk content hashes, only the chunks whose hash changed are
+        embedded and written, and then the stale chunks beyond the new last chunk are deleted.
+        Return a list of document ids.
+        """
+        if incremental:
+            doc_ids = await self._incremental_upsert(documents, chunk_token_size)
+            if doc_ids is not None:
+                return doc_ids
+
+        chunks = await get_document_chunks(documents, chunk_token_size)
+
+        return await self._replace_documents(chunks)
+
+    async def _incremental_upsert(
+        self, documents: List[Document], chunk_token_size: Optional[int]
+    ) -> Optional[List[str]]:
+        """
+        Writes the changed chunks of the documents and deletes their stale chunks.
+        Returns None, without writing anything, if the database cannot look up stored content hashes.
+        """
+        return await self._upsert_changed_chunks(create_chunks(documents, chunk_token_size))
+
+    async def _upsert_changed_chunks(self, chunks: Dict[str, DocumentChunks]) -> Optional[List[str]]:
+        """
+        Takes in a dict from document id to the chunks of the document, embeds the chunks whose content hash changed
+        unless they are embedded already, writes them and then deletes the stale chunks beyond the new last chunk.
+        Returns None, without writing anything, if the database cannot look up stored content hashes.
+        """
+        stored_hashes = await asyncio.gather(
+            *[
+                self._get_chunk_hashes(doc_id, doc_chunks.ids)
+                for doc_id, doc_chunks in chunks.items()
+            ]
+        )
+        if any(hashes is None for hashes in stored_hashes):
+            return None
+
+        changed_chunks: Dict[str, DocumentChunks] = {}
+        stale_ids: List[str] = []
+        for (doc_id, doc_chunks), hashes in zip(chunks.items(), stored_hashes):
+            changed_chunks[doc_id] = doc_chunks.select(
+                [
+                    row
+                    for row, (chunk_id, content_hash) in enumerate(zip(doc_chunks.ids, doc_chunks.content_hashes))
+                    if hashes.get(chunk_id) != content_hash
+                ]
+            )
+            chunk_ids = set(doc_chunks.ids)
+            stale_ids.extend(chunk_id for chunk_id in hashes if chunk_id not in chunk_ids)
+
+        num_changed = sum(len(doc_chunks) for doc_chunks in changed_chunks.values())
+        print(
+            f"Incremental upsert: {num_changed} of {sum(len(doc_chunks) for doc_chunks in chunks.values())} "
+            f"chunks changed, {len(stale_ids)} stale chunks"
+        )
+        unembedded_chunks = {
+            doc_id: doc_chunks
+            for doc_id, doc_chunks in changed_chunks.items()
+            if len(doc_chunks) and doc_chunks.embeddings is None
+        }
+        if unembedded_chunks:
+            # Only the changed chunks are embedded, the S3 objects of the documents are left as they are
+            await embed_chunks(unembedded_chunks, complete=False)
+        if num_changed or stale_ids:
+            await self._replace_chunks(changed_chunks, stale_ids)
+
+        return list(chunks.keys())
+
+    async def upsert_chunks(
+        self, chunks: Dict[str, DocumentChunks], incremental: bool = INCREMENTAL_UPSERT
+    ) -> List[str]:
+        """
+        Takes in a dict from document id to the embedded chunks of the document, e.g. from a pipeline that chunks and
+        embeds documents in stages of its own, and replaces the stored chunks of those documents with them.
+        With incremental set, only the chunks whose hash changed are written, as in upsert.
+        Return a list of document ids.
+        """
+        if incremental:
+            doc_ids = await self._upsert_changed_chunks(chunks)
+            if doc_ids is not None:
+                return doc_ids
+
+        return await self._replace_documents(chunks)
+
+    async def _replace_documents(self, chunks: Dict[str, DocumentChunks]) -> List[str]:
+        """
+        Takes in a dict from document id to the embedded chunks of the document and replaces all stored chunks of
+        those documents with them, by deleting the documents and then inserting the chunks.
         Return a list of document ids.
         """
         # Delete any existing vectors for documents with the input document ids
@@ -28,23 +122,45 @@ class DataStore(ABC):
             *[
                 self.delete(
                     filter=DocumentMetadataFilter(
-                        document_id=document.id,
+                        document_id=doc_id,
                     ),
                     delete_all=False,
                 )
-                for document in documents
-                if document.id
+                for doc_id in chunks
             ]
         )
+        return await self._upsert(chunks)
 
-        chunks = get_document_chunks(documents, chunk_token_size)
+    async def _replace_chunks(self, chunks: Dict[str, DocumentChunks], stale_ids: List[str]):
+        """
+        Takes in a dict from document id to the embedded chunks that changed and the ids of the stored chunks that no
+        longer exist, and writes the former before deleting the latter, so the documents always have vectors.
+        """
+        if any(len(doc_chunks) for doc_chunks in chunks.values()):
+            await self._upsert(chunks)
+        if stale_ids:
+            await self._delete_chunks(stale_ids)
 
-        return await self._upsert(chunks)
+    async def _get_chunk_hashes(
+        self, document_id: str, chunk_ids: List[str]
+    ) -> Optional[Dict[str, str]]:
+        """
+        Takes in a document id and the ids of its new chunks and returns the content hashes of its stored chunks by
+        chunk id, including stored chunks that are not in chunk_ids. Chunks stored without a hash map to None.
+        Returns None if the database does not support this, which makes upsert delete and insert every chunk.
+        """
+        return None
+
+    async def _delete_chunks(self, chunk_ids: List[str]):
+        """
+        Removes chunks by chunk id. Only needed by databases that implement _get_chunk_hashes.
+        """
+        raise NotImplementedError
 
     @abstractmethod
-    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+    async def _upsert(self, chunks: Dict[str, DocumentChunks]) -> List[str]:
         """
-        Takes in a list of list of document chunks and inserts them into the database.
+        Takes in a dict from document id to the embedded chunks of the document and inserts them into the database.
         Return a list of document ids.
         """
 
@@ -56,10 +172,12 @@ class DataStore(ABC):
         """
         # get a list of of just the queries from the Query list
         query_texts = [query.query for query in queries]
-        query_embeddings = get_embeddings(query_texts)
+        query_embeddings = await aget_embeddings(query_texts)
         # hydrate the queries with embeddings
         queries_with_embeddings = [
-            QueryWithEmbedding(**query.dict(), embedding=embedding)
+            QueryWithEmbedding(
+                query.query, embedding, filter=query.filter, top_k=query.top_k
+            )
             for query, embedding in zip(queries, query_embeddings)
         ]
         return await self._query(queries_with_embeddings)
@@ -71,6 +189,24 @@ class DataStore(ABC):
         """
         raise NotImplementedError
 
+    async def health_check(self) -> bool:
+        """
+        Returns whether the connection to the database still works.
+        """
+        return True
+
+    def is_connection_error(self, error: Exception) -> bool:
+        """
+        Returns whether an error raised by a request came from the database or the connection to it, rather than e.g.
+        from the OpenAI embeddings of the request, so that reconnecting may help.
+        """
+        return isinstance(error, (ConnectionError, TimeoutError))
+
+    def close(self):
+        """
+        Releases the resources of the datastore, e.g. its threads. The datastore is not used afterwards.
+        """
+
     @abstractmethod
     async def delete(
         self,
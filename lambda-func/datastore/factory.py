@@ -1,6 +1,67 @@
 from datastore.datastore import DataStore
+from typing import Optional
 import os
+import time
+
+DATASTORE_HEALTH_CHECK_INTERVAL = int(os.environ.get("DATASTORE_HEALTH_CHECK_INTERVAL", "300"))  # seconds
+
+# The datastore shared by all handlers of this container, see get_shared_datastore
+shared_datastore: Optional[DataStore] = None
+shared_datastore_checked_at = 0.0
+datastore_builds = 0  # how many times this container built the shared datastore
 
 async def get_datastore() -> DataStore:
-    from datastore.providers.pinecone_datastore import PineconeDataStore
-    return PineconeDataStore()
\ No newline at end of file
+    datastore = os.environ.get("DATASTORE", "pinecone")
+
+    if datastore == "pinecone":
+        from datastore.providers.pinecone_datastore import PineconeDataStore
+        return PineconeDataStore()
+    elif datastore == "local":
+        from datastore.providers.local_datastore import LocalDataStore
+        return LocalDataStore()
+    else:
+        raise ValueError(f"Unsupported vector database: {datastore}")
+
+
+async def get_shared_datastore() -> DataStore:
+    """
+    Return the datastore of this container, building it on first use.
+
+    The datastore is health checked at most every DATASTORE_HEALTH_CHECK_INTERVAL seconds and rebuilt when the check
+    fails or after invalidate_shared_datastore.
+    """
+    global shared_datastore, shared_datastore_checked_at, datastore_builds
+
+    now = time.monotonic()
+    if shared_datastore is not None and now - shared_datastore_checked_at >= DATASTORE_HEALTH_CHECK_INTERVAL:
+        try:
+            healthy = await shared_datastore.health_check()
+        except Exception as e:
+            print(f"Datastore health check failed: {e}")
+            healthy = False
+        shared_datastore_checked_at = now
+        if not healthy:
+            shared_datastore.close()
+            shared_datastore = None
+
+    if shared_datastore is None:
+        shared_datastore = await get_datastore()
+        shared_datastore_checked_at = now
+        datastore_builds += 1
+        print(f"Datastore built, {datastore_builds - 1} rebuilds in this container")
+
+    return shared_datastore
+
+
+def invalidate_shared_datastore(error: Optional[Exception] = None):
+    """
+    Drop the shared datastore after a request failed with error, so the next use reconnects. The datastore is kept if
+    the error did not come from it or its connection, e.g. if the OpenAI embeddings of the request failed.
+    """
+    global shared_datastore
+    if shared_datastore is None:
+        return
+    if error is not None and not shared_datastore.is_connection_error(error):
+        return
+    shared_datastore.close()
+    shared_datastore = None
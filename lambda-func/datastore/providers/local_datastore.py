@@ -0,0 +1,521 @@
+import asyncio
+import io
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+
+from datastore.datastore import DataStore
+from models.models import (
+    DocumentChunkMetadata,
+    DocumentChunkWithScore,
+    DocumentMetadataFilter,
+    QueryResult,
+)
+from models.records import DocumentChunks, QueryWithEmbedding
+from services.date import to_unix_timestamp
+
+# Read environment variables for the local datastore configuration
+LOCAL_DATASTORE_PATH = os.environ.get("LOCAL_DATASTORE_PATH", "/tmp/local_datastore")
+LOCAL_DATASTORE_BUCKET = os.environ.get("LOCAL_DATASTORE_BUCKET")
+LOCAL_DATASTORE_PREFIX = os.environ.get("LOCAL_DATASTORE_PREFIX", "datastore")
+
+EMBEDDING_DIMENSION = 1536  # dimensionality of OpenAI ada v2 embeddings
+EMBEDDINGS_FILE_NAME = "embeddings.npy"
+METADATA_FILE_NAME = "metadata.json"
+LOCAL_DATASTORE_REFRESH_INTERVAL = float(
+    os.environ.get("LOCAL_DATASTORE_REFRESH_INTERVAL", "60")
+)  # seconds between checks of S3 for documents that other containers wrote, before queries of all documents
+S3_DOWNLOAD_THREADS = 16  # concurrent downloads of the document objects when loading from S3
+
+# Metadata fields that can be matched exactly by a DocumentMetadataFilter
+FILTER_FIELDS = ["document_id", "source", "source_id", "author"]
+
+
+class LocalDataStore(DataStore):
+    """
+    A datastore that keeps all chunk embeddings in one contiguous float32 matrix and answers queries by brute force.
+
+    Rows of the matrix are normalized on insert, so cosine similarity is a single matrix-vector product. Chunk ids,
+    texts and metadata live in a side table whose row order matches the matrix. Both are persisted to
+    LOCAL_DATASTORE_PATH once per write, the matrix as a .npy file that is memory-mapped on load.
+
+    When a bucket is configured, each document is also mirrored to its own object
+    s3://LOCAL_DATASTORE_BUCKET/LOCAL_DATASTORE_PREFIX/documents/<document id>.npz, and a write uploads only the
+    documents it changed. Containers that write different documents therefore never overwrite each other's vectors.
+    The ETag of every document object is kept, so that the documents another container wrote since are downloaded
+    again: those of the document_id filter before a query or an incremental upsert, with a conditional GET, and all
+    of them before a query without one, at most every LOCAL_DATASTORE_REFRESH_INTERVAL seconds.
+    """
+
+    def __init__(
+        self,
+        path: str = LOCAL_DATASTORE_PATH,
+        bucket_name: Optional[str] = LOCAL_DATASTORE_BUCKET,
+        prefix: str = LOCAL_DATASTORE_PREFIX,
+    ):
+        self.path = path
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = None
+        if self.bucket_name:
+            import boto3
+
+            self.s3_client = boto3.client("s3")
+        self.etags: Dict[str, str] = {}  # document id -> ETag of the S3 object the rows of the document come from
+        self.refreshed_at = time.monotonic()
+
+        os.makedirs(self.path, exist_ok=True)
+        self._download_from_s3()
+        self._load()
+
+    @property
+    def _embeddings_path(self) -> str:
+        return os.path.join(self.path, EMBEDDINGS_FILE_NAME)
+
+    @property
+    def _metadata_path(self) -> str:
+        return os.path.join(self.path, METADATA_FILE_NAME)
+
+    def _load(self):
+        """
+        Load the embedding matrix as a read-only memory map and the metadata side table into memory.
+        """
+        if os.path.exists(self._embeddings_path) and os.path.exists(self._metadata_path):
+            print(f"Loading local datastore from {self.path}")
+            self.embeddings = np.load(self._embeddings_path, mmap_mode="r")
+            with open(self._metadata_path, "r") as f:
+                self.records: List[Dict[str, Any]] = json.load(f)
+        else:
+            print(f"Creating empty local datastore in {self.path}")
+            self.embeddings = np.empty((0, EMBEDDING_DIMENSION), dtype=np.float32)
+            self.records = []
+        self._build_columns()
+
+    def _build_columns(self):
+        """
+        Build the column arrays used for vectorized filtering and the chunk id to row lookup.
+        """
+        self.row_by_id = {record["id"]: row for row, record in enumerate(self.records)}
+        self.columns = {
+            field: np.array(
+                [record["metadata"].get(field) for record in self.records], dtype=object
+            )
+            for field in FILTER_FIELDS
+        }
+        self.dates = np.array(
+            [record["metadata"].get("created_at", np.nan) for record in self.records],
+            dtype=np.float64,
+        )
+
+    def _save(
+        self,
+        embeddings: np.ndarray,
+        records: List[Dict[str, Any]],
+        document_ids: Optional[Iterable[str]] = None,
+    ):
+        """
+        Atomically replace the persisted matrix and side table, then reopen the matrix as a memory map.
+        The objects of the given documents are then uploaded to S3, or deleted there if no rows of them are left.
+        """
+        embeddings_tmp_path = self._embeddings_path + ".tmp"
+        metadata_tmp_path = self._metadata_path + ".tmp"
+        # np.save appends .npy to paths without that suffix, so write through a file object
+        with open(embeddings_tmp_path, "wb") as f:
+            np.save(f, np.ascontiguousarray(embeddings, dtype=np.float32))
+        with open(metadata_tmp_path, "w") as f:
+            json.dump(records, f)
+        os.replace(embeddings_tmp_path, self._embeddings_path)
+        os.replace(metadata_tmp_path, self._metadata_path)
+
+        self.embeddings = np.load(self._embeddings_path, mmap_mode="r")
+        self.records = records
+        self._build_columns()
+        if document_ids is not None:
+            self._upload_to_s3(document_ids)
+
+    def _get_document_key(self, document_id: str) -> str:
+        return f"{self.prefix}/documents/{document_id}.npz"
+
+    def _get_document_id(self, key: str) -> str:
+        return key[len(f"{self.prefix}/documents/") : -len(".npz")]
+
+    def _list_documents(self) -> Dict[str, str]:
+        """
+        Return the ETag of every document object in S3 by document id.
+        """
+        etags = {}
+        paginator = self.s3_client.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket_name, Prefix=f"{self.prefix}/documents/"):
+            for item in page.get("Contents", []):
+                etags[self._get_document_id(item["Key"])] = item["ETag"]
+        return etags
+
+    def _fetch_documents(
+        self, document_ids: Iterable[str]
+    ) -> Dict[str, Optional[Tuple[str, np.ndarray, List[Dict[str, Any]]]]]:
+        """
+        Download the objects of documents that changed since their known ETag, with conditional GETs.
+        Returns the ETag, embeddings and records of every changed document by document id, or None for a document
+        whose object no longer exists. Documents that did not change are left out.
+        """
+        from botocore.exceptions import ClientError
+
+        def fetch(document_id):
+            etag = self.etags.get(document_id)
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name,
+                    Key=self._get_document_key(document_id),
+                    **({"IfNoneMatch": etag} if etag else {}),
+                )
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code in ("304", "NotModified"):
+                    return document_id, False
+                if code in ("404", "NoSuchKey"):
+                    return document_id, None
+                raise e
+            with np.load(io.BytesIO(response["Body"].read())) as data:
+                return document_id, (response["ETag"], data["embeddings"], json.loads(str(data["records"])))
+
+        with ThreadPoolExecutor(max_workers=S3_DOWNLOAD_THREADS) as executor:
+            fetched = list(executor.map(fetch, set(document_ids)))
+        return {document_id: document for document_id, document in fetched if document is not False}
+
+    def _download_from_s3(self):
+        """
+        Download every document object and persist their rows as the local matrix and side table.
+        """
+        if self.s3_client is None:
+            return
+        document_ids = list(self._list_documents())
+        if not document_ids:
+            print(f"No documents found in s3://{self.bucket_name}/{self.prefix}/documents/")
+            return
+
+        documents = {
+            document_id: document
+            for document_id, document in self._fetch_documents(document_ids).items()
+            if document is not None
+        }
+        if not documents:
+            return
+        self._save(
+            np.concatenate([embeddings for _, embeddings, _ in documents.values()]),
+            [record for _, _, records in documents.values() for record in records],
+        )
+        self.etags = {document_id: etag for document_id, (etag, _, _) in documents.items()}
+        print(f"Downloaded {len(documents)} documents from s3 bucket {self.bucket_name} to path: {self.path}")
+
+    async def _refresh_documents(self, document_ids: Iterable[str]):
+        """
+        Replace the rows of documents whose S3 object another container wrote or deleted since they were loaded.
+        """
+        if self.s3_client is None:
+            return
+        documents = await asyncio.to_thread(self._fetch_documents, document_ids)
+        self._apply_documents(documents)
+
+    async def _refresh_all(self):
+        """
+        Load the documents that other containers wrote or deleted, at most every LOCAL_DATASTORE_REFRESH_INTERVAL.
+        """
+        if self.s3_client is None or time.monotonic() - self.refreshed_at < LOCAL_DATASTORE_REFRESH_INTERVAL:
+            return
+        self.refreshed_at = time.monotonic()
+        etags = await asyncio.to_thread(self._list_documents)
+        changed = [document_id for document_id, etag in etags.items() if self.etags.get(document_id) != etag]
+        documents = await asyncio.to_thread(self._fetch_documents, changed) if changed else {}
+        documents.update({document_id: None for document_id in self.etags if document_id not in etags})
+        self._apply_documents(documents)
+
+    def _apply_documents(self, documents: Dict[str, Optional[Tuple[str, np.ndarray, List[Dict[str, Any]]]]]):
+        """
+        Replace the rows of the given documents with the downloaded ones, or remove them for documents given as None,
+        and save the result once without uploading it.
+        """
+        documents = {
+            document_id: document
+            for document_id, document in documents.items()
+            if document is not None or document_id in self.etags
+        }
+        if not documents:
+            return
+        keep = np.flatnonzero(~np.isin(self.columns["document_id"], list(documents)))
+        downloaded = [document for document in documents.values() if document is not None]
+        self._save(
+            np.concatenate(
+                [np.asarray(self.embeddings[keep], dtype=np.float32)]
+                + [embeddings for _, embeddings, _ in downloaded]
+            ),
+            [self.records[row] for row in keep] + [record for _, _, records in downloaded for record in records],
+        )
+        for document_id, document in documents.items():
+            if document is None:
+                self.etags.pop(document_id, None)
+            else:
+                self.etags[document_id] = document[0]
+        print(f"Reloaded {len(documents)} documents that changed in s3 bucket {self.bucket_name}")
+
+    def _upload_to_s3(self, document_ids: Iterable[str]):
+        """
+        Upload the rows of each document as one object, or delete the object of a document without rows.
+        """
+        if self.s3_client is None:
+            return
+        for document_id in set(document_ids):
+            key = self._get_document_key(document_id)
+            rows = np.flatnonzero(self.columns["document_id"] == document_id)
+            if len(rows) == 0:
+                self.s3_client.delete_object(Bucket=self.bucket_name, Key=key)
+                self.etags.pop(document_id, None)
+                print(f"The document {document_id} was deleted from s3 bucket: {key}")
+                continue
+            buffer = io.BytesIO()
+            np.savez(
+                buffer,
+                embeddings=np.asarray(self.embeddings[rows], dtype=np.float32),
+                records=np.array(json.dumps([self.records[row] for row in rows])),
+            )
+            response = self.s3_client.put_object(Bucket=self.bucket_name, Key=key, Body=buffer.getvalue())
+            self.etags[document_id] = response["ETag"]
+            print(f"The document {document_id} was uploaded to s3 bucket: {key}")
+
+    async def _upsert(self, chunks: Dict[str, DocumentChunks]) -> List[str]:
+        """
+        Takes in a dict from document id to the chunks of the document and inserts them into the matrix.
+        Chunks whose id is already stored replace the existing row.
+        Return a list of document ids.
+        """
+        self._write(chunks, np.zeros(len(self.records), dtype=bool))
+        return list(chunks.keys())
+
+    async def _replace_documents(self, chunks: Dict[str, DocumentChunks]) -> List[str]:
+        """
+        Removes the rows of the documents and inserts their new chunks in a single write.
+        """
+        self._write(chunks, np.isin(self.columns["document_id"], list(chunks.keys())))
+        return list(chunks.keys())
+
+    async def _replace_chunks(self, chunks: Dict[str, DocumentChunks], stale_ids: List[str]):
+        """
+        Inserts the changed chunks and removes the stale ones in a single write.
+        """
+        self._write(chunks, self._get_rows_mask(stale_ids))
+
+    def _write(self, chunks: Dict[str, DocumentChunks], to_delete: np.ndarray):
+        """
+        Removes the rows in the to_delete mask, then inserts the chunks, overwriting the rows of chunks whose id is
+        already stored, and saves the result once.
+        """
+        keep = np.flatnonzero(~to_delete)
+        # Indexing with an array copies the memory-mapped rows into a writable matrix
+        embeddings = np.asarray(self.embeddings[keep], dtype=np.float32)
+        records = [self.records[row] for row in keep]
+        row_by_id = {record["id"]: row for row, record in enumerate(records)}
+        appended_rows: List[np.ndarray] = []
+        appended_records: List[Dict[str, Any]] = []
+
+        for doc_id, doc_chunks in chunks.items():
+            if len(doc_chunks) == 0:
+                continue
+            print(f"Upserting document_id: {doc_id}")
+            metadata = self._get_local_metadata(doc_chunks.metadata)
+            metadata["document_id"] = doc_id
+            vectors = self._normalize_rows(doc_chunks.embeddings)
+            stored_rows = [row_by_id.get(chunk_id) for chunk_id in doc_chunks.ids]
+            for i, row in enumerate(stored_rows):
+                record = {
+                    "id": doc_chunks.ids[i],
+                    "text": doc_chunks.texts[i],
+                    "metadata": metadata,
+                    "content_hash": doc_chunks.content_hashes[i],
+                }
+                if row is not None:
+                    # Overwrite the row of a chunk that is already stored
+                    embeddings[row] = vectors[i]
+                    records[row] = record
+                else:
+                    appended_records.append(record)
+            new_rows = [i for i, row in enumerate(stored_rows) if row is None]
+            if new_rows:
+                appended_rows.append(vectors[new_rows])
+
+        # Append the new chunks at the end of the matrix
+        if appended_rows:
+            embeddings = np.concatenate([embeddings] + appended_rows)
+            records.extend(appended_records)
+
+        num_upserted = sum(len(doc_chunks) for doc_chunks in chunks.values())
+        print(f"Upserted {num_upserted} and deleted {int(to_delete.sum())} chunks in local datastore")
+        document_ids = set(chunks.keys()) | set(self.columns["document_id"][to_delete])
+        self._save(embeddings, records, document_ids)
+
+    def _get_rows_mask(self, chunk_ids: List[str]) -> np.ndarray:
+        mask = np.zeros(len(self.records), dtype=bool)
+        mask[[self.row_by_id[chunk_id] for chunk_id in chunk_ids if chunk_id in self.row_by_id]] = True
+        return mask
+
+    def is_connection_error(self, error: Exception) -> bool:
+        """
+        Errors reading or writing the persisted files, or S3 errors when a bucket is configured.
+        """
+        if self.s3_client is not None:
+            from botocore.exceptions import BotoCoreError, ClientError
+
+            if isinstance(error, (BotoCoreError, ClientError)):
+                return True
+        return isinstance(error, OSError)
+
+    async def _query(
+        self,
+        queries: List[QueryWithEmbedding],
+    ) -> List[QueryResult]:
+        """
+        Takes in a list of queries with embeddings and filters and returns a list of query results with matching document chunks and scores.
+        """
+        # Load what other containers wrote since, e.g. a video that the worker just added
+        document_ids = [query.filter.document_id if query.filter else None for query in queries]
+        if all(document_ids):
+            await self._refresh_documents(document_ids)
+        else:
+            await self._refresh_all()
+
+        results: List[QueryResult] = []
+        for query in queries:
+            print(f"Query: {query.query}")
+
+            # Restrict the search to the rows that pass the metadata filter
+            candidate_rows = np.flatnonzero(self._get_filter_mask(query.filter))
+            if len(candidate_rows) == 0:
+                results.append(QueryResult(query=query.query, results=[]))
+                continue
+
+            query_embedding = self._normalize(np.asarray(query.embedding, dtype=np.float32))
+            scores = self.embeddings[candidate_rows] @ query_embedding
+
+            # Select the top_k rows without sorting the whole score vector
+            top_k = min(query.top_k or 3, len(candidate_rows))
+            top = np.argpartition(-scores, top_k - 1)[:top_k]
+            top = top[np.argsort(-scores[top])]
+
+            query_results: List[DocumentChunkWithScore] = []
+            for i in top:
+                record = self.records[candidate_rows[i]]
+                query_results.append(
+                    DocumentChunkWithScore(
+                        id=record["id"],
+                        score=float(scores[i]),
+                        text=record["text"],
+                        metadata=record["metadata"],
+                    )
+                )
+            results.append(QueryResult(query=query.query, results=query_results))
+
+        return results
+
+    async def _get_chunk_hashes(
+        self, document_id: str, chunk_ids: List[str]
+    ) -> Optional[Dict[str, str]]:
+        """
+        Returns the content hashes of the stored chunks of a document, read from the side table.
+        """
+        await self._refresh_documents([document_id])
+        rows = np.flatnonzero(self.columns["document_id"] == document_id)
+        return {
+            self.records[row]["id"]: self.records[row].get("content_hash")
+            for row in rows
+        }
+
+    async def _delete_chunks(self, chunk_ids: List[str]):
+        """
+        Removes rows by chunk id from the matrix.
+        """
+        to_delete = self._get_rows_mask(chunk_ids)
+        if to_delete.any():
+            self._write({}, to_delete)
+
+    async def delete(
+        self,
+        ids: Optional[List[str]] = None,
+        filter: Optional[DocumentMetadataFilter] = None,
+        delete_all: Optional[bool] = None,
+    ) -> bool:
+        """
+        Removes vectors by document ids, filter, or everything from the matrix.
+        """
+        if delete_all:
+            print(f"Deleting all vectors from local datastore")
+            self._write({}, np.ones(len(self.records), dtype=bool))
+            return True
+
+        to_delete = np.zeros(len(self.records), dtype=bool)
+        if filter is not None and self._has_conditions(filter):
+            print(f"Deleting vectors with filter {filter}")
+            to_delete |= self._get_filter_mask(filter)
+        if ids is not None and len(ids) > 0:
+            print(f"Deleting vectors with ids {ids}")
+            to_delete |= np.isin(self.columns["document_id"], ids)
+
+        if to_delete.any():
+            self._write({}, to_delete)
+
+        return True
+
+    def _has_conditions(self, filter: DocumentMetadataFilter) -> bool:
+        return any(value is not None for value in filter.dict().values())
+
+    def _get_filter_mask(
+        self, filter: Optional[DocumentMetadataFilter] = None
+    ) -> np.ndarray:
+        """
+        Return a boolean mask over the stored rows that match every condition of the filter.
+        """
+        mask = np.ones(len(self.records), dtype=bool)
+        if filter is None:
+            return mask
+
+        for field, value in filter.dict().items():
+            if value is None:
+                continue
+            if field == "start_date":
+                mask &= self.dates >= to_unix_timestamp(value)
+            elif field == "end_date":
+                mask &= self.dates <= to_unix_timestamp(value)
+            else:
+                mask &= self.columns[field] == value
+
+        return mask
+
+    def _get_local_metadata(
+        self, metadata: Optional[DocumentChunkMetadata] = None
+    ) -> Dict[str, Any]:
+        if metadata is None:
+            return {}
+
+        local_metadata = {}
+
+        # For each field in the Metadata, check if it has a value and add it to the metadata dict
+        # For fields that are dates, convert them to unix timestamps
+        for field, value in metadata.dict().items():
+            if value is not None:
+                if field in ["created_at"]:
+                    local_metadata[field] = to_unix_timestamp(value)
+                else:
+                    local_metadata[field] = value
+
+        return local_metadata
+
+    @staticmethod
+    def _normalize_rows(matrix: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        return matrix / np.where(norms > 0, norms, 1)
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
@@ -1,18 +1,20 @@
 import os
 from typing import Any, Dict, List, Optional
 import pinecone
+import urllib3
 import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
 
 from datastore.datastore import DataStore
 from models.models import (
-    DocumentChunk,
     DocumentChunkMetadata,
     DocumentChunkWithScore,
     DocumentMetadataFilter,
     QueryResult,
-    QueryWithEmbedding,
     Source,
 )
+from models.records import DocumentChunks, QueryWithEmbedding
 from services.date import to_unix_timestamp
 
 # Read environment variables for Pinecone configuration
@@ -32,10 +34,20 @@ pinecone.init(api_key=PINECONE_API_KEY, environment=PINECONE_ENVIRONMENT)
 
 # Set the batch size for upserting vectors to Pinecone
 UPSERT_BATCH_SIZE = 100
+# The number of vector ids to fetch or delete in one request
+FETCH_BATCH_SIZE = 100
+DELETE_BATCH_SIZE = 1000
+# The number of index requests (queries, upsert batches, deletes) in flight at a time
+PINECONE_CONCURRENCY = int(os.environ.get("PINECONE_CONCURRENCY", "8"))
 
 
 class PineconeDataStore(DataStore):
     def __init__(self):
+        # The Pinecone client is blocking, so index requests run on a bounded pool of threads
+        self.executor = ThreadPoolExecutor(
+            max_workers=PINECONE_CONCURRENCY, thread_name_prefix="pinecone"
+        )
+
         # Check if the index name is specified and exists in Pinecone
         if PINECONE_INDEX and PINECONE_INDEX not in pinecone.list_indexes():
 
@@ -67,45 +79,86 @@ class PineconeDataStore(DataStore):
                 print(f"Error connecting to index {PINECONE_INDEX}: {e}")
                 raise e
 
-    async def _upsert(self, chunks: Dict[str, List[DocumentChunk]]) -> List[str]:
+    async def _run(self, func, *args, **kwargs):
+        """
+        Runs a blocking index request on the executor without blocking the event loop.
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(
+            self.executor, functools.partial(func, *args, **kwargs)
+        )
+
+    async def health_check(self) -> bool:
+        """
+        Checks the connection to the index with a cheap data plane request.
+        """
+        await self._run(self.index.describe_index_stats)
+        return True
+
+    def is_connection_error(self, error: Exception) -> bool:
+        """
+        Errors of the Pinecone client and of the HTTP connections under it.
         """
-        Takes in a dict from document id to list of document chunks and inserts them into the index.
+        return isinstance(
+            error, (pinecone.PineconeException, urllib3.exceptions.HTTPError, ConnectionError, TimeoutError)
+        )
+
+    def close(self):
+        # Requests that are already running finish, the threads exit afterwards
+        self.executor.shutdown(wait=False)
+
+    async def _upsert(self, chunks: Dict[str, DocumentChunks]) -> List[str]:
+        """
+        Takes in a dict from document id to the chunks of the document and inserts them into the index.
         Return a list of document ids.
         """
         # Initialize a list of ids to return
         doc_ids: List[str] = []
-        # Initialize a list of vectors to upsert
-        vectors = []
+        # Initialize a list of batches to upsert, as (chunks, base metadata, start row, end row)
+        batches = []
         # Loop through the dict items
-        for doc_id, chunk_list in chunks.items():
+        for doc_id, doc_chunks in chunks.items():
             # Append the id to the ids list
             doc_ids.append(doc_id)
             print(f"Upserting document_id: {doc_id}")
-            for chunk in chunk_list:
-                # Create a vector tuple of (id, embedding, metadata)
-                # Convert the metadata object to a dict with unix timestamps for dates
-                pinecone_metadata = self._get_pinecone_metadata(chunk.metadata)
-                # Add the text and document id to the metadata dict
-                pinecone_metadata["text"] = chunk.text
-                pinecone_metadata["document_id"] = doc_id
-                vector = (chunk.id, chunk.embedding, pinecone_metadata)
-                vectors.append(vector)
-
-        # Split the vectors list into batches of the specified size
-        batches = [
-            vectors[i : i + UPSERT_BATCH_SIZE]
-            for i in range(0, len(vectors), UPSERT_BATCH_SIZE)
-        ]
-        # Upsert each batch to Pinecone
-        for batch in batches:
+            # Convert the metadata object to a dict with unix timestamps for dates, once for all chunks
+            pinecone_metadata = self._get_pinecone_metadata(doc_chunks.metadata)
+            pinecone_metadata["document_id"] = doc_id
+            # Split the chunks into batches of the specified size
+            for start in range(0, len(doc_chunks), UPSERT_BATCH_SIZE):
+                batches.append(
+                    (doc_chunks, pinecone_metadata, start, min(start + UPSERT_BATCH_SIZE, len(doc_chunks)))
+                )
+
+        def _send_batch(doc_chunks, pinecone_metadata, start, end):
+            # Create the vector tuples of (id, embedding, metadata) right before sending them, so only the batches in
+            # flight hold their embeddings as lists of Python floats
+            vectors = [
+                (
+                    doc_chunks.ids[row],
+                    doc_chunks.embeddings[row].tolist(),
+                    {
+                        **pinecone_metadata,
+                        "text": doc_chunks.texts[row],
+                        "content_hash": doc_chunks.content_hashes[row],
+                    },
+                )
+                for row in range(start, end)
+            ]
+            self.index.upsert(vectors=vectors)
+
+        # Upsert the batches to Pinecone, up to PINECONE_CONCURRENCY at a time
+        async def _upsert_batch(batch):
             try:
-                print(f"Upserting batch of size {len(batch)}")
-                self.index.upsert(vectors=batch)
+                print(f"Upserting batch of size {batch[3] - batch[2]}")
+                await self._run(_send_batch, *batch)
                 print(f"Upserted batch successfully")
             except Exception as e:
                 print(f"Error upserting batch: {e}")
                 raise e
 
+        await asyncio.gather(*[_upsert_batch(batch) for batch in batches])
+
         return doc_ids
 
     async def _query(
@@ -125,10 +178,11 @@ class PineconeDataStore(DataStore):
 
             try:
                 # Query the index with the query embedding, filter, and top_k
-                query_response = self.index.query(
+                query_response = await self._run(
+                    self.index.query,
                     # namespace=namespace,
                     top_k=query.top_k,
-                    vector=query.embedding,
+                    vector=query.embedding.tolist(),
                     filter=pinecone_filter,
                     include_metadata=True,
                 )
@@ -165,13 +219,68 @@ class PineconeDataStore(DataStore):
                 query_results.append(result)
             return QueryResult(query=query.query, results=query_results)
 
-        # Use asyncio.gather to run multiple _single_query coroutines concurrently and collect their results
+        # Use asyncio.gather to run the queries concurrently on the executor and collect their results
         results: List[QueryResult] = await asyncio.gather(
             *[_single_query(query) for query in queries]
         )
 
         return results
 
+    async def _get_chunk_hashes(
+        self, document_id: str, chunk_ids: List[str]
+    ) -> Optional[Dict[str, str]]:
+        """
+        Fetches the stored chunks of a document by id and returns their content hashes.
+        Chunk ids are sequential, so the chunks that a longer earlier version of the document left behind follow the
+        new ones, and are probed page by page.
+        """
+
+        async def _fetch_hashes(ids: List[str]) -> Dict[str, str]:
+            response = await self._run(self.index.fetch, ids=ids)
+            return {
+                vector_id: (vector.metadata or {}).get("content_hash")
+                for vector_id, vector in response.vectors.items()
+            }
+
+        hashes: Dict[str, str] = {}
+        pages = await asyncio.gather(
+            *[
+                _fetch_hashes(chunk_ids[i : i + FETCH_BATCH_SIZE])
+                for i in range(0, len(chunk_ids), FETCH_BATCH_SIZE)
+            ]
+        )
+        for page in pages:
+            hashes.update(page)
+
+        start = len(chunk_ids)
+        while True:
+            page = await _fetch_hashes(
+                [f"{document_id}_{i}" for i in range(start, start + FETCH_BATCH_SIZE)]
+            )
+            hashes.update(page)
+            if len(page) < FETCH_BATCH_SIZE:
+                break
+            start += FETCH_BATCH_SIZE
+
+        return hashes
+
+    async def _delete_chunks(self, chunk_ids: List[str]):
+        """
+        Removes vectors by chunk id from the index.
+        """
+        try:
+            print(f"Deleting {len(chunk_ids)} stale chunks")
+            await asyncio.gather(
+                *[
+                    self._run(self.index.delete, ids=chunk_ids[i : i + DELETE_BATCH_SIZE])
+                    for i in range(0, len(chunk_ids), DELETE_BATCH_SIZE)
+                ]
+            )
+            print(f"Deleted stale chunks successfully")
+        except Exception as e:
+            print(f"Error deleting stale chunks: {e}")
+            raise e
+
     async def delete(
         self,
         ids: Optional[List[str]] = None,
@@ -185,7 +294,7 @@ class PineconeDataStore(DataStore):
         if delete_all:
             try:
                 print(f"Deleting all vectors from index")
-                self.index.delete(delete_all=True)
+                await self._run(self.index.delete, delete_all=True)
                 print(f"Deleted all vectors successfully")
                 return True
             except Exception as e:
@@ -198,7 +307,7 @@ class PineconeDataStore(DataStore):
         if pinecone_filter != {}:
             try:
                 print(f"Deleting vectors with filter {pinecone_filter}")
-                self.index.delete(filter=pinecone_filter)
+                await self._run(self.index.delete, filter=pinecone_filter)
                 print(f"Deleted vectors with filter successfully")
             except Exception as e:
                 print(f"Error deleting vectors with filter: {e}")
@@ -209,7 +318,7 @@ class PineconeDataStore(DataStore):
             try:
                 print(f"Deleting vectors with ids {ids}")
                 pinecone_filter = {"document_id": {"$in": ids}}
-                self.index.delete(filter=pinecone_filter)  # type: ignore
+                await self._run(self.index.delete, filter=pinecone_filter)  # type: ignore
                 print(f"Deleted vectors with ids successfully")
             except Exception as e:
                 print(f"Error deleting vectors with ids: {e}")
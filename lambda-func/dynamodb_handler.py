@@ -1,10 +1,51 @@
 import os
+import time
 
 users_table = os.environ['USERS_NAME']
 videos_table = os.environ['VIDEOS_NAME']
 
+BATCH_GET_MAX_KEYS = 100  # BatchGetItem limit
+BATCH_GET_MAX_ATTEMPTS = 5
+BATCH_GET_BACKOFF = 0.05  # seconds, doubled on every retry of unprocessed keys
+VIDEOS_PAGE_SIZE = 20
+# Attributes of a video that the bot renders, as ExpressionAttributeNames
+VIDEO_PROJECTION = {'#video_id': 'video_id', '#title': 'title', '#author': 'author', '#url_link': 'url_link'}
 
-def retrieve_user_videos(client, chat_id):
+
+def batch_get_videos(client, video_ids):
+    """Reads video items with BatchGetItem, retrying unprocessed keys. Returns a dict from video_id to item."""
+    items = {}
+    for i in range(0, len(video_ids), BATCH_GET_MAX_KEYS):
+        request_items = {
+            videos_table: {
+                'Keys': [{'video_id': {'S': str(vid_id)}} for vid_id in video_ids[i:i + BATCH_GET_MAX_KEYS]],
+                'ProjectionExpression': ', '.join(VIDEO_PROJECTION),
+                'ExpressionAttributeNames': VIDEO_PROJECTION,
+            }
+        }
+        for attempt in range(BATCH_GET_MAX_ATTEMPTS):
+            resp = client.batch_get_item(RequestItems=request_items)
+            for item in resp['Responses'].get(videos_table, []):
+                vid_info = {}
+                for attr, val_dict in item.items():
+                    vid_info[attr] = list(val_dict.values())[0]
+                items[vid_info['video_id']] = vid_info
+            request_items = resp.get('UnprocessedKeys')
+            if not request_items:
+                break
+            time.sleep(BATCH_GET_BACKOFF * 2 ** attempt)
+        else:
+            print(f'Unprocessed keys left after {BATCH_GET_MAX_ATTEMPTS} attempts: {request_items}')
+    return items
+
+
+def retrieve_user_videos(client, chat_id, page=None, page_size=VIDEOS_PAGE_SIZE):
+    """
+    Returns the videos of the user library in the order they were added.
+
+    The video items are read with BatchGetItem, projected to the rendered fields. With page set, only that page of
+    the library is read, page 0 being the page_size most recently added videos.
+    """
     videos_resp = client.get_item(
         TableName=users_table,
         Key={
@@ -19,19 +60,15 @@ def retrieve_user_videos(client, chat_id):
         videos_list = videos_resp['Item']['videos']
         
     print(videos_list)
-    user_videos = []
-    for vid in videos_list['L']:
-        vid_id = vid['S']
-        vid_info_resp = client.get_item(
-            TableName=videos_table,
-            Key={
-                'video_id': {'S': str(vid_id)},
-            }
-        )
-        vid_info = {}
-        for attr, val_dict in vid_info_resp['Item'].items():
-            vid_info[attr] = list(val_dict.values())[0]
-        user_videos.append(vid_info)
+    video_ids = [vid['S'] for vid in videos_list['L']]
+    if page is not None:
+        end = len(video_ids) - page * page_size
+        video_ids = video_ids[max(end - page_size, 0):max(end, 0)]
+
+    # BatchGetItem rejects duplicate keys
+    video_items = batch_get_videos(client, list(dict.fromkeys(video_ids)))
+
+    user_videos = [video_items[vid_id] for vid_id in video_ids if vid_id in video_items]
         
     return user_videos
     
@@ -73,6 +110,43 @@ def retrieve_user_openai_creds(client, chat_id):
         return openai_key_resp['Item']['openai_key']['S']
 
 
+def retrieve_user_item(client, chat_id):
+    """Returns the openai_key, username and last_seen attributes of a user in one read, or {} for a new user."""
+    user_resp = client.get_item(
+        TableName=users_table,
+        Key={
+            'chat_id': {'N': str(chat_id)},
+        },
+        ProjectionExpression='openai_key, username, last_seen'
+    )
+    user_item = {}
+    for attr, val_dict in user_resp.get('Item', {}).items():
+        user_item[attr] = list(val_dict.values())[0]
+
+    return user_item
+
+
+def touch_user_item(client, chat_id, last_seen, username=None):
+    """Creates the user if needed and records when they were last seen, and their username if given, in one write."""
+    update_expression = "SET last_seen = :t"
+    expression_values = {':t': {'N': str(last_seen)}}
+    if username:
+        update_expression += ", username = :u"
+        expression_values[':u'] = {'S': str(username)}
+    data = client.update_item(
+        TableName=users_table,
+        Key={
+            'chat_id': {'N': str(chat_id)},
+        },
+        UpdateExpression=update_expression,
+        ExpressionAttributeValues=expression_values,
+        ReturnValues="UPDATED_NEW"
+    )
+    print(data)
+
+    return 1
+
+
 def add_video_to_user(client, chat_id, video_id):
     """Adds video_id into videos list if it is not there yet."""
     videos_resp = client.get_item(
@@ -187,6 +261,49 @@ def update_user_item(client, chat_id, **kwargs):
     return 1
 
 
+def retrieve_video_item(client, video_id):
+    """Returns the attributes of a video, including its index registry entry, as a dict, or {} for a new video."""
+    video_resp = client.get_item(
+        TableName=videos_table,
+        Key={
+            'video_id': {'S': str(video_id)},
+        }
+    )
+    video_item = {}
+    for attr, val_dict in video_resp.get('Item', {}).items():
+        video_item[attr] = list(val_dict.values())[0]
+
+    return video_item
+
+
+def is_video_indexed(video_item, chunker_version, embedding_model):
+    """Returns whether a video item records that its chunks are in the index with the given chunker and model."""
+    return (
+        video_item.get('indexed_chunker_version') == chunker_version
+        and video_item.get('indexed_embedding_model') == embedding_model
+    )
+
+
+def mark_video_indexed(client, video_id, chunker_version, embedding_model, indexed_at):
+    """Records in the video item that its chunks were indexed with the given chunker and model, in one write."""
+    data = client.update_item(
+        TableName=videos_table,
+        Key={
+            'video_id': {'S': str(video_id)},
+        },
+        UpdateExpression="SET indexed_chunker_version = :c, indexed_embedding_model = :m, indexed_at = :t",
+        ExpressionAttributeValues={
+            ':c': {'S': str(chunker_version)},
+            ':m': {'S': str(embedding_model)},
+            ':t': {'N': str(indexed_at)},
+        },
+        ReturnValues="UPDATED_NEW"
+    )
+    print(data)
+
+    return 1
+
+
 def update_video_item(client, video_id, **kwargs):
 
     for key, value in kwargs.items():
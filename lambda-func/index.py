@@ -1,40 +1,79 @@
 import json
-import boto3
-import telebot
-from telebot import types, formatting
 import re
-import openai
+import sys
 import asyncio
 import os
+import time
+from lazy_loader import LazyObject, lazy_function, lazy_module, startup_report, timed
+with timed('boto3'):
+    import boto3
+with timed('telebot'):
+    import telebot
+    from telebot import types, formatting, util
 from aws_secretsmanager_caching import SecretCache, SecretCacheConfig
-from youtube_video_handler import generate_transcript, retrieve_metadata
-from user_creds_handler import encrypt_key, decrypt_key
+from user_creds_handler import encrypt_key
+from user_context import get_user_context, user_context_cache
 from s3_storage_handler import upload_file_to_s3, download_file_from_s3
-from dynamodb_handler import update_video_item, update_user_item, add_video_to_user, retrieve_user_openai_creds, retrieve_user_videos, add_note_to_user, retrieve_user_notes
-from summary import generate_summary_pdf
-from chat_utils import ask, upsert
+from artifact_cache import ArtifactCache
+from dynamodb_handler import retrieve_video_item, is_video_indexed, mark_video_indexed, update_video_item, update_user_item, add_video_to_user, retrieve_user_videos, add_note_to_user, retrieve_user_notes
+from job_queue import Job, InProcessJobQueue, get_job_queue, run_worker
+from async_runtime import run, to_thread
+from telegram_stream import StreamingReply, TELEGRAM_MESSAGE_LIMIT
+from rate_limiter import RateLimitExceeded
+from openai_client import CircuitOpenError, report as openai_report
+from services.index_version import get_index_version
 
 
 tg_bot_token_secret_name = os.environ['TG_TOKEN_NM']
 openai_key_secret_name = "OpenAISecretKey"
 region_name = "eu-north-1"
 kms_key_id = 'da85dd30-85cc-4a75-986f-b62fefb4a55b'
+SUMMARY_PROGRESSIVE = os.environ.get('SUMMARY_PROGRESSIVE', 'true').lower() == 'true'  # send summary sections as they are ready
+STREAM_ANSWERS = os.environ.get('STREAM_ANSWERS', 'true').lower() == 'true'  # edit answers into a message as they are generated
 youtube_video_id_regexp = "^.*(?:(?:youtu\.be\/|v\/|vi\/|u\/\w\/|embed\/|shorts\/)|(?:(?:watch)?\?v(?:i)?=|\&v(?:i)?=))([^#\&\?]*).*"
 
 session = boto3.session.Session()  # create a session object
-dynamodb_client = session.client('dynamodb')  # create a client for dynamodb
-secrets_manager_client = session.client('secretsmanager')  # create a client for secrets manager
-kms_client = boto3.client('kms')  # create a client for kms
-s3_client = boto3.client('s3')  # create a client for s3
+with timed('boto3 clients'):
+    dynamodb_client = session.client('dynamodb')  # create a client for dynamodb
+    secrets_manager_client = session.client('secretsmanager')  # create a client for secrets manager
+kms_client = LazyObject('kms client', lambda: boto3.client('kms'))  # create a client for kms on first use
+s3_client = LazyObject('s3 client', lambda: boto3.client('s3'))  # create a client for s3 on first use
+video_artifacts = ArtifactCache(s3_client, 'videos')  # transcripts and summaries of videos
 
 cache_config = SecretCacheConfig()
 cache = SecretCache(config=cache_config, client=secrets_manager_client)
 
-tg_bot_secret = cache.get_secret_string(tg_bot_token_secret_name)
-default_openai_key = cache.get_secret_string(openai_key_secret_name)
+with timed('telegram token'):
+    tg_bot_secret = cache.get_secret_string(tg_bot_token_secret_name)
+default_openai_key = LazyObject('default openai key', lambda: cache.get_secret_string(openai_key_secret_name))
+
+# The OpenAI key of the chat whose update or job is being processed, None for the default key
+current_openai_key = None
+
+
+def apply_openai_key(openai_module):
+    if current_openai_key:
+        openai_module.api_key = current_openai_key
+    else:
+        openai_module.api_key = default_openai_key.load()
+
+
+openai = lazy_module('openai', on_load=apply_openai_key)
+
+# Subsystems that only some commands need are imported on first use
+open_cached_transcript_file = lazy_function('youtube_video_handler', 'open_cached_transcript_file')
+retrieve_metadata = lazy_function('youtube_video_handler', 'retrieve_metadata')
+agenerate_summary_pdf = lazy_function('summary', 'agenerate_summary_pdf', requires=[openai])
+ask = lazy_function('chat_utils', 'ask', requires=[openai])
+ask_stream = lazy_function('chat_utils', 'ask_stream', requires=[openai])
+upsert = lazy_function('chat_utils', 'upsert', requires=[openai])
+parse_video_ids = lazy_function('ingest', 'parse_video_ids')
+ingest_videos = lazy_function('ingest', 'ingest_videos', requires=[openai])
 
 bot = telebot.TeleBot(tg_bot_secret, threaded=False)
 
+job_queue = get_job_queue()
+
 
 def process_event(event):
     try:
@@ -50,36 +89,64 @@ def process_event(event):
             message_type = 'edited_message'
     
         print(request_body_dict)
-        try:
-            if message_type == None:
-                return
-            update_user_item(dynamodb_client, chat_id=request_body_dict[message_type]['chat']['id'], username=request_body_dict[message_type]['chat']['username'])
-        except:
-            update_user_item(dynamodb_client, chat_id=request_body_dict[message_type]['chat']['id'])
-        encrypted_openai_creds = retrieve_user_openai_creds(dynamodb_client, request_body_dict[message_type]['chat']['id'])
-    
-        if encrypted_openai_creds:
-            openai_creds = decrypt_key(kms_client, kms_key_id, encrypted_openai_creds)
-        else:
-            openai_creds = default_openai_key
-        openai.api_key = openai_creds
-    
+        if message_type == None:
+            return
+        chat = request_body_dict[message_type]['chat']
+        user_context = get_user_context(dynamodb_client, kms_client, kms_key_id, chat['id'], username=chat.get('username'))
+
+        set_openai_key(user_context)
+
         # Run handlers and etc for updates
         bot.process_new_updates([update])
     except Exception as e:
         print(e)
 
 
+def set_openai_key(user_context):
+    global current_openai_key
+    current_openai_key = user_context.openai_key
+    # OpenAI is imported by the first command that needs it, which applies the key then
+    if openai.is_loaded:
+        apply_openai_key(openai.load())
+
+
 def handler(event, context):
     print(event)
     # Process event from aws and respond
     process_event(event)
 
+    # Without a queue service the jobs of the update run here, after the handlers
+    if isinstance(job_queue, InProcessJobQueue):
+        run_worker(job_queue, run_job)
+
     return {
         'statusCode': 200
     }
 
 
+def run_job(job):
+    """Runs a job taken from the job queue and reports failures to the chat."""
+    print(f'Running {job}')
+    try:
+        user_context = get_user_context(dynamodb_client, kms_client, kms_key_id, job.chat_id)
+        set_openai_key(user_context)
+        run(JOB_HANDLERS[job.kind](job.chat_id, **job.payload))
+    except RateLimitExceeded as e:
+        print(f"Job {job} failed.\nError: {e}")
+        bot.send_message(job.chat_id, f"Your OpenAI key reached its rate limit, please try again in {e.wait_time:.0f} seconds.")
+    except CircuitOpenError as e:
+        print(f"Job {job} failed.\nError: {e}")
+        bot.send_message(job.chat_id, f"OpenAI is not responding, please try again in {e.retry_in:.0f} seconds.")
+    except Exception as e:
+        print(f"Job {job} failed.\nError: {e}")
+        bot.send_message(job.chat_id, "You broke the bot.")
+    print(video_artifacts.report())
+    print(openai_report())
+    # The embedding cache is only loaded by the jobs that embed texts
+    if 'services.embedding_cache' in sys.modules:
+        print(sys.modules['services.embedding_cache'].embedding_cache.report())
+
+
 # Handle '/start'
 @bot.message_handler(commands=['start'])
 def send_welcome(message):
@@ -107,6 +174,7 @@ Hi there! I'm LectureMate, your helpful bot. Here's how you can make the most ou
 
 📚 Library Commands:
 - /add_video: Add a YouTube video to your library.
+- /add_playlist: Add all videos of a YouTube playlist, or a list of videos, to your library.
 - /add_note: Add a Note to your library.
 - /show_my_library: View the list of videos in your library.
 - /show_my_notes: View the list of notes in your library.
@@ -210,24 +278,88 @@ def process_add_video(message):
         bot.reply_to(message, f"Youtube video link could not be processed.\nError: {e}")
         return
 
-    title, author = retrieve_metadata(video_id)
+    job_queue.enqueue(Job('add_video', message.chat.id, {'video_id': video_id, 'url': url}, job_id=f'add_video_{message.chat.id}_{message.message_id}'))
+    bot.reply_to(message, "Adding the video to your library, I will let you know when it is ready.")
 
-    update_video_item(dynamodb_client, video_id=video_id, title=title, author=author, url_link=url)
-    add_video_to_user(dynamodb_client, message.chat.id, video_id)
 
-    file_path = generate_transcript(video_id)
-    with open(file_path, "r") as file:
+async def run_add_video_job(chat_id, video_id, url):
+    video_item = await to_thread(retrieve_video_item, dynamodb_client, video_id)
+    index_version = get_index_version()
+    if is_video_indexed(video_item, **index_version):
+        # Another user already added the video, only add it to this library
+        print(f'Video {video_id} is already indexed with {index_version}. Skip embedding.')
+        await to_thread(add_video_to_user, dynamodb_client, chat_id, video_id)
+        await to_thread(bot.send_message, chat_id, f"Video \"{video_item.get('title', video_id)}\" added to your library.")
+        return
+
+    # The metadata and the transcript come from different services, fetch them at the same time
+    (title, author), file = await asyncio.gather(
+        to_thread(retrieve_metadata, video_id),
+        to_thread(open_transcript_file, video_id),
+    )
+
+    await asyncio.gather(
+        to_thread(update_video_item, dynamodb_client, video_id=video_id, title=title, author=author, url_link=url),
+        to_thread(add_video_to_user, dynamodb_client, chat_id, video_id),
+    )
+
+    if not file:
+        await to_thread(bot.send_message, chat_id, "Transcript could not be retrieved from provided link.")
+        return
+    with file:
         transcript = file.read()
 
     try:
-        loop_ask = asyncio.get_event_loop()
-        response = loop_ask.run_until_complete(upsert(video_id, transcript))
+        response = await upsert(video_id, transcript)
     except Exception as e:
         print(f"Couldn't connect to database.\nError: {e}")
-        bot.reply_to(message, "You broke the bot.")
+        await to_thread(bot.send_message, chat_id, "You broke the bot.")
         return
+    await to_thread(mark_video_indexed, dynamodb_client, video_id, indexed_at=int(time.time()), **index_version)
+
+    await to_thread(bot.send_message, chat_id, f"Video \"{title}\" added to your library.")
+
+
+# Handle '/add_playlist'
+@bot.message_handler(commands=['add_playlist'])
+def add_playlist(message):
+    bot.reply_to(message, "Please provide a youtube playlist link, or several video links separated by spaces.")
+    bot.register_next_step_handler_by_chat_id(message.chat.id, process_add_playlist)
+
+
+def process_add_playlist(message):
+    if message.text == "/exit":
+        bot.reply_to(message, "You exited the current process, start a new one.")
+        return
+    job_queue.enqueue(Job('add_videos', message.chat.id, {'source': message.text}, job_id=f'add_videos_{message.chat.id}_{message.message_id}'))
+    bot.reply_to(message, "Adding the videos to your library, I will let you know how it goes.")
+
+
+async def run_add_videos_job(chat_id, source):
+    try:
+        video_ids, unknown = await to_thread(parse_video_ids, source)
+    except ValueError as e:
+        # A playlist that cannot be read, e.g. it is private or YouTube answered with a consent page
+        print(e)
+        await to_thread(bot.send_message, chat_id, "Could not read the playlist, please check that it is public and try again later.")
+        return
+    if unknown:
+        await to_thread(bot.send_message, chat_id, f"Skipping what is not a youtube link: {' '.join(unknown)}")
+    if not video_ids:
+        await to_thread(bot.send_message, chat_id, "No videos found.")
+        return
+    await to_thread(bot.send_message, chat_id, f"Importing {len(video_ids)} videos.")
+
+    async def report_progress(progress):
+        await to_thread(bot.send_message, chat_id, progress.summary())
 
-    bot.reply_to(message, "Video added to your library.")
+    # Videos indexed by an earlier run of the job are skipped, so a retried job resumes where it failed
+    progress = await ingest_videos(chat_id, video_ids, dynamodb_client, video_artifacts, on_progress=report_progress)
+    msg = progress.summary()
+    if progress.failed:
+        msg += "\nFailed:\n" + "\n".join(f"{video_id} ({error})" for video_id, error in progress.failed)
+    for part in util.smart_split(msg, TELEGRAM_MESSAGE_LIMIT):
+        await to_thread(bot.send_message, chat_id, part)
 
 
 # Handle '/provide_openai_key'
@@ -249,6 +381,7 @@ def register_openai_user_key(message):
         return
     encrypted_openai_key = encrypt_key(kms_client, kms_key_id, message.text)
     update_user_item(dynamodb_client, chat_id=message.chat.id, openai_key=encrypted_openai_key)
+    user_context_cache.invalidate(message.chat.id)
     bot.reply_to(message, "Your OpenAI key saved.")
 
 
@@ -294,29 +427,34 @@ def process_transcript(message):
     except Exception as e:
         bot.reply_to(message, f"Video could not be processed.\nError: {e}")
         return
-    title, author = retrieve_metadata(video_id)
+    markup = types.ReplyKeyboardRemove(selective=False)
+    job_queue.enqueue(Job('transcript', message.chat.id, {'video_id': video_id}, job_id=f'transcript_{message.chat.id}_{message.message_id}'))
+    bot.send_message(message.chat.id, "Preparing the transcript, I will send it when it is ready.", reply_markup=markup)
 
-    try:
-        file_path = download_file_from_s3(s3_client, video_id, f'transcript_{video_id}.txt', 'videos')
-        print(f'File transcript_{video_id}.txt found in bucket. Skip generating.')
-    except Exception as e:
-        print(e)
-        print(f'No file transcript_{video_id}.txt found in bucket. Start generating.')
-        transcript_result = generate_transcript(video_id)
-        if not transcript_result:
-            print(f"Transcript could not be retrieved from provided link.")
-            return
-        else:
-            file_path = transcript_result
-        upload_file_to_s3(s3_client, file_path, video_id, 'videos')
 
-    doc = open(file_path, 'rb')
-    markup = types.ReplyKeyboardRemove(selective=False)
+def open_transcript_file(video_id, mode='r'):
+    """
+    Opens the plain text transcript of a video, downloading it from the bucket or generating it.
+    A generated transcript is uploaded both as structured .jsonl and as .txt. Returns None if there is no transcript.
+    """
+    return open_cached_transcript_file(video_artifacts, video_id, mode)
+
+
+async def run_transcript_job(chat_id, video_id):
+    (title, author), doc = await asyncio.gather(
+        to_thread(retrieve_metadata, video_id),
+        to_thread(open_transcript_file, video_id, 'rb'),
+    )
+    if not doc:
+        await to_thread(bot.send_message, chat_id, "Transcript could not be retrieved from provided link.")
+        return
+
     title_esc = formatting.escape_markdown(title)
     author_esc = formatting.escape_markdown(author)
     msg = f"\"{title_esc}\" by {author_esc}\n*Video transcript:*"
-    bot.send_message(message.chat.id, msg, reply_markup=markup, parse_mode='MarkdownV2')
-    bot.send_document(message.chat.id, doc)
+    await to_thread(bot.send_message, chat_id, msg, parse_mode='MarkdownV2')
+    with doc:
+        await to_thread(bot.send_document, chat_id, doc)
 
 
 # Handle '/get_summary'
@@ -337,41 +475,69 @@ def process_summarization(message):
         bot.reply_to(message, f"Youtube video link could not be processed.\nError: {e}")
         return
 
-    title, author = retrieve_metadata(video_id)
+    markup = types.ReplyKeyboardRemove(selective=False)
+    job_queue.enqueue(Job('summary', message.chat.id, {'video_id': video_id}, job_id=f'summary_{message.chat.id}_{message.message_id}'))
+    bot.send_message(message.chat.id, "Summarization may take some time, please bear with us.", reply_markup=markup)
+
+
+async def open_summary_file(video_id, on_section=None):
+    """
+    Opens the summary PDF of a video, from the artifact cache or generated. None if there is no transcript.
+    While a summary is generated, its markdown sections are passed to the on_section(i, section) coroutine in order.
+    """
+    file_name = f'summary_{video_id}.pdf'
+    pdf = await to_thread(video_artifacts.open_file, video_id, file_name)
+    if pdf:
+        print(f'File {file_name} found in cache. Skip generating.')
+        return pdf
+    print(f'No file {file_name} found in cache. Start generating.')
+
+    file = await to_thread(open_transcript_file, video_id)
+    if not file:
+        return
 
-    try:
-        pdf_path = download_file_from_s3(s3_client, video_id, f'summary_{video_id}.pdf', 'videos')
-        print(f'File summary_{video_id}.pdf found in bucket. Skip generating.')
-    except Exception as e:
-        print(f'No file summary_{video_id}.pdf found in bucket. Start generating.')
+    print('START PDF SUMMARY')
+    with file:
+        transcript = file.read()
+    pdf_path = await agenerate_summary_pdf(transcript, video_id, on_section=on_section)
+    await to_thread(video_artifacts.put_file, video_id, pdf_path)
+    return await to_thread(video_artifacts.open_file, video_id, file_name)
+
+
+async def run_summary_job(chat_id, video_id):
+    metadata = asyncio.ensure_future(to_thread(retrieve_metadata, video_id))
+    header_sent = False
+
+    async def send_header():
+        nonlocal header_sent
+        title, author = await metadata
+        title_esc = formatting.escape_markdown(title)
+        author_esc = formatting.escape_markdown(author)
+        msg = f"\"{title_esc}\" by {author_esc}\n*Video summary:*"
+        await to_thread(bot.send_message, chat_id, msg, parse_mode='MarkdownV2')
+        header_sent = True
+
+    async def send_section(i, section):
+        # Each section goes to the chat as soon as it is ready, the PDF with all of them follows at the end.
+        # A section that cannot be sent is skipped, the PDF still has it.
         try:
-            file_path = download_file_from_s3(s3_client, video_id, f'transcript_{video_id}.txt', 'videos')
+            if not header_sent:
+                await send_header()
+            for part in util.smart_split(section, TELEGRAM_MESSAGE_LIMIT):
+                await to_thread(bot.send_message, chat_id, part)
         except Exception as e:
-            print(e)
-            print(f'No file transcript_{video_id}.txt found in bucket. Start generating.')
-            transcript_result = generate_transcript(video_id)
-            if not transcript_result:
-                print(f"Transcript could not be retrieved from provided link.")
-                return
-            else:
-                file_path = transcript_result
-            upload_file_to_s3(s3_client, file_path, video_id, 'videos')
-
-        print('START PDF SUMMARY')
-        markup = types.ReplyKeyboardRemove(selective=False)
-        bot.send_message(message.chat.id, f"Summarization may take some time, please bear with us.", reply_markup=markup)
-        with open(file_path, "r") as file:
-            transcript = file.read()
-        pdf_path = generate_summary_pdf(transcript, video_id)
-        upload_file_to_s3(s3_client, pdf_path, video_id, 'videos')
-
-    doc = open(pdf_path, 'rb')
-    markup = types.ReplyKeyboardRemove(selective=False)
-    title_esc = formatting.escape_markdown(title)
-    author_esc = formatting.escape_markdown(author)
-    msg = f"\"{title_esc}\" by {author_esc}\n*Video summary:*"
-    bot.send_message(message.chat.id, msg, reply_markup=markup, parse_mode='MarkdownV2')
-    bot.send_document(message.chat.id, doc)
+            print(f"Could not send summary section {i} of {video_id}.\nError: {e}")
+
+    doc = await open_summary_file(video_id, on_section=send_section if SUMMARY_PROGRESSIVE else None)
+    if not doc:
+        metadata.cancel()
+        await to_thread(bot.send_message, chat_id, "Transcript could not be retrieved from provided link.")
+        return
+
+    if not header_sent:
+        await send_header()
+    with doc:
+        await to_thread(bot.send_document, chat_id, doc)
 
 
 # Handle '/start_chat'
@@ -397,16 +563,41 @@ def process_lecture_for_question(message):
     bot.register_next_step_handler_by_chat_id(message.chat.id, process_question, video_id=video_id)
 
 
+async def stream_answer(message, video_id):
+    """Replies to a question with a placeholder that is edited as the answer is generated."""
+    reply = StreamingReply(bot, message.chat.id, reply_to_message_id=message.message_id)
+    await reply.start()
+    try:
+        async for delta in ask_stream(message.text, video_id):
+            await reply.feed(delta)
+    except Exception as e:
+        await reply.fail()
+        raise e
+    await reply.finish()
+
+
 def process_question(message, **kwargs):
     if message.text == "/exit":
         bot.reply_to(message, "You exited the current process, start a new one.")
         return
     for key, value in kwargs.items():
         try:
-            loop_ask = asyncio.get_event_loop()
-            response = loop_ask.run_until_complete(ask(message.text, value))
-            bot.reply_to(message, response)
+            if STREAM_ANSWERS:
+                run(stream_answer(message, value))
+            else:
+                response = run(ask(message.text, value))
+                bot.reply_to(message, response)
+            bot.register_next_step_handler_by_chat_id(message.chat.id, process_question, **kwargs)
+        except RateLimitExceeded as e:
+            print(e)
+            bot.reply_to(message, f"Your OpenAI key reached its rate limit, please ask again in {e.wait_time:.0f} seconds.")
+            bot.register_next_step_handler_by_chat_id(message.chat.id, process_question, **kwargs)
+            return
+        except CircuitOpenError as e:
+            print(e)
+            bot.reply_to(message, f"OpenAI is not responding, please ask again in {e.retry_in:.0f} seconds.")
             bot.register_next_step_handler_by_chat_id(message.chat.id, process_question, **kwargs)
+            return
         except Exception as e:
             print(f"Couldn't connect to database.\nError: {e}")
             bot.reply_to(message, "You broke the bot.")
@@ -447,3 +638,13 @@ def exit(message):
 #@bot.message_handler(func=lambda message: True, content_types=['text'])
 #def default_command(message):
 #    bot.reply_to(message, "Please use the commands from the menu.")
+
+
+JOB_HANDLERS = {
+    'add_video': run_add_video_job,
+    'add_videos': run_add_videos_job,
+    'transcript': run_transcript_job,
+    'summary': run_summary_job,
+}
+
+print(startup_report())
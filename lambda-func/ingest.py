@@ -0,0 +1,293 @@
+import asyncio
+import os
+import re
+import time
+from urllib.parse import parse_qs, urlparse
+
+from async_runtime import to_thread
+
+INGEST_QUEUE_SIZE = int(os.environ.get('INGEST_QUEUE_SIZE', '4'))  # videos waiting between two stages
+# Videos of one bulk import. A playlist yields at most its first 100 videos unless YOUTUBE_API_KEY is set
+INGEST_MAX_VIDEOS = int(os.environ.get('INGEST_MAX_VIDEOS', '100'))
+INGEST_PROGRESS_INTERVAL = float(os.environ.get('INGEST_PROGRESS_INTERVAL', '15'))  # seconds between progress reports
+# Videos processed at a time by each stage, in pipeline order
+INGEST_CONCURRENCY = {
+    'metadata': int(os.environ.get('INGEST_METADATA_CONCURRENCY', '8')),
+    'transcript': int(os.environ.get('INGEST_TRANSCRIPT_CONCURRENCY', '8')),
+    'chunk': int(os.environ.get('INGEST_CHUNK_CONCURRENCY', '2')),
+    'embed': int(os.environ.get('INGEST_EMBED_CONCURRENCY', '4')),
+    'upsert': int(os.environ.get('INGEST_UPSERT_CONCURRENCY', '4')),
+}
+
+VIDEO_ID_RE = re.compile(r'^[\w-]{11}$')
+VIDEO_URL_RE = re.compile(r'(?:youtu\.be/|/v/|/vi/|/embed/|/shorts/|[?&]vi?=)([\w-]{11})')
+CHANNEL_URL_RE = re.compile(r'youtube\.com/channel/UC([\w-]{22})')
+
+
+class IngestItem:
+    """A video on its way through the ingestion pipeline."""
+
+    def __init__(self, video_id):
+        self.video_id = video_id
+        self.title = None
+        self.author = None
+        self.transcript_file = None  # the open transcript, read and closed by the chunk stage
+        self.chunks = None  # document id -> DocumentChunks, embedded by the embed stage
+        self.status = 'pending'  # pending, done, skipped or failed
+        self.error = None
+
+    def __repr__(self):
+        return f'IngestItem({self.video_id}, {self.status})'
+
+
+class IngestProgress:
+    """Counts the videos of a bulk import by outcome."""
+
+    def __init__(self, total):
+        self.total = total
+        self.done = []
+        self.skipped = []
+        self.failed = []  # (video_id, error)
+        self.started_at = time.monotonic()
+
+    @property
+    def finished(self):
+        return len(self.done) + len(self.skipped) + len(self.failed)
+
+    def add(self, item):
+        if item.status == 'failed':
+            self.failed.append((item.video_id, item.error))
+        elif item.status == 'skipped':
+            self.skipped.append(item.video_id)
+        else:
+            self.done.append(item.video_id)
+
+    def summary(self):
+        elapsed = time.monotonic() - self.started_at
+        return (
+            f'{self.finished}/{self.total} videos processed in {elapsed:.0f}s: {len(self.done)} imported, '
+            f'{len(self.skipped)} already in the index, {len(self.failed)} failed'
+        )
+
+
+class IngestPipeline:
+    """
+    Runs videos through stages, each with its own workers, connected by bounded queues.
+
+    A stage is a coroutine taking an IngestItem that returns True to pass the item on to the next stage, or False if
+    the item is finished, e.g. because it was already imported. An exception fails the item, not the pipeline. Full
+    queues make the earlier stages wait, so at most INGEST_QUEUE_SIZE videos are held between two stages.
+    """
+
+    def __init__(self, stages, concurrency=INGEST_CONCURRENCY, queue_size=INGEST_QUEUE_SIZE, on_progress=None,
+                 progress_interval=INGEST_PROGRESS_INTERVAL):
+        self.stages = stages  # stage name -> coroutine function, in pipeline order
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.on_progress = on_progress
+        self.progress_interval = progress_interval
+
+    async def run(self, video_ids):
+        progress = IngestProgress(len(video_ids))
+        names = list(self.stages)
+        queues = [asyncio.Queue(maxsize=self.queue_size) for _ in names]
+        last_report = time.monotonic()
+
+        async def finish(item):
+            nonlocal last_report
+            progress.add(item)
+            if item.status == 'failed':
+                print(f'Ingesting {item.video_id} failed: {item.error}')
+            if self.on_progress is not None and time.monotonic() - last_report >= self.progress_interval:
+                last_report = time.monotonic()
+                try:
+                    await self.on_progress(progress)
+                except Exception as e:
+                    # A failed report must not stop the worker, the queues would never drain
+                    print(f'Progress report failed: {e}')
+
+        async def worker(i):
+            stage = self.stages[names[i]]
+            while True:
+                item = await queues[i].get()
+                try:
+                    proceed = await stage(item)
+                except Exception as e:
+                    item.status, item.error = 'failed', f'{names[i]}: {e}'
+                    proceed = False
+                if proceed and i + 1 < len(names):
+                    await queues[i + 1].put(item)
+                else:
+                    if proceed:
+                        item.status = 'done'
+                    elif item.status == 'pending':
+                        item.status = 'skipped'
+                    item.chunks = None
+                    await finish(item)
+                queues[i].task_done()
+
+        workers = [
+            asyncio.ensure_future(worker(i))
+            for i, name in enumerate(names)
+            for _ in range(self.concurrency.get(name, 1))
+        ]
+        try:
+            for video_id in video_ids:
+                await queues[0].put(IngestItem(video_id))
+            # Every item a stage finished is in the queue of the next stage, so the stages drain in order
+            for queue in queues:
+                await queue.join()
+        finally:
+            for task in workers:
+                task.cancel()
+        return progress
+
+
+def parse_video_ids(text, max_videos=INGEST_MAX_VIDEOS):
+    """
+    Returns the video ids of a message with playlist links, channel links, video links or video ids, separated by
+    spaces, commas or new lines, in order and without duplicates, and the parts that are none of these.
+    A video link that also names a playlist stands for the playlist. A channel stands for its uploads playlist.
+    Raises PlaylistUnavailableError if a playlist cannot be read.
+    """
+    from youtube_video_handler import retrieve_playlist_video_ids
+
+    video_ids = []
+    unknown = []
+    for token in re.split(r'[\s,]+', text.strip()):
+        if not token:
+            continue
+        playlist_id = parse_qs(urlparse(token).query).get('list', [None])[0]
+        channel = CHANNEL_URL_RE.search(token)
+        video = VIDEO_URL_RE.search(token)
+        if playlist_id:
+            video_ids.extend(retrieve_playlist_video_ids(playlist_id, max_videos))
+        elif channel:
+            video_ids.extend(retrieve_playlist_video_ids('UU' + channel.group(1), max_videos))
+        elif video:
+            video_ids.append(video.group(1))
+        elif VIDEO_ID_RE.match(token):
+            video_ids.append(token)
+        else:
+            unknown.append(token)
+    return list(dict.fromkeys(video_ids))[:max_videos], unknown
+
+
+def create_video_stages(chat_id, dynamodb_client, artifacts):
+    """
+    The stages that add videos to the index and to the library of a chat: metadata, transcript, chunk, embed and
+    upsert. Videos already indexed with the current chunker and embedding model are only added to the library, which
+    makes a bulk import that is run again resume after the videos it finished.
+    """
+    from datastore.factory import get_shared_datastore, invalidate_shared_datastore
+    from dynamodb_handler import add_video_to_user, is_video_indexed, mark_video_indexed, retrieve_video_item, update_video_item
+    from models.models import Document
+    from services.chunks import create_chunks, embed_chunks
+    from services.index_version import get_index_version
+    from youtube_video_handler import open_cached_transcript_file, retrieve_metadata
+
+    index_version = get_index_version()
+    # The library of a chat is one list, add the videos one at a time
+    library_lock = asyncio.Lock()
+
+    async def add_to_library(video_id):
+        async with library_lock:
+            await to_thread(add_video_to_user, dynamodb_client, chat_id, video_id)
+
+    async def metadata(item):
+        video_item = await to_thread(retrieve_video_item, dynamodb_client, item.video_id)
+        if is_video_indexed(video_item, **index_version):
+            item.status = 'skipped'
+            await add_to_library(item.video_id)
+            return False
+        item.title, item.author = await to_thread(retrieve_metadata, item.video_id)
+        url = f'https://www.youtube.com/watch?v={item.video_id}'
+        await to_thread(
+            update_video_item, dynamodb_client, video_id=item.video_id, title=item.title, author=item.author, url_link=url
+        )
+        return True
+
+    async def transcript(item):
+        # The file is opened here, the disk tier of the cache may evict it before the chunk stage reads it
+        item.transcript_file = await to_thread(open_cached_transcript_file, artifacts, item.video_id)
+        if not item.transcript_file:
+            raise ValueError('the video has no transcript')
+        return True
+
+    async def chunk(item):
+        def _create_chunks():
+            with item.transcript_file as file:
+                return create_chunks([Document(id=item.video_id, text=file.read())], None)
+
+        item.chunks = await to_thread(_create_chunks)
+        if not sum(len(doc_chunks) for doc_chunks in item.chunks.values()):
+            raise ValueError('the transcript is empty')
+        return True
+
+    async def embed(item):
+        await embed_chunks(item.chunks)
+        return True
+
+    async def upsert(item):
+        datastore = await get_shared_datastore()
+        try:
+            await datastore.upsert_chunks(item.chunks)
+        except Exception as e:
+            invalidate_shared_datastore(e)
+            raise e
+        await to_thread(
+            mark_video_indexed, dynamodb_client, item.video_id, indexed_at=int(time.time()), **index_version
+        )
+        await add_to_library(item.video_id)
+        return True
+
+    return {'metadata': metadata, 'transcript': transcript, 'chunk': chunk, 'embed': embed, 'upsert': upsert}
+
+
+async def ingest_videos(chat_id, video_ids, dynamodb_client, artifacts, on_progress=None):
+    """Adds videos to the index and to the library of a chat through the staged pipeline. Returns the progress."""
+    stages = create_video_stages(chat_id, dynamodb_client, artifacts)
+    progress = await IngestPipeline(stages, on_progress=on_progress).run(video_ids)
+    print(progress.summary())
+    return progress
+
+
+def main():
+    """
+    Imports a playlist or videos from the command line, e.g.
+
+        python ingest.py --chat-id 123 "https://www.youtube.com/playlist?list=PL..."
+
+    It needs the environment of the bot functions, e.g. USERS_NAME, VIDEOS_NAME, BUCKET_NAME and the datastore
+    settings, and OPENAI_API_KEY. Run it again to resume an import that failed.
+    """
+    import argparse
+
+    import boto3
+
+    from artifact_cache import ArtifactCache
+    from async_runtime import run
+
+    parser = argparse.ArgumentParser(description='Bulk import YouTube videos into the index and a library.')
+    parser.add_argument('sources', nargs='+', help='playlist, channel or video links, or video ids')
+    parser.add_argument('--chat-id', type=int, required=True, help='the chat whose library gets the videos')
+    parser.add_argument('--max-videos', type=int, default=INGEST_MAX_VIDEOS)
+    args = parser.parse_args()
+
+    video_ids, unknown = parse_video_ids(' '.join(args.sources), args.max_videos)
+    if unknown:
+        print(f'Not a video, playlist or channel: {", ".join(unknown)}')
+    print(f'Importing {len(video_ids)} videos')
+
+    async def report(progress):
+        print(progress.summary())
+
+    progress = run(ingest_videos(
+        args.chat_id, video_ids, boto3.client('dynamodb'), ArtifactCache(boto3.client('s3'), 'videos'), report
+    ))
+    for video_id, error in progress.failed:
+        print(f'{video_id} failed: {error}')
+
+
+if __name__ == '__main__':
+    main()
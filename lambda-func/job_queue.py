@@ -0,0 +1,164 @@
+import json
+import os
+import sqlite3
+import time
+import uuid
+from abc import ABC, abstractmethod
+from collections import deque
+
+JOB_QUEUE = os.environ.get('JOB_QUEUE', 'inprocess')  # inprocess, sqlite or sqs
+JOB_QUEUE_URL = os.environ.get('JOB_QUEUE_URL')  # SQS queue url
+JOB_QUEUE_PATH = os.environ.get('JOB_QUEUE_PATH', '/tmp/jobs.sqlite3')  # SQLite queue file
+WORKER_POLL_INTERVAL = 1  # seconds between polls of an empty queue
+
+
+class Job:
+    """A long running command for a chat, e.g. fetching a transcript or generating a summary."""
+
+    def __init__(self, kind, chat_id, payload=None, job_id=None):
+        self.kind = kind
+        self.chat_id = chat_id
+        self.payload = payload or {}
+        self.job_id = job_id or str(uuid.uuid4())
+        self.receipt = None  # set by the queue a job was received from, used to acknowledge it
+
+    def to_json(self):
+        return json.dumps({'job_id': self.job_id, 'kind': self.kind, 'chat_id': self.chat_id, 'payload': self.payload})
+
+    @classmethod
+    def from_json(cls, body):
+        job_dict = json.loads(body)
+        return cls(job_dict['kind'], job_dict['chat_id'], job_dict['payload'], job_dict['job_id'])
+
+    def __repr__(self):
+        return f'Job({self.kind}, chat_id={self.chat_id}, job_id={self.job_id})'
+
+
+class JobQueue(ABC):
+    @abstractmethod
+    def enqueue(self, job):
+        """Adds a job to the queue. A job id that is already queued is ignored."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def receive(self, max_jobs=1):
+        """Returns up to max_jobs jobs that are not being processed by another worker."""
+        raise NotImplementedError
+
+    @abstractmethod
+    def ack(self, job):
+        """Removes a processed job from the queue."""
+        raise NotImplementedError
+
+
+class InProcessJobQueue(JobQueue):
+    """Keeps jobs in memory. The process that enqueued them has to run them, see run_worker."""
+
+    def __init__(self):
+        self.jobs = deque()
+        self.job_ids = set()
+
+    def enqueue(self, job):
+        if job.job_id in self.job_ids:
+            return
+        self.job_ids.add(job.job_id)
+        self.jobs.append(job)
+
+    def receive(self, max_jobs=1):
+        jobs = []
+        while self.jobs and len(jobs) < max_jobs:
+            jobs.append(self.jobs.popleft())
+        return jobs
+
+    def ack(self, job):
+        self.job_ids.discard(job.job_id)
+
+
+class SQLiteJobQueue(JobQueue):
+    """Keeps jobs in a SQLite file, so a worker in another process can run them locally."""
+
+    def __init__(self, path=JOB_QUEUE_PATH):
+        self.connection = sqlite3.connect(path, isolation_level=None)
+        self.connection.execute(
+            'CREATE TABLE IF NOT EXISTS jobs (job_id TEXT PRIMARY KEY, body TEXT, taken INTEGER DEFAULT 0, enqueued_at REAL)'
+        )
+
+    def enqueue(self, job):
+        self.connection.execute(
+            'INSERT OR IGNORE INTO jobs (job_id, body, enqueued_at) VALUES (?, ?, ?)',
+            (job.job_id, job.to_json(), time.time()),
+        )
+
+    def receive(self, max_jobs=1):
+        # Take the jobs in one write transaction, so two workers never take the same job
+        self.connection.execute('BEGIN IMMEDIATE')
+        try:
+            rows = self.connection.execute(
+                'SELECT job_id, body FROM jobs WHERE taken = 0 ORDER BY enqueued_at LIMIT ?', (max_jobs,)
+            ).fetchall()
+            self.connection.executemany('UPDATE jobs SET taken = 1 WHERE job_id = ?', [(job_id,) for job_id, _ in rows])
+            self.connection.execute('COMMIT')
+        except Exception as e:
+            self.connection.execute('ROLLBACK')
+            raise e
+        return [Job.from_json(body) for _, body in rows]
+
+    def ack(self, job):
+        self.connection.execute('DELETE FROM jobs WHERE job_id = ?', (job.job_id,))
+
+
+class SQSJobQueue(JobQueue):
+    """Sends jobs to an SQS queue, which triggers the worker Lambda function."""
+
+    def __init__(self, queue_url=JOB_QUEUE_URL, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client('sqs')
+        self.client = client
+        self.queue_url = queue_url
+
+    def enqueue(self, job):
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=job.to_json())
+        print(f'{job} sent to queue {self.queue_url}')
+
+    def receive(self, max_jobs=1):
+        resp = self.client.receive_message(
+            QueueUrl=self.queue_url, MaxNumberOfMessages=min(max_jobs, 10), WaitTimeSeconds=WORKER_POLL_INTERVAL
+        )
+        jobs = []
+        for message in resp.get('Messages', []):
+            job = Job.from_json(message['Body'])
+            job.receipt = message['ReceiptHandle']
+            jobs.append(job)
+        return jobs
+
+    def ack(self, job):
+        self.client.delete_message(QueueUrl=self.queue_url, ReceiptHandle=job.receipt)
+
+
+def get_job_queue():
+    if JOB_QUEUE == 'inprocess':
+        return InProcessJobQueue()
+    elif JOB_QUEUE == 'sqlite':
+        return SQLiteJobQueue()
+    elif JOB_QUEUE == 'sqs':
+        return SQSJobQueue()
+    else:
+        raise ValueError(f'Unsupported job queue: {JOB_QUEUE}')
+
+
+def run_worker(queue, run_job, wait=False):
+    """
+    Runs the jobs of a queue one after another with run_job, acknowledging each one once it finished.
+    Returns when the queue is empty, or keeps polling it if wait is set.
+    """
+    while True:
+        jobs = queue.receive()
+        if not jobs:
+            if not wait:
+                return
+            time.sleep(WORKER_POLL_INTERVAL)
+            continue
+        for job in jobs:
+            run_job(job)
+            queue.ack(job)
@@ -0,0 +1,83 @@
+import importlib
+import time
+from contextlib import contextmanager
+
+# Seconds spent loading each subsystem in this container, in load order
+import_timings = {}
+
+_NOT_LOADED = object()
+_lazy_modules = {}
+
+
+@contextmanager
+def timed(name):
+    """Records how long the enclosed block takes under name in import_timings."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        import_timings[name] = time.perf_counter() - start
+
+
+def startup_report():
+    """Returns the load timings recorded so far, slowest first."""
+    lines = [f'  {name}: {seconds * 1000:.0f} ms' for name, seconds in sorted(import_timings.items(), key=lambda item: -item[1])]
+    total = sum(import_timings.values())
+    return f'Startup time {total * 1000:.0f} ms:\n' + '\n'.join(lines)
+
+
+class LazyObject:
+    """
+    Stands in for an object that is expensive to create, e.g. a module or a client, and creates it on first use.
+
+    The objects in requires are loaded first, and on_load is called with the object once it is created.
+    """
+
+    def __init__(self, name, factory, on_load=None, requires=()):
+        object.__setattr__(self, '_name', name)
+        object.__setattr__(self, '_factory', factory)
+        object.__setattr__(self, '_on_load', on_load)
+        object.__setattr__(self, '_requires', requires)
+        object.__setattr__(self, '_value', _NOT_LOADED)
+
+    @property
+    def is_loaded(self):
+        return self._value is not _NOT_LOADED
+
+    def load(self):
+        if self._value is _NOT_LOADED:
+            for required in self._requires:
+                required.load()
+            with timed(self._name):
+                value = self._factory()
+            object.__setattr__(self, '_value', value)
+            print(f'Loaded {self._name} in {import_timings[self._name] * 1000:.0f} ms')
+            if self._on_load is not None:
+                self._on_load(value)
+        return self._value
+
+    def __getattr__(self, attr):
+        return getattr(self.load(), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self.load(), attr, value)
+
+
+def lazy_module(name, on_load=None, requires=()):
+    """Returns a stand-in for a module that imports it on first attribute access."""
+    if name not in _lazy_modules:
+        _lazy_modules[name] = LazyObject(name, lambda: importlib.import_module(name), on_load, requires)
+    return _lazy_modules[name]
+
+
+def lazy_function(module_name, function_name, requires=()):
+    """Returns a function that imports its module on the first call and then calls module.function_name."""
+    module = lazy_module(module_name, requires=requires)
+
+    def _call(*args, **kwargs):
+        return getattr(module.load(), function_name)(*args, **kwargs)
+
+    _call.__name__ = function_name
+    _call.__qualname__ = function_name
+    _call.__module__ = module_name
+    return _call
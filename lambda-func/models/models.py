@@ -57,10 +57,6 @@ class Query(BaseModel):
     top_k: Optional[int] = 3
 
 
-class QueryWithEmbedding(Query):
-    embedding: List[float]
-
-
 class QueryResult(BaseModel):
     query: str
     results: List[DocumentChunkWithScore]
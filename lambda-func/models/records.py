@@ -0,0 +1,70 @@
+from typing import List, Optional, Sequence
+
+import numpy as np
+
+from models.models import DocumentChunkMetadata, DocumentMetadataFilter
+
+# The pydantic models in models.models are used where data enters or leaves the datastore. Between chunking,
+# embedding and the vector database, chunks and queries are held in these records instead, which keep embeddings in
+# float32 arrays rather than lists of boxed Python floats.
+
+
+class DocumentChunks:
+    """
+    The chunks of one document, as columns: chunk ids, texts and content hashes, the metadata that all chunks of the
+    document share, and their embeddings as one float32 matrix with a row per chunk (None until embedded).
+    """
+
+    __slots__ = ("document_id", "ids", "texts", "content_hashes", "metadata", "embeddings")
+
+    def __init__(
+        self,
+        document_id: str,
+        ids: List[str],
+        texts: List[str],
+        content_hashes: List[str],
+        metadata: DocumentChunkMetadata,
+        embeddings: Optional[np.ndarray] = None,
+    ):
+        self.document_id = document_id
+        self.ids = ids
+        self.texts = texts
+        self.content_hashes = content_hashes
+        self.metadata = metadata
+        self.embeddings = embeddings
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def select(self, rows: Sequence[int]) -> "DocumentChunks":
+        """
+        Return the chunks at the given rows, e.g. the ones that changed since the document was last stored.
+        """
+        return DocumentChunks(
+            self.document_id,
+            [self.ids[row] for row in rows],
+            [self.texts[row] for row in rows],
+            [self.content_hashes[row] for row in rows],
+            self.metadata,
+            self.embeddings[list(rows)] if self.embeddings is not None else None,
+        )
+
+
+class QueryWithEmbedding:
+    """
+    A query hydrated with the float32 embedding of its text.
+    """
+
+    __slots__ = ("query", "filter", "top_k", "embedding")
+
+    def __init__(
+        self,
+        query: str,
+        embedding: np.ndarray,
+        filter: Optional[DocumentMetadataFilter] = None,
+        top_k: Optional[int] = 3,
+    ):
+        self.query = query
+        self.filter = filter
+        self.top_k = top_k
+        self.embedding = np.asarray(embedding, dtype=np.float32)
@@ -0,0 +1,280 @@
+import asyncio
+import email.utils
+import os
+import random
+import threading
+import time
+from collections import Counter
+
+from rate_limiter import get_rate_limiter, key_hash
+
+OPENAI_MAX_RETRIES = int(os.environ.get('OPENAI_MAX_RETRIES', '4'))  # retries of a failed call
+OPENAI_BACKOFF_BASE = float(os.environ.get('OPENAI_BACKOFF_BASE', '1.0'))  # seconds, doubled on every retry
+OPENAI_BACKOFF_MAX = float(os.environ.get('OPENAI_BACKOFF_MAX', '30'))  # seconds of the longest wait before a retry
+OPENAI_BREAKER_FAILURES = int(os.environ.get('OPENAI_BREAKER_FAILURES', '5'))  # failures in a row that open a circuit
+OPENAI_BREAKER_RESET = float(os.environ.get('OPENAI_BREAKER_RESET', '30'))  # seconds an open circuit rejects calls
+OPENAI_HEDGE_AFTER = float(os.environ.get('OPENAI_HEDGE_AFTER', '0'))  # seconds before a hedged chat call, 0 is off
+
+# Server side failures, worth retrying. Client errors like an invalid request or key fail at once.
+RETRYABLE_ERRORS = ('RateLimitError', 'APIError', 'ServiceUnavailableError', 'Timeout', 'APIConnectionError', 'TryAgain')
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit breaker is open."""
+
+    def __init__(self, endpoint, retry_in):
+        super().__init__(f'OpenAI {endpoint} is failing, calls are paused for {retry_in:.0f}s')
+        self.endpoint = endpoint
+        self.retry_in = retry_in
+
+
+class CircuitBreaker:
+    """
+    Stops calling an endpoint with an API key after `failure_threshold` retryable failures in a row, for
+    `reset_timeout` seconds.
+    Then one trial call is let through: its success closes the circuit again, its failure opens it for another
+    `reset_timeout`.
+    """
+
+    def __init__(self, endpoint, failure_threshold=OPENAI_BREAKER_FAILURES, reset_timeout=OPENAI_BREAKER_RESET):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        """Raises CircuitOpenError if the circuit is open. Returns whether the call is the trial of a half-open circuit."""
+        with self.lock:
+            if self.opened_at is None:
+                return False
+            retry_in = self.opened_at + self.reset_timeout - time.monotonic()
+            if retry_in > 0 or self.trial_running:
+                raise CircuitOpenError(self.endpoint, max(retry_in, 0))
+            self.trial_running = True
+            return True
+
+    def release_trial(self, trial):
+        """Lets the next call be the trial, if the trial call ended without an answer, e.g. it was cancelled."""
+        if not trial:
+            return
+        with self.lock:
+            self.trial_running = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial_running or self.failures >= self.failure_threshold:
+                if self.opened_at is None or self.trial_running:
+                    print(f'Circuit of OpenAI {self.endpoint} opened after {self.failures} failures')
+                self.opened_at = time.monotonic()
+                self.trial_running = False
+
+
+breakers = {}  # API key hash:endpoint -> CircuitBreaker
+metrics = Counter()  # (endpoint, event) -> count
+
+
+def get_breaker(endpoint, api_key):
+    # Each key has its own breaker, so the rate limit errors of one user's key do not pause the calls of the others
+    key = f'{key_hash(api_key)}:{endpoint}'
+    if key not in breakers:
+        breakers[key] = CircuitBreaker(endpoint)
+    return breakers[key]
+
+
+def get_api_key(kwargs):
+    """The API key a call of an OpenAI function uses: its api_key argument, else the key set on the module."""
+    import openai
+
+    return kwargs.get('api_key') or openai.api_key
+
+
+def report():
+    events = ', '.join(f'{endpoint} {event} {count}' for (endpoint, event), count in sorted(metrics.items()))
+    return f'OpenAI calls: {events or "none"}'
+
+
+def is_retryable(error):
+    if type(error).__name__ not in RETRYABLE_ERRORS:
+        return False
+    # A quota that ran out does not come back by waiting
+    if getattr(error, 'code', None) == 'insufficient_quota':
+        return False
+    status = getattr(error, 'http_status', None)
+    return status is None or status == 429 or status >= 500
+
+
+def get_retry_after(error):
+    """Returns the seconds the server asked to wait in the Retry-After header of an error, or None."""
+    headers = getattr(error, 'headers', None) or {}
+    retry_after_ms = headers.get('retry-after-ms')
+    if retry_after_ms:
+        try:
+            return float(retry_after_ms) / 1000
+        except ValueError:
+            pass
+    retry_after = headers.get('retry-after')
+    if not retry_after:
+        return None
+    try:
+        return float(retry_after)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, email.utils.parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, error=None):
+    """The wait before retry number `attempt`: the Retry-After of the error, else a full jitter exponential backoff."""
+    retry_after = get_retry_after(error) if error is not None else None
+    if retry_after is not None:
+        return min(retry_after, OPENAI_BACKOFF_MAX)
+    return random.uniform(0, min(OPENAI_BACKOFF_MAX, OPENAI_BACKOFF_BASE * 2 ** attempt))
+
+
+def _after_failure(endpoint, breaker, error, attempt, max_retries):
+    """Counts a failed attempt and returns the seconds to wait before retrying it, raising it if it is final."""
+    retryable = is_retryable(error)
+    if retryable:
+        breaker.record_failure()
+    else:
+        # The endpoint answered, the call itself was wrong
+        breaker.record_success()
+    if not retryable or attempt >= max_retries:
+        metrics[(endpoint, 'failure')] += 1
+        raise error
+    delay = backoff_delay(attempt, error)
+    metrics[(endpoint, 'retry')] += 1
+    print(f'OpenAI {endpoint} call failed ({type(error).__name__}: {error}), retry {attempt + 1} in {delay:.1f}s')
+    return delay
+
+
+def call(endpoint, func, *args, tokens=None, max_retries=OPENAI_MAX_RETRIES, **kwargs):
+    """
+    Calls a blocking OpenAI function, e.g. openai.ChatCompletion.create, retrying server side failures with backoff.
+    Raises CircuitOpenError without calling it while the circuit of the endpoint is open for the API key.
+
+    With tokens, every attempt first waits for one request and that many tokens of the rate limits of the key and
+    the model of the call, see rate_limiter.
+    """
+    api_key = get_api_key(kwargs)
+    breaker = get_breaker(endpoint, api_key)
+    metrics[(endpoint, 'call')] += 1
+    attempt = 0
+    while True:
+        try:
+            trial = breaker.before_call()
+        except CircuitOpenError:
+            metrics[(endpoint, 'rejected')] += 1
+            raise
+        try:
+            if tokens is not None:
+                get_rate_limiter().acquire_sync(api_key, kwargs['model'], tokens)
+        except BaseException:
+            # The request was not made, e.g. the rate limits had no capacity for it
+            breaker.release_trial(trial)
+            raise
+        try:
+            response = func(*args, **kwargs)
+        except Exception as e:
+            time.sleep(_after_failure(endpoint, breaker, e, attempt, max_retries))
+            attempt += 1
+            continue
+        except BaseException:
+            breaker.release_trial(trial)
+            raise
+        breaker.record_success()
+        metrics[(endpoint, 'success')] += 1
+        return response
+
+
+async def _hedged(endpoint, func, hedge_after, can_hedge, *args, **kwargs):
+    """
+    Awaits func, and if it has not answered after hedge_after seconds a second call, returning the first answer.
+    The second call is only made if the can_hedge coroutine returns True, e.g. if the rate limits have capacity for it.
+    """
+    first = asyncio.ensure_future(func(*args, **kwargs))
+    done, _ = await asyncio.wait({first}, timeout=hedge_after)
+    if done:
+        return first.result()
+    if not await can_hedge():
+        return await first
+
+    metrics[(endpoint, 'hedge')] += 1
+    second = asyncio.ensure_future(func(*args, **kwargs))
+    pending = {first, second}
+    error = None
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is None:
+                    if task is second:
+                        metrics[(endpoint, 'hedge_win')] += 1
+                    return task.result()
+                error = task.exception()
+        raise error
+    finally:
+        # The slower request is not needed anymore
+        for task in pending:
+            task.cancel()
+
+
+async def acall(endpoint, func, *args, tokens=None, max_retries=OPENAI_MAX_RETRIES, hedge_after=None, **kwargs):
+    """
+    Like call, for an async OpenAI function, e.g. openai.ChatCompletion.acreate.
+
+    With hedge_after, every attempt that has not answered after that many seconds is raced by a second request, which
+    cuts the tail latency of answers the user is waiting for at the cost of the occasional extra request. With tokens,
+    the second request is only made if the rate limits have capacity for it right away.
+    """
+    api_key = get_api_key(kwargs)
+    breaker = get_breaker(endpoint, api_key)
+    metrics[(endpoint, 'call')] += 1
+
+    async def can_hedge():
+        if tokens is None:
+            return True
+        return await asyncio.to_thread(get_rate_limiter().try_acquire, api_key, kwargs['model'], tokens) == 0
+
+    attempt = 0
+    while True:
+        try:
+            trial = breaker.before_call()
+        except CircuitOpenError:
+            metrics[(endpoint, 'rejected')] += 1
+            raise
+        try:
+            if tokens is not None:
+                await get_rate_limiter().acquire(api_key, kwargs['model'], tokens)
+        except BaseException:
+            # The request was not made, e.g. the rate limits had no capacity for it or the call was cancelled
+            breaker.release_trial(trial)
+            raise
+        try:
+            if hedge_after:
+                response = await _hedged(endpoint, func, hedge_after, can_hedge, *args, **kwargs)
+            else:
+                response = await func(*args, **kwargs)
+        except Exception as e:
+            await asyncio.sleep(_after_failure(endpoint, breaker, e, attempt, max_retries))
+            attempt += 1
+            continue
+        except BaseException:
+            # Cancelled before an answer, e.g. by a job timeout, which says nothing about the endpoint
+            breaker.release_trial(trial)
+            raise
+        breaker.record_success()
+        metrics[(endpoint, 'success')] += 1
+        return response
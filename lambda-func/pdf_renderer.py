@@ -0,0 +1,352 @@
+import os
+import re
+import zlib
+from abc import ABC, abstractmethod
+
+PDF_RENDERER = os.environ.get('PDF_RENDERER', 'wkhtmltopdf')  # 'wkhtmltopdf' runs the binary, 'simple' renders in process
+WKHTMLTOPDF_PATH = os.environ.get('WKHTMLTOPDF_PATH', '/opt/bin/wkhtmltopdf')
+
+# A4 in points, with the margins and type sizes of the simple renderer
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+MARGIN = 56
+BODY_SIZE = 11
+HEADING_SIZES = {1: 20, 2: 16, 3: 13}  # deeper headings use the level 3 size
+LIST_INDENT = 18
+
+# Glyph widths in 1/1000 em of the characters 32-126, from the Adobe metrics of the standard fonts. The oblique fonts
+# have the widths of their upright counterparts.
+HELVETICA_WIDTHS = [
+    278, 278, 355, 556, 556, 889, 667, 191, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 278, 278, 584, 584, 584, 556, 1015,
+    667, 667, 722, 722, 667, 611, 778, 722, 278, 500, 667, 556, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667,
+    944, 667, 667, 611, 278, 278, 278, 469, 556, 333,
+    556, 556, 500, 556, 556, 278, 556, 556, 222, 222, 500, 222, 833, 556, 556, 556, 556, 333, 500, 278, 556, 500,
+    722, 500, 500, 500, 334, 260, 334, 584,
+]
+HELVETICA_BOLD_WIDTHS = [
+    278, 333, 474, 556, 556, 889, 722, 238, 333, 333, 389, 584, 278, 333, 278, 278,
+    556, 556, 556, 556, 556, 556, 556, 556, 556, 556, 333, 333, 584, 584, 584, 611, 975,
+    722, 722, 722, 722, 667, 611, 778, 722, 278, 556, 722, 611, 833, 722, 778, 667, 778, 722, 667, 611, 722, 667,
+    944, 667, 667, 611, 333, 278, 333, 584, 556, 333,
+    556, 611, 556, 611, 556, 333, 611, 611, 278, 278, 556, 278, 889, 611, 611, 611, 611, 389, 556, 333, 611, 556,
+    778, 556, 556, 500, 389, 280, 389, 584,
+]
+OTHER_WIDTHS = {'•': 350, '–': 556, '—': 1000, '‘': 222, '’': 222, '“': 333, '”': 333, '…': 1000}
+DEFAULT_WIDTH = 556
+
+# Font resource names: (bold, italic) -> (resource, base font)
+FONTS = {
+    (False, False): ('F1', 'Helvetica'),
+    (True, False): ('F2', 'Helvetica-Bold'),
+    (False, True): ('F3', 'Helvetica-Oblique'),
+    (True, True): ('F4', 'Helvetica-BoldOblique'),
+}
+
+HEADING_RE = re.compile(r'^(#{1,6})\s+(.*?)\s*#*$')
+BULLET_RE = re.compile(r'^(\s*)[-*+]\s+(.*)$')
+NUMBERED_RE = re.compile(r'^(\s*)(\d+)[.)]\s+(.*)$')
+RULE_RE = re.compile(r'^\s*([-*_])(\s*\1){2,}\s*$')
+INLINE_RE = re.compile(r'(\*\*\*.+?\*\*\*|\*\*.+?\*\*|__.+?__|\*[^*\s][^*]*?\*|`[^`]+`)')
+LINK_RE = re.compile(r'\[([^\]]+)\]\([^)]*\)')
+# Markdown the simple renderer does not support: code fences and table delimiter rows
+UNSUPPORTED_RE = re.compile(r'^\s*(```|~~~|\|?(\s*:?-+:?\s*\|)+(\s*:?-+:?\s*)?$)', re.MULTILINE)
+
+
+class PDFRenderer(ABC):
+    name = None
+
+    @abstractmethod
+    def render(self, markdown_string: str) -> bytes:
+        """
+        Takes the markdown of a summary and returns it rendered as a PDF document.
+        """
+        raise NotImplementedError
+
+
+class WkhtmltopdfRenderer(PDFRenderer):
+    """Converts the markdown to HTML and renders it with the wkhtmltopdf binary, one process per document."""
+
+    name = 'wkhtmltopdf'
+
+    def __init__(self, path=WKHTMLTOPDF_PATH):
+        self.path = path
+
+    def render(self, markdown_string):
+        import markdown
+        import pdfkit
+
+        html_text = markdown.markdown(markdown_string)
+        config = pdfkit.configuration(wkhtmltopdf=self.path)
+        return pdfkit.from_string(html_text, False, configuration=config)
+
+
+class SimplePDFRenderer(PDFRenderer):
+    """
+    Renders a subset of markdown straight to PDF in process, without the wkhtmltopdf binary. Selected with
+    PDF_RENDERER=simple.
+
+    Supported are headings, paragraphs with bold, italic and inline code text, links (as their text), bulleted and
+    numbered lists nested up to three levels, and rules. Tables, code fences, images and HTML are not: their lines
+    are set as plain paragraphs. Text is set in the standard Helvetica fonts, which every PDF reader has, so nothing
+    is embedded, and they cover the Windows-1252 characters only.
+
+    Markdown outside the subset is rendered by the fallback renderer if there is one. Without one it is rendered as
+    described, with characters outside Windows-1252 replaced with '?', and a warning is logged.
+    """
+
+    name = 'simple'
+
+    def __init__(self, fallback=None):
+        self.fallback = fallback
+
+    def render(self, markdown_string):
+        if not is_supported(markdown_string):
+            if self.fallback is not None:
+                return self.fallback.render(markdown_string)
+            print('Warning: the summary has markdown or characters the simple PDF renderer does not support, '
+                  'and no fallback renderer is available. Tables and code are set as text, other characters as "?".')
+        pages = layout_pages(parse_blocks(markdown_string))
+        return write_pdf(pages)
+
+
+def can_encode(text):
+    try:
+        text.encode('cp1252')
+        return True
+    except UnicodeEncodeError:
+        return False
+
+
+def is_supported(markdown_string):
+    """Returns whether the simple renderer renders markdown faithfully, see SimplePDFRenderer."""
+    return can_encode(markdown_string) and not UNSUPPORTED_RE.search(markdown_string)
+
+
+def parse_inline(text, bold=False):
+    """Splits a line of markdown into (text, bold, italic) runs."""
+    runs = []
+    for part in INLINE_RE.split(LINK_RE.sub(r'\1', text)):
+        if not part:
+            continue
+        if part.startswith('***') and part.endswith('***') and len(part) > 6:
+            runs.append((part[3:-3], True, True))
+        elif (part.startswith('**') or part.startswith('__')) and len(part) > 4:
+            runs.append((part[2:-2], True, False))
+        elif part.startswith('*') and part.endswith('*') and len(part) > 2:
+            runs.append((part[1:-1], bold, True))
+        elif part.startswith('`') and part.endswith('`') and len(part) > 2:
+            runs.append((part[1:-1], bold, False))
+        else:
+            runs.append((part, bold, False))
+    return runs
+
+
+def parse_blocks(markdown_string):
+    """
+    Splits markdown into blocks of (kind, level, marker, runs): headings, paragraphs, list items and rules.
+    Consecutive lines of a paragraph or list item are joined, as in markdown.
+    """
+    blocks = []
+    current = None
+    for line in markdown_string.splitlines():
+        if not line.strip():
+            current = None
+            continue
+        heading = HEADING_RE.match(line)
+        bullet = BULLET_RE.match(line)
+        numbered = NUMBERED_RE.match(line)
+        if RULE_RE.match(line):
+            blocks.append(('rule', 0, None, []))
+            current = None
+        elif heading:
+            level = len(heading.group(1))
+            blocks.append(('heading', level, None, parse_inline(heading.group(2), bold=True)))
+            current = None
+        elif bullet or numbered:
+            indent, marker, text = (
+                (bullet.group(1), '•', bullet.group(2)) if bullet
+                else (numbered.group(1), f'{numbered.group(2)}.', numbered.group(3))
+            )
+            level = min(len(indent.expandtabs(4)) // 2, 3)
+            current = ('item', level, marker, parse_inline(text))
+            blocks.append(current)
+        elif current is not None:
+            current[3].extend(parse_inline(' ' + line.strip()))
+        else:
+            current = ('paragraph', 0, None, parse_inline(line.strip()))
+            blocks.append(current)
+    return blocks
+
+
+def text_width(text, bold, size):
+    widths = HELVETICA_BOLD_WIDTHS if bold else HELVETICA_WIDTHS
+    total = 0
+    for char in text:
+        code = ord(char)
+        total += widths[code - 32] if 32 <= code <= 126 else OTHER_WIDTHS.get(char, DEFAULT_WIDTH)
+    return total * size / 1000
+
+
+def wrap_runs(runs, size, width):
+    """Breaks runs into lines of at most width points, returning each line as a list of (text, bold, italic)."""
+    lines = [[]]
+    line_width = 0.0
+    space_width = text_width(' ', False, size)
+    pending_space = False
+    for text, bold, italic in runs:
+        for word in re.split(r'(\s+)', text):
+            if not word:
+                continue
+            if word.isspace():
+                pending_space = bool(lines[-1])
+                continue
+            word_width = text_width(word, bold, size)
+            gap = space_width if pending_space else 0.0
+            if lines[-1] and line_width + gap + word_width > width:
+                lines.append([])
+                line_width, gap = 0.0, 0.0
+            if gap:
+                lines[-1].append((' ', bold, italic))
+            lines[-1].append((word, bold, italic))
+            line_width += gap + word_width
+            pending_space = False
+    return [line for line in lines if line]
+
+
+class PageWriter:
+    """Places lines of text top to bottom, starting a new page when one is full."""
+
+    def __init__(self):
+        self.pages = []
+        self.new_page()
+
+    def new_page(self):
+        self.ops = []
+        self.pages.append(self.ops)
+        self.y = PAGE_HEIGHT - MARGIN
+
+    def space(self, points):
+        if self.y < PAGE_HEIGHT - MARGIN:
+            self.y -= points
+
+    def ensure(self, points):
+        if self.y - points < MARGIN:
+            self.new_page()
+
+    def line(self, x, size, leading, segments, marker=None, marker_x=None):
+        self.ensure(leading)
+        self.y -= leading
+        ops = []
+        if marker:
+            ops.append(f'BT /F1 {size} Tf {marker_x:.2f} {self.y:.2f} Td ({escape_text(marker)}) Tj ET')
+        ops.append(f'BT {x:.2f} {self.y:.2f} Td')
+        font = None
+        for text, bold, italic in segments:
+            if FONTS[(bold, italic)][0] != font:
+                font = FONTS[(bold, italic)][0]
+                ops.append(f'/{font} {size} Tf')
+            ops.append(f'({escape_text(text)}) Tj')
+        ops.append('ET')
+        self.ops.append(' '.join(ops))
+
+    def rule(self):
+        self.ensure(BODY_SIZE)
+        self.y -= BODY_SIZE / 2
+        self.ops.append(f'0.5 w {MARGIN} {self.y:.2f} m {PAGE_WIDTH - MARGIN} {self.y:.2f} l S')
+        self.y -= BODY_SIZE / 2
+
+
+def layout_pages(blocks):
+    """Lays the blocks out on pages, returning the content stream operators of each page."""
+    writer = PageWriter()
+    text_width_available = PAGE_WIDTH - 2 * MARGIN
+    for kind, level, marker, runs in blocks:
+        if kind == 'rule':
+            writer.rule()
+            continue
+        if kind == 'heading':
+            size = HEADING_SIZES.get(level, HEADING_SIZES[3])
+            leading = size * 1.3
+            writer.space(size * 0.6)
+            # Keep a heading on the page of the text that follows it
+            writer.ensure(leading + BODY_SIZE * 1.4 * 2)
+            for segments in wrap_runs(runs, size, text_width_available):
+                writer.line(MARGIN, size, leading, segments)
+            writer.space(size * 0.2)
+            continue
+        size = BODY_SIZE
+        leading = size * 1.4
+        x = MARGIN + (level + 1) * LIST_INDENT if kind == 'item' else MARGIN
+        for i, segments in enumerate(wrap_runs(runs, size, PAGE_WIDTH - MARGIN - x)):
+            if i == 0 and marker:
+                writer.line(x, size, leading, segments, marker, x - LIST_INDENT + 4)
+            else:
+                writer.line(x, size, leading, segments)
+        writer.space(size * 0.2 if kind == 'item' else size * 0.6)
+    return writer.pages
+
+
+def escape_text(text):
+    encoded = text.encode('cp1252', errors='replace').decode('latin-1')
+    return encoded.replace('\\', '\\\\').replace('(', '\\(').replace(')', '\\)')
+
+
+def write_pdf(pages):
+    """Writes a PDF document with one compressed content stream per page, using the standard fonts."""
+    font_objects = [
+        f'<< /Type /Font /Subtype /Type1 /BaseFont /{base} /Encoding /WinAnsiEncoding >>'.encode()
+        for _, base in FONTS.values()
+    ]
+    fonts = ' '.join(f'/{resource} {3 + i} 0 R' for i, (resource, _) in enumerate(FONTS.values()))
+    objects = [b'<< /Type /Catalog /Pages 2 0 R >>', None] + font_objects
+    page_numbers = []
+    for ops in pages:
+        content = zlib.compress('\n'.join(ops).encode('latin-1'))
+        objects.append(b'<< /Length %d /Filter /FlateDecode >>\nstream\n' % len(content) + content + b'\nendstream')
+        page_numbers.append(len(objects) + 1)
+        objects.append(
+            f'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] '
+            f'/Resources << /Font << {fonts} >> >> /Contents {len(objects)} 0 R >>'.encode()
+        )
+    kids = ' '.join(f'{number} 0 R' for number in page_numbers)
+    objects[1] = f'<< /Type /Pages /Kids [{kids}] /Count {len(page_numbers)} >>'.encode()
+
+    output = bytearray(b'%PDF-1.4\n%\xe2\xe3\xcf\xd3\n')
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(output))
+        output += b'%d 0 obj\n' % number + body + b'\nendobj\n'
+    xref_offset = len(output)
+    output += b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1)
+    output += b''.join(b'%010d 00000 n \n' % offset for offset in offsets)
+    output += b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset)
+    return bytes(output)
+
+
+pdf_renderer = None  # the renderer of this container, see get_pdf_renderer
+
+
+def get_pdf_renderer() -> PDFRenderer:
+    global pdf_renderer
+
+    if pdf_renderer is None:
+        if PDF_RENDERER == 'simple':
+            # Fall back to wkhtmltopdf for markdown the simple renderer does not support, where the binary is shipped
+            fallback = WkhtmltopdfRenderer() if os.path.exists(WKHTMLTOPDF_PATH) else None
+            pdf_renderer = SimplePDFRenderer(fallback)
+        elif PDF_RENDERER == 'wkhtmltopdf':
+            pdf_renderer = WkhtmltopdfRenderer()
+        else:
+            raise ValueError(f"Unsupported PDF renderer: {PDF_RENDERER}")
+    return pdf_renderer
+
+
+def render_pdf(markdown_string, output_file_path, renderer=None):
+    """
+    Renders markdown to a PDF file with the renderer selected by PDF_RENDERER.
+    """
+    renderer = renderer or get_pdf_renderer()
+    pdf = renderer.render(markdown_string)
+    with open(output_file_path, 'wb') as file:
+        file.write(pdf)
+    return output_file_path
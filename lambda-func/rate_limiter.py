@@ -0,0 +1,229 @@
+import asyncio
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+
+RATE_LIMIT_STORE = os.environ.get('RATE_LIMIT_STORE', 'memory')  # memory, sqlite or dynamodb
+RATE_LIMITS_NAME = os.environ.get('RATE_LIMITS_NAME')  # DynamoDB table of the buckets
+RATE_LIMIT_PATH = os.environ.get('RATE_LIMIT_PATH', '/tmp/rate_limits.sqlite3')  # SQLite file of the buckets
+RATE_LIMIT_MAX_WAIT = float(os.environ.get('RATE_LIMIT_MAX_WAIT', '60'))  # seconds a call may wait for capacity
+RATE_LIMIT_CONFLICT_RETRIES = 10  # attempts of a DynamoDB bucket update that races with other containers
+BUCKET_TTL = 600  # seconds after its last use that DynamoDB deletes a bucket
+
+# Requests and tokens per minute of an OpenAI key for each model, the pay-as-you-go defaults. These are the only
+# limits on OpenAI calls in the bot, lower them for keys with lower limits, e.g. OPENAI_CHAT_REQUESTS_PER_MINUTE=3
+RATE_LIMITS = {
+    'gpt-3.5-turbo': (
+        int(os.environ.get('OPENAI_CHAT_REQUESTS_PER_MINUTE', '3500')),
+        int(os.environ.get('OPENAI_CHAT_TOKENS_PER_MINUTE', '90000')),
+    ),
+    'text-embedding-ada-002': (
+        int(os.environ.get('OPENAI_EMBEDDING_REQUESTS_PER_MINUTE', '3500')),
+        int(os.environ.get('OPENAI_EMBEDDING_TOKENS_PER_MINUTE', '350000')),
+    ),
+}
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a call would have to wait longer than RATE_LIMIT_MAX_WAIT for the limits of its key."""
+
+    def __init__(self, wait_time):
+        super().__init__(f'OpenAI rate limit reached, capacity is expected in {wait_time:.0f}s')
+        self.wait_time = wait_time
+
+
+def key_hash(api_key):
+    """Identifies an API key in stored state and logs without revealing it."""
+    return hashlib.sha256((api_key or '').encode()).hexdigest()[:16]
+
+
+def take_from_buckets(state, limits, tokens, now):
+    """
+    Refills the request and token buckets of a key for the time since their last update and takes one request and
+    `tokens` tokens from them. Each bucket holds up to one minute of its limit and refills at its limit per minute.
+
+    Returns the new state, or None if there is not enough capacity, and the seconds until there is.
+    """
+    requests_per_minute, tokens_per_minute = limits
+    if state is None:
+        state = {'requests': requests_per_minute, 'tokens': tokens_per_minute, 'updated_at': now}
+    elapsed = max(0.0, now - state['updated_at'])
+    requests = min(requests_per_minute, state['requests'] + elapsed * requests_per_minute / 60)
+    available_tokens = min(tokens_per_minute, state['tokens'] + elapsed * tokens_per_minute / 60)
+    # A call larger than the bucket could never run, it runs once the bucket is full
+    tokens = min(tokens, tokens_per_minute)
+
+    wait_time = max(
+        (1 - requests) * 60 / requests_per_minute,
+        (tokens - available_tokens) * 60 / tokens_per_minute,
+        0.0,
+    )
+    if wait_time > 0:
+        return None, wait_time
+    return {'requests': requests - 1, 'tokens': available_tokens - tokens, 'updated_at': now}, 0.0
+
+
+class RateLimitStore(ABC):
+    @abstractmethod
+    def update(self, key, update):
+        """
+        Applies update(state) -> (new_state, result) to the bucket state of a key atomically and returns result.
+        The state is None for a new key, and a new_state of None leaves the stored state as it is.
+        """
+        raise NotImplementedError
+
+
+class InMemoryRateLimitStore(RateLimitStore):
+    """Keeps the buckets in memory, so the limits only hold within one container."""
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+
+    def update(self, key, update):
+        with self.lock:
+            new_state, result = update(self.states.get(key))
+            if new_state is not None:
+                self.states[key] = new_state
+            return result
+
+
+class SQLiteRateLimitStore(RateLimitStore):
+    """Keeps the buckets in a SQLite file, shared by the processes of one machine."""
+
+    def __init__(self, path=RATE_LIMIT_PATH):
+        self.connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS rate_limits (limit_key TEXT PRIMARY KEY, state TEXT)')
+        self.lock = threading.Lock()
+
+    def update(self, key, update):
+        with self.lock:
+            # Read and write the bucket in one write transaction, so two processes never take the same capacity
+            self.connection.execute('BEGIN IMMEDIATE')
+            try:
+                row = self.connection.execute('SELECT state FROM rate_limits WHERE limit_key = ?', (key,)).fetchone()
+                new_state, result = update(json.loads(row[0]) if row else None)
+                if new_state is not None:
+                    self.connection.execute(
+                        'INSERT OR REPLACE INTO rate_limits (limit_key, state) VALUES (?, ?)', (key, json.dumps(new_state))
+                    )
+                self.connection.execute('COMMIT')
+            except Exception as e:
+                self.connection.execute('ROLLBACK')
+                raise e
+            return result
+
+
+class DynamoDBRateLimitStore(RateLimitStore):
+    """
+    Keeps the buckets in a DynamoDB table, shared by all containers. Updates are optimistic: a bucket is written
+    only if its version did not change since it was read, else the update is retried with the new state.
+    """
+
+    def __init__(self, table_name=RATE_LIMITS_NAME, client=None):
+        if client is None:
+            import boto3
+            client = boto3.client('dynamodb')
+        self.client = client
+        self.table_name = table_name
+
+    def update(self, key, update):
+        for _ in range(RATE_LIMIT_CONFLICT_RETRIES):
+            resp = self.client.get_item(TableName=self.table_name, Key={'limit_key': {'S': key}}, ConsistentRead=True)
+            item = resp.get('Item')
+            state = {name: float(item[name]['N']) for name in ('requests', 'tokens', 'updated_at')} if item else None
+            version = int(item['version']['N']) if item else 0
+            new_state, result = update(state)
+            if new_state is None:
+                return result
+            try:
+                self.client.put_item(
+                    TableName=self.table_name,
+                    Item={
+                        'limit_key': {'S': key},
+                        **{name: {'N': repr(value)} for name, value in new_state.items()},
+                        'version': {'N': str(version + 1)},
+                        'expires_at': {'N': str(int(new_state['updated_at']) + BUCKET_TTL)},
+                    },
+                    ConditionExpression='attribute_not_exists(limit_key) OR version = :version',
+                    ExpressionAttributeValues={':version': {'N': str(version)}},
+                )
+                return result
+            except self.client.exceptions.ConditionalCheckFailedException:
+                continue
+        raise RuntimeError(f'Rate limit bucket {key} kept changing during {RATE_LIMIT_CONFLICT_RETRIES} updates')
+
+
+class RateLimiter:
+    """
+    Limits the requests and tokens per minute of OpenAI calls for each API key and model, in token buckets kept in
+    a store that the containers of the bot share.
+
+    try_acquire takes capacity for a call or returns how long until there is some. acquire and acquire_sync wait
+    for that long if it is within max_wait, else they raise RateLimitExceeded with the estimate.
+    """
+
+    def __init__(self, store, limits=RATE_LIMITS, max_wait=RATE_LIMIT_MAX_WAIT):
+        self.store = store
+        self.limits = limits
+        self.max_wait = max_wait
+        self.waits = 0
+        self.waited = 0.0  # seconds
+
+    def key(self, api_key, model):
+        # Keys are stored by hash, never in the clear
+        return f'{key_hash(api_key)}:{model}'
+
+    def try_acquire(self, api_key, model, tokens):
+        """Takes one request and `tokens` tokens of the limits of a key. Returns 0, or the seconds to wait first."""
+        limits = self.limits.get(model, self.limits['gpt-3.5-turbo'])
+        return self.store.update(
+            self.key(api_key, model), lambda state: take_from_buckets(state, limits, tokens, time.time())
+        )
+
+    def _check_wait(self, wait_time):
+        if wait_time > self.max_wait:
+            raise RateLimitExceeded(wait_time)
+        print(f'Rate limit reached, waiting {wait_time:.1f}s')
+        self.waits += 1
+        self.waited += wait_time
+
+    def acquire_sync(self, api_key, model, tokens):
+        wait_time = self.try_acquire(api_key, model, tokens)
+        while wait_time > 0:
+            self._check_wait(wait_time)
+            time.sleep(wait_time)
+            wait_time = self.try_acquire(api_key, model, tokens)
+
+    async def acquire(self, api_key, model, tokens):
+        wait_time = await asyncio.to_thread(self.try_acquire, api_key, model, tokens)
+        while wait_time > 0:
+            self._check_wait(wait_time)
+            await asyncio.sleep(wait_time)
+            wait_time = await asyncio.to_thread(self.try_acquire, api_key, model, tokens)
+
+
+def get_rate_limit_store():
+    if RATE_LIMIT_STORE == 'memory':
+        return InMemoryRateLimitStore()
+    elif RATE_LIMIT_STORE == 'sqlite':
+        return SQLiteRateLimitStore()
+    elif RATE_LIMIT_STORE == 'dynamodb':
+        return DynamoDBRateLimitStore()
+    else:
+        raise ValueError(f'Unsupported rate limit store: {RATE_LIMIT_STORE}')
+
+
+rate_limiter = None  # the rate limiter of this container, see get_rate_limiter
+
+
+def get_rate_limiter():
+    global rate_limiter
+
+    if rate_limiter is None:
+        rate_limiter = RateLimiter(get_rate_limit_store())
+    return rate_limiter
@@ -3,18 +3,33 @@ import os
 bucket_name = os.environ['BUCKET_NAME']
 
 
+def get_s3_key(item_id, file_name, folder):
+    return f'{folder}/{item_id}/{file_name}'  # Construct the key with the video_id folder
+
+
 def upload_file_to_s3(client, file_path, item_id, folder):
 
-    key = f'{folder}/{item_id}/{file_path.split("/")[-1]}'  # Construct the key with the video_id folder
+    key = get_s3_key(item_id, file_path.split("/")[-1], folder)
     client.upload_file(file_path, bucket_name, key)
     print(f'The file {file_path} was uploaded to s3 bucket: {key}')
 
 
 def download_file_from_s3(client, item_id, file_name, folder):
     destination_path = f'/tmp/{file_name}'
-    key = f'{folder}/{item_id}/{file_name}'  # Construct the key with the video_id folder
+    key = get_s3_key(item_id, file_name, folder)
     client.download_file(bucket_name, key, destination_path)
     print(f'The file {key} was downloaded to path: {destination_path}')
 
     return destination_path
 
+
+def file_exists_in_s3(client, item_id, file_name, folder):
+    """Checks whether a file is in the bucket with a HEAD request, without downloading it."""
+    key = get_s3_key(item_id, file_name, folder)
+    try:
+        client.head_object(Bucket=bucket_name, Key=key)
+    except client.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise e
+    return True
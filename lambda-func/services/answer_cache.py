@@ -0,0 +1,129 @@
+import os
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+
+from services.index_version import get_index_version
+
+# Read environment variables for the answer cache configuration
+ANSWER_CACHE_SIZE = int(os.environ.get("ANSWER_CACHE_SIZE", "1024"))
+ANSWER_CACHE_TTL = int(os.environ.get("ANSWER_CACHE_TTL", "86400"))  # seconds
+ANSWER_CACHE_SIMILARITY = float(
+    os.environ.get("ANSWER_CACHE_SIMILARITY", "0.95")
+)  # The cosine similarity above which two questions count as the same
+
+
+class CachedAnswer:
+    def __init__(self, document_key: Tuple[str, ...], embedding: np.ndarray, chunk_ids: List[str], answer: str):
+        self.document_key = document_key
+        self.embedding = embedding
+        self.chunk_ids = tuple(chunk_ids)
+        self.answer = answer
+        self.created_at = time.monotonic()
+
+
+class AnswerCache:
+    """
+    An in-process cache of the answers to questions about a document, shared by the warm invocations of a container.
+
+    An earlier answer is reused for a new question about the same document when the cosine similarity of the two
+    question embeddings is at least ANSWER_CACHE_SIMILARITY and the datastore retrieved the same chunks for both.
+    Answers are kept per document and index version, so the answers from chunks of an older chunker or embedding
+    model are not reused once the document is indexed again.
+    Entries expire after ANSWER_CACHE_TTL seconds and the least recently used ones are evicted beyond
+    ANSWER_CACHE_SIZE entries.
+    """
+
+    def __init__(
+        self,
+        max_size: int = ANSWER_CACHE_SIZE,
+        ttl: float = ANSWER_CACHE_TTL,
+        similarity: float = ANSWER_CACHE_SIMILARITY,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity = similarity
+        self.entries: "OrderedDict[int, CachedAnswer]" = OrderedDict()
+        self.by_document: Dict[Tuple[str, ...], Set[int]] = {}
+        self.next_key = 0
+        self.hits = 0
+        self.misses = 0
+
+    def stats(self) -> Dict[str, float]:
+        """
+        Return the hit and miss counters, the hit rate and the number of cached answers.
+        """
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.entries),
+        }
+
+    def get(self, document_id: str, embedding: List[float], chunk_ids: List[str]) -> Optional[str]:
+        """
+        Return the cached answer to the most similar question about the document with the same retrieved chunks,
+        or None if no cached question is similar enough.
+        """
+        self._expire()
+        query_embedding = self._normalize(np.asarray(embedding, dtype=np.float32))
+        candidates = [
+            key
+            for key in self.by_document.get(self._document_key(document_id), ())
+            if self.entries[key].chunk_ids == tuple(chunk_ids)
+        ]
+        if candidates:
+            scores = np.vstack([self.entries[key].embedding for key in candidates]) @ query_embedding
+            best = int(np.argmax(scores))
+            if scores[best] >= self.similarity:
+                self.hits += 1
+                self.entries.move_to_end(candidates[best])
+                return self.entries[candidates[best]].answer
+        self.misses += 1
+        return None
+
+    def put(self, document_id: str, embedding: List[float], chunk_ids: List[str], answer: str):
+        """
+        Cache the answer to a question about a document.
+        """
+        key = self.next_key
+        self.next_key += 1
+        document_key = self._document_key(document_id)
+        self.entries[key] = CachedAnswer(
+            document_key,
+            self._normalize(np.asarray(embedding, dtype=np.float32)),
+            chunk_ids,
+            answer,
+        )
+        self.by_document.setdefault(document_key, set()).add(key)
+        while len(self.entries) > self.max_size:
+            self._remove(next(iter(self.entries)))
+
+    def _expire(self):
+        now = time.monotonic()
+        expired = [key for key, entry in self.entries.items() if now - entry.created_at > self.ttl]
+        for key in expired:
+            self._remove(key)
+
+    def _remove(self, key: int):
+        entry = self.entries.pop(key)
+        keys = self.by_document[entry.document_key]
+        keys.discard(key)
+        if not keys:
+            del self.by_document[entry.document_key]
+
+    @staticmethod
+    def _document_key(document_id: str) -> Tuple[str, ...]:
+        index_version = get_index_version()
+        return (document_id, index_version["chunker_version"], index_version["embedding_model"])
+
+    @staticmethod
+    def _normalize(vector: np.ndarray) -> np.ndarray:
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+
+answer_cache = AnswerCache()
@@ -1,10 +1,21 @@
-from typing import Dict, List, Optional, Tuple
+from typing import Dict, List, Optional, Set, Tuple
+import asyncio
+import bisect
+import hashlib
+import itertools
+import os
 import uuid
-from models.models import Document, DocumentChunk, DocumentChunkMetadata
+from models.models import Document, DocumentChunkMetadata
+from models.records import DocumentChunks
 
+import numpy as np
+import openai
+import regex
 import tiktoken
 
-from services.openai import get_embeddings
+from services.index_version import EMBEDDING_MODEL
+from services.embedding_cache import embedding_cache
+from services.openai import aget_embeddings
 
 # Global variables
 tokenizer = tiktoken.get_encoding(
@@ -15,14 +26,97 @@ tokenizer = tiktoken.get_encoding(
 CHUNK_SIZE = 200  # The target size of each text chunk in tokens
 MIN_CHUNK_SIZE_CHARS = 350  # The minimum size of each text chunk in characters
 MIN_CHUNK_LENGTH_TO_EMBED = 5  # Discard chunks shorter than this
-EMBEDDINGS_BATCH_SIZE = 128  # The number of embeddings to request at a time
+EMBEDDINGS_BATCH_SIZE = 2048  # The maximum number of texts in one embeddings request
+EMBEDDINGS_BATCH_TOKENS = int(
+    os.environ.get("EMBEDDINGS_BATCH_TOKENS", "8192")
+)  # The token budget of one embeddings request
+EMBEDDINGS_CONCURRENCY = int(
+    os.environ.get("EMBEDDINGS_CONCURRENCY", "4")
+)  # The number of embeddings requests in flight at a time
 MAX_NUM_CHUNKS = 10000  # The maximum number of chunks to generate from a text
 
 
+def _find_last_punctuation(text: str) -> int:
+    """
+    Return the index of the last period, question mark, exclamation mark or newline in a text, or -1 if there is none.
+    """
+    return max(
+        text.rfind("."),
+        text.rfind("?"),
+        text.rfind("!"),
+        text.rfind("\n"),
+    )
+
+
+def _get_token_offsets(tokens: List[int]) -> List[int]:
+    """
+    Return the byte offset in the text of the start of every token, followed by the byte length of the text.
+    """
+    return list(itertools.accumulate(map(len, map(tokenizer.decode_single_token_bytes, tokens)), initial=0))
+
+
+def _get_piece_offsets(text: str) -> Set[int]:
+    """
+    Return the byte offsets in a text where the pieces that the tokenizer splits it into before byte pair encoding
+    start, and the byte length of the text. Tokens never cross these offsets.
+    """
+    pieces = regex.finditer(tokenizer._pat_str, text)
+    if text.isascii():
+        # Character offsets are byte offsets
+        return {0, *(match.end() for match in pieces)}
+    return {0, *itertools.accumulate(len(match.group().encode("utf-8")) for match in pieces)}
+
+
+def _count_prefix_tokens(
+    chunk_text: str,
+    prefix_len: int,
+    start: int,
+    token_offsets: List[int],
+    piece_offsets: Set[int],
+) -> int:
+    """
+    Count the tokens that the first prefix_len characters of a decoded chunk are encoded to.
+
+    A text is split into pieces that are byte pair encoded one at a time, so if the prefix starts and ends where
+    pieces of the whole text start, encoding it gives back the tokens of the whole text between those offsets, which
+    are counted with the token offsets instead of re-encoding the prefix. A prefix that starts or ends inside a piece,
+    e.g. in the middle of a word, may be encoded to other tokens, as may one that ends with blanks (which the tokenizer
+    groups differently at the end of a text) or a chunk whose decoding replaced partial multi-byte characters, so
+    these are encoded.
+
+    Args:
+        chunk_text: The decoded text of the chunk.
+        prefix_len: The number of characters of chunk_text to count tokens for.
+        start: The index of the first token of the chunk in the tokens of the whole text.
+        token_offsets: The byte offsets of the tokens of the whole text, see _get_token_offsets.
+        piece_offsets: The byte offsets of the pieces of the whole text, see _get_piece_offsets.
+
+    Returns:
+        The number of tokens the prefix is encoded to.
+    """
+    prefix_text = chunk_text[:prefix_len]
+    ends_with_blank = prefix_text[-1].isspace() and prefix_text[-1] != "\n"
+    start_offset = token_offsets[start]
+    end_offset = start_offset + len(prefix_text.encode("utf-8"))
+    if (
+        "\ufffd" not in chunk_text
+        and not ends_with_blank
+        and start_offset in piece_offsets
+        and end_offset in piece_offsets
+    ):
+        # Pieces start on token boundaries, so the end offset is the offset of a token
+        return bisect.bisect_left(token_offsets, end_offset, lo=start) - start
+
+    return len(tokenizer.encode(prefix_text, disallowed_special=()))
+
+
 def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
     """
     Split a text into chunks of ~CHUNK_SIZE tokens, based on punctuation and newline boundaries.
 
+    The text is tokenized once and consumed with a cursor, so the running time is linear in the length of the text.
+    The chunks are the same as those of re-encoding the text of every chunk to find where the next one starts.
+
     Args:
         text: The text to split into chunks.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
@@ -36,6 +130,9 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
 
     # Tokenize the text
     tokens = tokenizer.encode(text, disallowed_special=())
+    num_tokens = len(tokens)
+    token_offsets = _get_token_offsets(tokens)
+    piece_offsets = _get_piece_offsets(text)
 
     # Initialize an empty list of chunks
     chunks = []
@@ -46,80 +143,81 @@ def get_text_chunks(text: str, chunk_token_size: Optional[int]) -> List[str]:
     # Initialize a counter for the number of chunks
     num_chunks = 0
 
+    # Initialize a cursor to the first token that is not consumed yet
+    cursor = 0
+
     # Loop until all tokens are consumed
-    while tokens and num_chunks < MAX_NUM_CHUNKS:
-        # Take the first chunk_size tokens as a chunk
-        chunk = tokens[:chunk_size]
+    while cursor < num_tokens and num_chunks < MAX_NUM_CHUNKS:
+        # Take the next chunk_size tokens as a chunk
+        chunk = tokens[cursor : cursor + chunk_size]
 
         # Decode the chunk into text
         chunk_text = tokenizer.decode(chunk)
 
         # Skip the chunk if it is empty or whitespace
         if not chunk_text or chunk_text.isspace():
-            # Remove the tokens corresponding to the chunk text from the remaining tokens
-            tokens = tokens[len(chunk) :]
+            # Move the cursor past the tokens of the chunk
+            cursor += len(chunk)
             # Continue to the next iteration of the loop
             continue
 
         # Find the last period or punctuation mark in the chunk
-        last_punctuation = max(
-            chunk_text.rfind("."),
-            chunk_text.rfind("?"),
-            chunk_text.rfind("!"),
-            chunk_text.rfind("\n"),
-        )
+        last_punctuation = _find_last_punctuation(chunk_text)
 
         # If there is a punctuation mark, and the last punctuation index is before MIN_CHUNK_SIZE_CHARS
         if last_punctuation != -1 and last_punctuation > MIN_CHUNK_SIZE_CHARS:
             # Truncate the chunk text at the punctuation mark
-            chunk_text = chunk_text[: last_punctuation + 1]
+            chunk_len = last_punctuation + 1
+        else:
+            chunk_len = len(chunk_text)
 
         # Remove any newline characters and strip any leading or trailing whitespace
-        chunk_text_to_append = chunk_text.replace("\n", " ").strip()
+        chunk_text_to_append = chunk_text[:chunk_len].replace("\n", " ").strip()
 
         if len(chunk_text_to_append) > MIN_CHUNK_LENGTH_TO_EMBED:
             # Append the chunk text to the list of chunks
             chunks.append(chunk_text_to_append)
 
-        # Remove the tokens corresponding to the chunk text from the remaining tokens
-        tokens = tokens[len(tokenizer.encode(chunk_text, disallowed_special=())) :]
+        # Move the cursor past the tokens corresponding to the chunk text
+        cursor += _count_prefix_tokens(chunk_text, chunk_len, cursor, token_offsets, piece_offsets)
 
         # Increment the number of chunks
         num_chunks += 1
 
     # Handle the remaining tokens
-    if tokens:
-        remaining_text = tokenizer.decode(tokens).replace("\n", " ").strip()
+    if cursor < num_tokens:
+        remaining_text = tokenizer.decode(tokens[cursor:]).replace("\n", " ").strip()
         if len(remaining_text) > MIN_CHUNK_LENGTH_TO_EMBED:
             chunks.append(remaining_text)
 
     return chunks
 
 
+def get_chunk_hash(text: str, metadata_json: str) -> str:
+    """
+    Return a hash of everything that is stored for a chunk: its text, its metadata as JSON and the embedding model.
+    """
+    content = f"{EMBEDDING_MODEL}\0{text}\0{metadata_json}"
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
 def create_document_chunks(
     doc: Document, chunk_token_size: Optional[int]
-) -> Tuple[List[DocumentChunk], str]:
+) -> Tuple[DocumentChunks, str]:
     """
-    Create a list of document chunks from a document object and return the document id.
+    Create the chunks of a document object and return the document id.
 
     Args:
         doc: The document object to create chunks from. It should have a text attribute and optionally an id and a metadata attribute.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
 
     Returns:
-        A tuple of (doc_chunks, doc_id), where doc_chunks is a list of document chunks, each of which is a DocumentChunk object with an id, a document_id, a text, and a metadata attribute,
+        A tuple of (doc_chunks, doc_id), where doc_chunks is a DocumentChunks record with the ids, texts, content hashes and metadata of the chunks,
         and doc_id is the id of the document object, generated if not provided. The id of each chunk is generated from the document id and a sequential number, and the metadata is copied from the document object.
     """
-    # Check if the document text is empty or whitespace
-    if not doc.text or doc.text.isspace():
-        return [], doc.id or str(uuid.uuid4())
-
     # Generate a document id if not provided
     doc_id = doc.id or str(uuid.uuid4())
 
-    # Split the document text into chunks
-    text_chunks = get_text_chunks(doc.text, chunk_token_size)
-
     metadata = (
         DocumentChunkMetadata(**doc.metadata.__dict__)
         if doc.metadata is not None
@@ -128,75 +226,199 @@ def create_document_chunks(
 
     metadata.document_id = doc_id
 
-    # Initialize an empty list of chunks for this document
-    doc_chunks = []
+    # Check if the document text is empty or whitespace
+    if not doc.text or doc.text.isspace():
+        return DocumentChunks(doc_id, [], [], [], metadata), doc_id
+
+    # Split the document text into chunks
+    text_chunks = get_text_chunks(doc.text, chunk_token_size)
 
-    # Assign each chunk a sequential number and create a DocumentChunk object
-    for i, text_chunk in enumerate(text_chunks):
-        chunk_id = f"{doc_id}_{i}"
-        doc_chunk = DocumentChunk(
-            id=chunk_id,
-            text=text_chunk,
-            metadata=metadata,
-        )
-        # Append the chunk object to the list of chunks for this document
-        doc_chunks.append(doc_chunk)
+    # Assign each chunk a sequential number
+    metadata_json = metadata.json(sort_keys=True)
+    doc_chunks = DocumentChunks(
+        doc_id,
+        [f"{doc_id}_{i}" for i in range(len(text_chunks))],
+        text_chunks,
+        [get_chunk_hash(text_chunk, metadata_json) for text_chunk in text_chunks],
+        metadata,
+    )
 
-    # Return the list of chunks and the document id
+    # Return the chunks and the document id
     return doc_chunks, doc_id
 
 
-def get_document_chunks(
+def get_embedding_batches(
+    texts: List[str], batch_token_size: int = EMBEDDINGS_BATCH_TOKENS
+) -> List[Tuple[int, int]]:
+    """
+    Group consecutive texts into embeddings requests that stay within a token budget.
+
+    Args:
+        texts: The texts to embed.
+        batch_token_size: The maximum number of tokens in one request. A single text that is longer gets its own request.
+
+    Returns:
+        A list of (start, end) index ranges into texts, one per request.
+    """
+    batches = []
+    start = 0
+    batch_tokens = 0
+    for i, text in enumerate(texts):
+        num_tokens = len(tokenizer.encode(text, disallowed_special=()))
+        is_full = (
+            batch_tokens + num_tokens > batch_token_size
+            or i - start >= EMBEDDINGS_BATCH_SIZE
+        )
+        if i > start and is_full:
+            batches.append((start, i))
+            start = i
+            batch_tokens = 0
+        batch_tokens += num_tokens
+    if start < len(texts):
+        batches.append((start, len(texts)))
+    return batches
+
+
+async def embed_batch(
+    texts: List[str],
+    semaphore: asyncio.Semaphore,
+    document_ids: Optional[List[str]] = None,
+) -> np.ndarray:
+    """
+    Embed one batch of texts, holding the semaphore while the request is in flight.
+
+    If the API rejects the request, e.g. because a text exceeds the context length of the model, the batch is split
+    in two halves that are embedded separately, so a single bad text does not fail the whole batch. A rejected batch
+    of one text raises the error, and so does any other error, e.g. of authentication, quota or rate limits, which
+    smaller requests would run into as well.
+
+    Returns the float32 embeddings matrix of the texts. The document_ids of the texts, if given, let the embedding
+    cache look the texts up in the embeddings stored for their documents.
+    """
+    try:
+        async with semaphore:
+            return await aget_embeddings(texts, document_ids)
+    except openai.error.InvalidRequestError as e:
+        if len(texts) == 1:
+            raise e
+        print(f"Error embedding batch of size {len(texts)}, splitting it: {e}")
+        middle = len(texts) // 2
+        halves = [(0, middle), (middle, len(texts))]
+        first_half, second_half = await asyncio.gather(
+            *[
+                embed_batch(
+                    texts[start:end],
+                    semaphore,
+                    document_ids[start:end] if document_ids is not None else None,
+                )
+                for start, end in halves
+            ]
+        )
+        return np.concatenate([first_half, second_half])
+
+
+def create_chunks(
     documents: List[Document], chunk_token_size: Optional[int]
-) -> Dict[str, List[DocumentChunk]]:
+) -> Dict[str, DocumentChunks]:
     """
-    Convert a list of documents into a dictionary from document id to list of document chunks.
+    Convert a list of documents into a dictionary from document id to the chunks of the document, without embeddings.
 
     Args:
         documents: The list of documents to convert.
         chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
 
     Returns:
-        A dictionary mapping each document id to a list of document chunks, each of which is a DocumentChunk object
-        with text, metadata, and embedding attributes.
+        A dictionary mapping each document id to a DocumentChunks record with texts, metadata and content hashes.
     """
-    # Initialize an empty dictionary of lists of chunks
-    chunks: Dict[str, List[DocumentChunk]] = {}
-
-    # Initialize an empty list of all chunks
-    all_chunks: List[DocumentChunk] = []
+    # Initialize an empty dictionary of chunks
+    chunks: Dict[str, DocumentChunks] = {}
 
     # Loop over each document and create chunks
     for doc in documents:
         doc_chunks, doc_id = create_document_chunks(doc, chunk_token_size)
 
-        # Append the chunks for this document to the list of all chunks
-        all_chunks.extend(doc_chunks)
-
-        # Add the list of chunks for this document to the dictionary with the document id as the key
+        # Add the chunks of this document to the dictionary with the document id as the key
         chunks[doc_id] = doc_chunks
 
+    return chunks
+
+
+async def embed_chunks(
+    chunks: Dict[str, DocumentChunks],
+    concurrency: int = EMBEDDINGS_CONCURRENCY,
+    complete: bool = True,
+):
+    """
+    Set the embeddings matrix of every document, embedding all chunks in token-budgeted batches with up to
+    concurrency requests in flight.
+
+    With complete set, the chunks are all chunks of their documents, and the embeddings of every document are
+    stored in the S3 tier of the embedding cache as one object.
+    """
+    all_texts = [text for doc_chunks in chunks.values() for text in doc_chunks.texts]
     # Check if there are no chunks
-    if not all_chunks:
-        return {}
+    if not all_texts:
+        return
+    all_document_ids = [
+        doc_id for doc_id, doc_chunks in chunks.items() for _ in range(len(doc_chunks))
+    ]
+
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def _embed_batch(start: int, end: int) -> np.ndarray:
+        return await embed_batch(
+            all_texts[start:end], semaphore, all_document_ids[start:end]
+        )
 
-    # Get all the embeddings for the document chunks in batches, using get_embeddings
-    embeddings: List[List[float]] = []
-    for i in range(0, len(all_chunks), EMBEDDINGS_BATCH_SIZE):
-        # Get the text of the chunks in the current batch
-        batch_texts = [
-            chunk.text for chunk in all_chunks[i : i + EMBEDDINGS_BATCH_SIZE]
+    batch_embeddings = await asyncio.gather(
+        *[
+            _embed_batch(start, end)
+            for start, end in get_embedding_batches(all_texts)
         ]
+    )
+    embeddings = np.concatenate(batch_embeddings)
+
+    # Give each document its rows of the embeddings matrix
+    start = 0
+    for doc_chunks in chunks.values():
+        doc_chunks.embeddings = embeddings[start : start + len(doc_chunks)]
+        start += len(doc_chunks)
+
+    if complete:
+        await asyncio.to_thread(
+            embedding_cache.put_documents,
+            EMBEDDING_MODEL,
+            {
+                doc_id: (doc_chunks.texts, doc_chunks.embeddings)
+                for doc_id, doc_chunks in chunks.items()
+                if len(doc_chunks)
+            },
+        )
 
-        # Get the embeddings for the batch texts
-        batch_embeddings = get_embeddings(batch_texts)
 
-        # Append the batch embeddings to the embeddings list
-        embeddings.extend(batch_embeddings)
+async def get_document_chunks(
+    documents: List[Document],
+    chunk_token_size: Optional[int],
+    concurrency: int = EMBEDDINGS_CONCURRENCY,
+) -> Dict[str, DocumentChunks]:
+    """
+    Convert a list of documents into a dictionary from document id to the embedded chunks of the document.
+
+    Args:
+        documents: The list of documents to convert.
+        chunk_token_size: The target size of each chunk in tokens, or None to use the default CHUNK_SIZE.
+        concurrency: The maximum number of embeddings requests in flight at a time.
+
+    Returns:
+        A dictionary mapping each document id to a DocumentChunks record with texts, metadata, content hashes and a
+        float32 embeddings matrix.
+    """
+    chunks = create_chunks(documents, chunk_token_size)
+
+    # Check if there are no chunks
+    if not any(len(doc_chunks) for doc_chunks in chunks.values()):
+        return {}
 
-    # Update the document chunk objects with the embeddings
-    for i, chunk in enumerate(all_chunks):
-        # Assign the embedding from the embeddings list to the chunk object
-        chunk.embedding = embeddings[i]
+    await embed_chunks(chunks, concurrency)
 
     return chunks
@@ -0,0 +1,131 @@
+import os
+from typing import Dict, List, Optional, Tuple
+
+from models.models import DocumentChunkWithScore
+from services.chunks import tokenizer
+
+# Read environment variables for the context packing configuration
+CONTEXT_TOKEN_BUDGET = int(
+    os.environ.get("CONTEXT_TOKEN_BUDGET", "1500")
+)  # The maximum number of prompt tokens of retrieved context per question
+CONTEXT_DUPLICATE_SIMILARITY = float(
+    os.environ.get("CONTEXT_DUPLICATE_SIMILARITY", "0.9")
+)  # The word overlap above which two chunks count as the same text
+MIN_PASSAGE_TOKENS = 50  # Do not truncate a passage to fewer tokens than this to fill the budget
+
+
+def _get_chunk_position(chunk: DocumentChunkWithScore) -> Tuple[str, Optional[int]]:
+    """
+    Return the document id and the sequential number of a chunk, parsed from its "{doc_id}_{i}" id.
+    """
+    document_id = chunk.metadata.document_id if chunk.metadata else None
+    prefix, _, number = (chunk.id or "").rpartition("_")
+    if number.isdigit():
+        return document_id or prefix, int(number)
+    return document_id or chunk.id or "", None
+
+
+def _word_overlap(first: str, second: str) -> float:
+    first_words, second_words = set(first.lower().split()), set(second.lower().split())
+    if not first_words or not second_words:
+        return 0.0
+    return len(first_words & second_words) / len(first_words | second_words)
+
+
+def _drop_duplicates(
+    chunks: List[DocumentChunkWithScore], similarity: float
+) -> List[DocumentChunkWithScore]:
+    """
+    Keep the best scoring chunk of every group of chunks whose texts overlap by at least similarity.
+    """
+    kept: List[DocumentChunkWithScore] = []
+    for chunk in sorted(chunks, key=lambda chunk: -chunk.score):
+        if all(_word_overlap(chunk.text, other.text) < similarity for other in kept):
+            kept.append(chunk)
+    return kept
+
+
+def _decode_prefix(tokens: List[int], max_tokens: int) -> str:
+    """
+    Decode at most max_tokens tokens from the start of tokens. A character can span several tokens, so the tokens of
+    a character that the cut would split are dropped rather than decoded into a replacement character.
+    """
+    end = max_tokens
+    while end > 0:
+        try:
+            return tokenizer.decode_bytes(tokens[:end]).decode("utf-8")
+        except UnicodeDecodeError:
+            end -= 1
+    return ""
+
+
+def pack_context(
+    chunks: List[DocumentChunkWithScore],
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+    similarity: float = CONTEXT_DUPLICATE_SIMILARITY,
+) -> List[str]:
+    """
+    Pack retrieved chunks into as few passages as possible that fit a prompt token budget.
+
+    Near-duplicate chunks are dropped and chunks that follow each other in the same document are merged into one
+    passage. Passages are then added best score first while they fit the budget, truncating the last one, and
+    returned in document order.
+
+    Args:
+        chunks: The chunks retrieved for a question, with their scores.
+        token_budget: The maximum number of tokens of all passages together.
+        similarity: The word overlap above which two chunks count as duplicates.
+
+    Returns:
+        A list of passages.
+    """
+    # Group the remaining chunks into runs of consecutive chunks of the same document
+    positioned = sorted(
+        ((_get_chunk_position(chunk), chunk) for chunk in _drop_duplicates(chunks, similarity)),
+        key=lambda item: (item[0][0], item[0][1] if item[0][1] is not None else -1),
+    )
+    passages: List[Dict] = []
+    for (document_id, number), chunk in positioned:
+        previous = passages[-1] if passages else None
+        if (
+            previous is not None
+            and number is not None
+            and previous["document_id"] == document_id
+            and previous["last"] == number - 1
+        ):
+            previous["texts"].append(chunk.text.strip())
+            previous["last"] = number
+            previous["score"] = max(previous["score"], chunk.score)
+        else:
+            passages.append(
+                {
+                    "document_id": document_id,
+                    "last": number,
+                    "texts": [chunk.text.strip()],
+                    "score": chunk.score,
+                    "order": len(passages),
+                }
+            )
+
+    # Fill the budget with the best passages
+    packed: List[Tuple[int, str]] = []
+    remaining = token_budget
+    for passage in sorted(passages, key=lambda passage: -passage["score"]):
+        tokens = tokenizer.encode(" ".join(passage["texts"]), disallowed_special=())
+        if len(tokens) <= remaining:
+            packed.append((passage["order"], " ".join(passage["texts"])))
+            remaining -= len(tokens)
+        elif remaining >= MIN_PASSAGE_TOKENS:
+            packed.append((passage["order"], _decode_prefix(tokens, remaining)))
+            remaining = 0
+        if remaining < MIN_PASSAGE_TOKENS:
+            break
+
+    return [text for _, text in sorted(packed)]
+
+
+def count_tokens(texts: List[str]) -> int:
+    """
+    Return the number of tokens of the texts together.
+    """
+    return sum(len(tokenizer.encode(text, disallowed_special=())) for text in texts)
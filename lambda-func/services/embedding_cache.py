@@ -0,0 +1,249 @@
+import hashlib
+import io
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# Read environment variables for the embedding cache configuration
+EMBEDDING_CACHE_SIZE = int(os.environ.get("EMBEDDING_CACHE_SIZE", "4096"))
+EMBEDDING_CACHE_PATH = os.environ.get(
+    "EMBEDDING_CACHE_PATH", "/tmp/embedding_cache.sqlite3"
+)
+EMBEDDING_CACHE_BUCKET = os.environ.get("EMBEDDING_CACHE_BUCKET")
+EMBEDDING_CACHE_PREFIX = os.environ.get("EMBEDDING_CACHE_PREFIX", "embeddings")
+
+SQLITE_MAX_VARIABLES = 500  # The number of keys to look up in one SQLite statement
+S3_MAX_WORKERS = 16  # The number of S3 objects to read or write at a time
+
+
+def get_cache_key(model: str, text: str) -> str:
+    """
+    Return the content address of an embedding: a hash of the model name and the embedded text.
+    """
+    return hashlib.sha256(f"{model}\0{text}".encode("utf-8")).hexdigest()
+
+
+def get_document_key(model: str, document_id: str) -> str:
+    """
+    Return the name of the S3 object of the embeddings of a document: a hash of the model name and the document id.
+    """
+    return hashlib.sha256(f"{model}\0{document_id}".encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    A content-addressed embedding cache with three tiers, looked up in order:
+
+    - an in-process LRU of EMBEDDING_CACHE_SIZE entries that survives across warm invocations,
+    - a SQLite file at EMBEDDING_CACHE_PATH (skipped when the path is empty),
+    - one S3 object per document under EMBEDDING_CACHE_PREFIX in EMBEDDING_CACHE_BUCKET, with the embeddings of all
+      chunks of the document (skipped when no bucket is set). Only lookups of texts that name their document use it.
+
+    Embeddings are stored and returned as float32 arrays. Hits of a lower tier are promoted to the tiers above it. The
+    memory and SQLite tiers are guarded by a lock, so the cache can be used from the threads of the event loop's
+    executor. Every lookup and write blocks on I/O, async code calls them with asyncio.to_thread.
+    """
+
+    def __init__(
+        self,
+        max_size: int = EMBEDDING_CACHE_SIZE,
+        path: Optional[str] = EMBEDDING_CACHE_PATH,
+        bucket_name: Optional[str] = EMBEDDING_CACHE_BUCKET,
+        prefix: str = EMBEDDING_CACHE_PREFIX,
+    ):
+        self.max_size = max_size
+        self.memory: "OrderedDict[str, np.ndarray]" = OrderedDict()
+
+        self.lock = threading.Lock()
+
+        self.connection = None
+        if path:
+            self.connection = sqlite3.connect(path, check_same_thread=False)
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)"
+            )
+
+        self.bucket_name = bucket_name
+        self.prefix = prefix
+        self.s3_client = None
+        if self.bucket_name:
+            import boto3
+
+            self.s3_client = boto3.client("s3")
+
+        self.hits = {"memory": 0, "local": 0, "s3": 0}
+        self.misses = 0
+        # S3 object key -> the embedding keys it is known to hold, so documents that did not change are not written again
+        self.stored_documents: Dict[str, frozenset] = {}
+
+    def stats(self) -> Dict[str, int]:
+        """
+        Return the hit counters of every tier and the miss counter.
+        """
+        return {**{f"{tier}_hits": hits for tier, hits in self.hits.items()}, "misses": self.misses}
+
+    def report(self) -> str:
+        stats = self.stats()
+        return "Embedding cache: " + ", ".join(f"{name} {count}" for name, count in stats.items())
+
+    def get_many(
+        self, model: str, texts: List[str], document_ids: Optional[Sequence[str]] = None
+    ) -> List[Optional[np.ndarray]]:
+        """
+        Look up the embeddings of a batch of texts. Hits and misses are counted per text.
+
+        Args:
+            model: The embedding model.
+            texts: The texts to look up.
+            document_ids: The id of the document of every text, or None. Texts missing from the memory and SQLite
+                tiers are looked up in the S3 objects of their documents.
+
+        Returns:
+            A list aligned with texts, holding the cached float32 embedding or None for every miss.
+        """
+        keys = [get_cache_key(model, text) for text in texts]
+        found: Dict[str, np.ndarray] = {}
+
+        with self.lock:
+            for key in keys:
+                if key in self.memory:
+                    self.memory.move_to_end(key)
+                    found[key] = self.memory[key]
+            self.hits["memory"] += sum(key in found for key in keys)
+
+        missing = [key for key in set(keys) if key not in found]
+        if missing and self.connection is not None:
+            local_found = self._get_local(missing)
+            with self.lock:
+                self.hits["local"] += sum(key in local_found for key in keys)
+            self._put_memory(local_found)
+            found.update(local_found)
+            missing = [key for key in missing if key not in local_found]
+
+        if missing and self.s3_client is not None and document_ids is not None:
+            missing_set = set(missing)
+            document_keys: Dict[str, List[str]] = {}
+            for key, document_id in zip(keys, document_ids):
+                if key in missing_set:
+                    document_keys.setdefault(get_document_key(model, document_id), []).append(key)
+            s3_found = self._get_s3(document_keys)
+            with self.lock:
+                self.hits["s3"] += sum(key in s3_found for key in keys)
+            self._put_memory(s3_found)
+            self._put_local(s3_found)
+            found.update(s3_found)
+
+        with self.lock:
+            self.misses += sum(key not in found for key in keys)
+
+        return [found.get(key) for key in keys]
+
+    def put_many(self, model: str, texts: List[str], embeddings: Sequence[Sequence[float]]):
+        """
+        Store the embeddings of a batch of texts in the memory and SQLite tiers.
+        """
+        entries = {
+            get_cache_key(model, text): np.asarray(embedding, dtype=np.float32)
+            for text, embedding in zip(texts, embeddings)
+        }
+        self._put_memory(entries)
+        self._put_local(entries)
+
+    def put_documents(self, model: str, documents: Dict[str, Tuple[List[str], np.ndarray]]):
+        """
+        Store the embeddings of the chunks of documents in the S3 tier, one object per document, from a dict from
+        document id to the texts of its chunks and their float32 embeddings matrix.
+        """
+        if self.s3_client is None:
+            return
+        objects = {}
+        for document_id, (texts, embeddings) in documents.items():
+            document_key = get_document_key(model, document_id)
+            keys = [get_cache_key(model, text) for text in texts]
+            with self.lock:
+                if self.stored_documents.get(document_key, frozenset()).issuperset(keys):
+                    continue
+            objects[document_key] = (keys, embeddings)
+        self._put_s3(objects)
+
+    def _put_memory(self, entries: Dict[str, np.ndarray]):
+        with self.lock:
+            for key, embedding in entries.items():
+                self.memory[key] = embedding
+                self.memory.move_to_end(key)
+            while len(self.memory) > self.max_size:
+                self.memory.popitem(last=False)
+
+    def _get_local(self, keys: List[str]) -> Dict[str, np.ndarray]:
+        found = {}
+        for i in range(0, len(keys), SQLITE_MAX_VARIABLES):
+            batch_keys = keys[i : i + SQLITE_MAX_VARIABLES]
+            with self.lock:
+                rows = self.connection.execute(
+                    f"SELECT key, embedding FROM embeddings WHERE key IN ({','.join('?' * len(batch_keys))})",
+                    batch_keys,
+                ).fetchall()
+            for key, blob in rows:
+                found[key] = np.frombuffer(blob, dtype=np.float32)
+        return found
+
+    def _put_local(self, entries: Dict[str, np.ndarray]):
+        if self.connection is None or not entries:
+            return
+        with self.lock, self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+                [(key, embedding.tobytes()) for key, embedding in entries.items()],
+            )
+
+    def _get_s3(self, document_keys: Dict[str, List[str]]) -> Dict[str, np.ndarray]:
+        """
+        Read the S3 objects of documents, from a dict from document key to the keys of the embeddings to look up in it.
+        """
+
+        def _get_object(document_key: str) -> Dict[str, np.ndarray]:
+            try:
+                response = self.s3_client.get_object(
+                    Bucket=self.bucket_name, Key=f"{self.prefix}/{document_key}.npz"
+                )
+            except Exception:
+                # A missing object, or one we may not read, is a cache miss
+                return {}
+            with np.load(io.BytesIO(response["Body"].read())) as data:
+                stored = dict(zip(data["keys"].tolist(), data["embeddings"]))
+            with self.lock:
+                self.stored_documents[document_key] = frozenset(stored)
+            return {key: stored[key] for key in document_keys[document_key] if key in stored}
+
+        found: Dict[str, np.ndarray] = {}
+        with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as executor:
+            for document_found in executor.map(_get_object, document_keys):
+                found.update(document_found)
+        return found
+
+    def _put_s3(self, objects: Dict[str, Tuple[List[str], np.ndarray]]):
+        if not objects:
+            return
+
+        def _put_object(item):
+            document_key, (keys, embeddings) = item
+            body = io.BytesIO()
+            np.savez(body, keys=np.array(keys), embeddings=np.asarray(embeddings, dtype=np.float32))
+            self.s3_client.put_object(
+                Bucket=self.bucket_name,
+                Key=f"{self.prefix}/{document_key}.npz",
+                Body=body.getvalue(),
+            )
+            with self.lock:
+                self.stored_documents[document_key] = frozenset(keys)
+
+        with ThreadPoolExecutor(max_workers=S3_MAX_WORKERS) as executor:
+            list(executor.map(_put_object, objects.items()))
+
+
+embedding_cache = EmbeddingCache()
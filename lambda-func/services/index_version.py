@@ -0,0 +1,13 @@
+from typing import Dict
+
+# The versions of the pipeline that turns a transcript into vectors, recorded with every indexed video. This module
+# has no dependencies, so the bot can check whether a video is indexed without loading the pipeline itself.
+CHUNKER_VERSION = "2"  # Bump when a change to transcripts or chunking changes the chunks
+EMBEDDING_MODEL = "text-embedding-ada-002"
+
+
+def get_index_version() -> Dict[str, str]:
+    """
+    The chunker version and embedding model that upsert indexes documents with.
+    """
+    return {"chunker_version": CHUNKER_VERSION, "embedding_model": EMBEDDING_MODEL}
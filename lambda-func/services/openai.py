@@ -1,27 +1,125 @@
-from typing import List
+from typing import List, Optional, Sequence, Tuple
+import asyncio
+
+import numpy as np
 import openai
 
-def get_embeddings(texts: List[str]) -> List[List[float]]:
+from openai_client import acall, call
+from services.embedding_cache import embedding_cache
+from services.index_version import EMBEDDING_MODEL
+
+
+def _count_tokens(texts: List[str]) -> int:
+    # Imported on use, services.context imports services.chunks, which imports this module
+    from services.context import count_tokens
+
+    return count_tokens(texts)
+
+
+def _lookup_cached_embeddings(
+    texts: List[str], document_ids: Optional[Sequence[str]] = None
+) -> Tuple[List[Optional[np.ndarray]], List[str]]:
+    """
+    Look up texts in the embedding cache.
+
+    Returns:
+        A tuple of (embeddings, missing_texts), where embeddings is aligned with texts and holds None for every miss,
+        and missing_texts are the distinct texts that have to be sent to the API.
+    """
+    embeddings = embedding_cache.get_many(EMBEDDING_MODEL, texts, document_ids)
+
+    # Embed each text that is not cached only once, even if it occurs several times in the batch
+    missing_texts = list(
+        dict.fromkeys(text for text, embedding in zip(texts, embeddings) if embedding is None)
+    )
+    return embeddings, missing_texts
+
+
+def _get_response_embeddings(response) -> np.ndarray:
+    """
+    Convert the embeddings of an API response to a float32 matrix, one row per input text.
+    """
+    # Extract the embedding data from the response
+    data = response["data"]  # type: ignore
+    return np.asarray([result["embedding"] for result in data], dtype=np.float32)
+
+
+def _merge_embeddings(
+    texts: List[str],
+    embeddings: List[Optional[np.ndarray]],
+    missing_texts: List[str],
+    missing_embeddings: Optional[np.ndarray],
+) -> np.ndarray:
+    """
+    Fill the embeddings of the missing texts into the misses of a cache lookup and stack them into a float32 matrix.
+    """
+    embedded = dict(zip(missing_texts, missing_embeddings)) if missing_texts else {}
+    if not texts:
+        return np.empty((0, 0), dtype=np.float32)
+    return np.stack(
+        [
+            embedding if embedding is not None else embedded[text]
+            for text, embedding in zip(texts, embeddings)
+        ]
+    )
+
+
+def get_embeddings(texts: List[str], document_ids: Optional[Sequence[str]] = None) -> np.ndarray:
     """
     Embed texts using OpenAI's ada model.
 
+    Texts whose embedding is already in the embedding cache are not sent to the API, and the embeddings of the
+    others are added to the cache.
+
     Args:
         texts: The list of texts to embed.
+        document_ids: The id of the document of every text, which lets the cache look the texts up in the
+            embeddings stored for their documents, or None.
 
     Returns:
-        A list of embeddings, each of which is a list of floats.
+        A float32 matrix with the embedding of every text as a row.
 
     Raises:
         Exception: If the OpenAI API call fails.
     """
-    # Call the OpenAI API to get the embeddings
-    response = openai.Embedding.create(input=texts, model="text-embedding-ada-002")
+    embeddings, missing_texts = _lookup_cached_embeddings(texts, document_ids)
+    missing_embeddings = None
+    if missing_texts:
+        # Call the OpenAI API to get the embeddings, each attempt waits for the rate limits of the key
+        response = call(
+            "embeddings",
+            openai.Embedding.create,
+            tokens=_count_tokens(missing_texts),
+            input=missing_texts,
+            model=EMBEDDING_MODEL,
+        )
+        missing_embeddings = _get_response_embeddings(response)
+        embedding_cache.put_many(EMBEDDING_MODEL, missing_texts, missing_embeddings)
 
-    # Extract the embedding data from the response
-    data = response["data"]  # type: ignore
+    return _merge_embeddings(texts, embeddings, missing_texts, missing_embeddings)
+
+
+async def aget_embeddings(texts: List[str], document_ids: Optional[Sequence[str]] = None) -> np.ndarray:
+    """
+    Embed texts using OpenAI's ada model without blocking the event loop.
+
+    Behaves like get_embeddings, including the embedding cache, whose lookups and writes run in worker threads.
+    """
+    embeddings, missing_texts = await asyncio.to_thread(_lookup_cached_embeddings, texts, document_ids)
+    missing_embeddings = None
+    if missing_texts:
+        # Call the OpenAI API to get the embeddings, each attempt waits for the rate limits of the key
+        response = await acall(
+            "embeddings",
+            openai.Embedding.acreate,
+            tokens=_count_tokens(missing_texts),
+            input=missing_texts,
+            model=EMBEDDING_MODEL,
+        )
+        missing_embeddings = _get_response_embeddings(response)
+        await asyncio.to_thread(embedding_cache.put_many, EMBEDDING_MODEL, missing_texts, missing_embeddings)
 
-    # Return the embeddings as a list of lists of floats
-    return [result["embedding"] for result in data]
+    return _merge_embeddings(texts, embeddings, missing_texts, missing_embeddings)
 
 
 def get_chat_completion(
@@ -41,8 +139,10 @@ def get_chat_completion(
     Raises:
         Exception: If the OpenAI API call fails.
     """
-    # call the OpenAI chat completion API with the given messages
-    response = openai.ChatCompletion.create(
+    # call the OpenAI chat completion API with the given messages, retrying server side failures
+    response = call(
+        "chat",
+        openai.ChatCompletion.create,
         model=model,
         messages=messages,
     )
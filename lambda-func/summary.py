@@ -1,39 +1,50 @@
 import openai
+import asyncio
 import math
-from pyrate_limiter import RequestRate, Duration, Limiter
-import markdown
+import os
 import tiktoken
-import pdfkit
+from pdf_renderer import render_pdf
+from openai_client import acall, call
 
 tokenizer = tiktoken.get_encoding(
     "cl100k_base"
 )
 
-rate_limits = (RequestRate(3, Duration.MINUTE),) 
 SUMMARY_RATIO = 0.4
 MAX_AVAILABLE_TOKEN_SIZE = 3600
+SUMMARY_CONCURRENCY = int(os.environ.get("SUMMARY_CONCURRENCY", "4"))  # Slices summarized at a time
+SUMMARY_REDUCE = os.environ.get("SUMMARY_REDUCE", "false").lower() == "true"  # Merge slice summaries
 
 
-# Create the rate limiter
-# Pyrate Limiter instance
-limiter = Limiter(*rate_limits)
-
-@limiter.ratelimit('gpt3.5', delay=True)
 def get_completion(prompt, model="gpt-3.5-turbo"): # Andrew mentioned that the prompt/ completion paradigm is preferable for this class
     messages = [{"role": "user", "content": prompt}]
-    response = openai.ChatCompletion.create(
+    # Each attempt waits for the rate limits of the key, shared by all containers
+    response = call(
+        'chat',
+        openai.ChatCompletion.create,
+        tokens=len(tokenizer.encode(prompt)),
         model=model,
         messages=messages,
         temperature=0, # this is the degree of randomness of the model's output
     )
     return response.choices[0].message["content"]
 
-def markdown_to_pdf(markdown_string, output_file_path):
-    # Convert to HTML
-    html_text = markdown.markdown(markdown_string)
+async def aget_completion(prompt, max_completion_tokens, model="gpt-3.5-turbo"):
+    """Like get_completion, but awaits the rate limits of the key without blocking."""
+    messages = [{"role": "user", "content": prompt}]
+    response = await acall(
+        'chat',
+        openai.ChatCompletion.acreate,
+        tokens=len(tokenizer.encode(prompt)) + max_completion_tokens,
+        model=model,
+        messages=messages,
+        temperature=0, # this is the degree of randomness of the model's output
+    )
+    return response.choices[0].message["content"]
 
-    config = pdfkit.configuration(wkhtmltopdf="/opt/bin/wkhtmltopdf")
-    pdfkit.from_string(html_text, output_file_path, configuration=config)
+def markdown_to_pdf(markdown_string, output_file_path):
+    # Rendered by the renderer selected with PDF_RENDERER, wkhtmltopdf by default
+    render_pdf(markdown_string, output_file_path)
 
 def create_summary_prompt(wc, transcript_part):
     prompt = f"""
@@ -60,8 +71,123 @@ def create_markdown_prompt(text, create_title):
     """
     return prompt
 
+def create_reduce_prompt(wc, summaries):
+    joined_summaries = "\n\n".join(summaries)
+    prompt = f"""
+    Your task is to merge consecutive summaries of parts of a video into one summary.
+    The summaries are in between the squared brackets, in the order of the video.
+    Remove repetitions, keep the order of the topics.
+    The summary should be maximum {wc} words.
 
-def generate_summary_pdf(transcript_text, video_id):
+    [{joined_summaries}]
+    
+    Summary:
+    """
+    return prompt
+
+
+async def summarize_slice(text_tokens):
+    """Map step: summarize one slice of the transcript."""
+    wc = round(len(text_tokens) * SUMMARY_RATIO)
+    prompt = create_summary_prompt(wc, tokenizer.decode(text_tokens))
+    return await aget_completion(prompt, wc)
+
+
+async def reduce_summaries(summaries):
+    """
+    Reduce step: merge neighbouring slice summaries in groups that fit into the model context.
+
+    Returns the merged summaries, in the original order.
+    """
+    groups = []
+    group_tokens = 0
+    for summary in summaries:
+        summary_tokens = len(tokenizer.encode(summary))
+        if groups and group_tokens + summary_tokens <= MAX_AVAILABLE_TOKEN_SIZE / (1 + SUMMARY_RATIO):
+            groups[-1].append(summary)
+            group_tokens += summary_tokens
+        else:
+            groups.append([summary])
+            group_tokens = summary_tokens
+
+    async def _reduce_group(group):
+        if len(group) == 1:
+            return group[0]
+        wc = round(sum(len(tokenizer.encode(summary)) for summary in group) * SUMMARY_RATIO * 2)
+        return await aget_completion(create_reduce_prompt(wc, group), wc)
+
+    return await asyncio.gather(*[_reduce_group(group) for group in groups])
+
+
+async def format_summary(summary, create_title):
+    """Format one summary as a markdown section."""
+    prompt = create_markdown_prompt(summary, create_title)
+    response = await aget_completion(prompt, len(tokenizer.encode(summary)) * 2)
+    print(response)
+    return response
+
+
+class SectionDelivery:
+    """Passes sections to a callback in order, each as soon as it and all sections before it are ready."""
+
+    def __init__(self, on_section):
+        self.on_section = on_section
+        self.ready = {}
+        self.next_index = 0
+        self.lock = asyncio.Lock()
+
+    async def add(self, i, section):
+        if self.on_section is None:
+            return
+        self.ready[i] = section
+        async with self.lock:
+            while self.next_index in self.ready:
+                await self.on_section(self.next_index, self.ready.pop(self.next_index))
+                self.next_index += 1
+
+
+async def summarize_transcript(tokenized_text, slices, concurrency=SUMMARY_CONCURRENCY, reduce=SUMMARY_REDUCE,
+                               on_section=None):
+    """
+    Summarize the slices of a tokenized transcript concurrently and format the summaries with markdown.
+
+    At most `concurrency` slices are processed at a time, and all completions wait for the rate limits of the key.
+    With `reduce`, the slice summaries are merged before formatting. The sections are returned in slice order, and
+    passed to the `on_section(i, section)` coroutine in that order as soon as they are ready.
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    delivery = SectionDelivery(on_section)
+
+    if not reduce or len(slices) == 1:
+        async def _summarize_and_format(i, slice_i):
+            async with semaphore:
+                summary = await summarize_slice(tokenized_text[slice_i])
+                section = await format_summary(summary, i == 0)
+            await delivery.add(i, section)
+            return section
+
+        return await asyncio.gather(
+            *[_summarize_and_format(i, slice_i) for i, slice_i in enumerate(slices)]
+        )
+
+    async def _summarize(slice_i):
+        async with semaphore:
+            return await summarize_slice(tokenized_text[slice_i])
+
+    async def _format(i, summary):
+        async with semaphore:
+            section = await format_summary(summary, i == 0)
+        await delivery.add(i, section)
+        return section
+
+    summaries = await asyncio.gather(*[_summarize(slice_i) for slice_i in slices])
+    summaries = await reduce_summaries(summaries)
+    return await asyncio.gather(
+        *[_format(i, summary) for i, summary in enumerate(summaries)]
+    )
+
+
+async def agenerate_summary_pdf(transcript_text, video_id, on_section=None):
     tokenized_text = tokenizer.encode(transcript_text)
     token_count = len(tokenized_text)
     max_part_len = math.floor(MAX_AVAILABLE_TOKEN_SIZE / (1 + SUMMARY_RATIO))
@@ -74,24 +200,15 @@ def generate_summary_pdf(transcript_text, video_id):
     for i in range(iter_num):
         slices.append(slice(i*part_len, (i+1)*part_len))
     
-    results = []
-    for i, slice_i in enumerate(slices):
-        print('FOR', i)
-        wc = round(len(tokenized_text[slice_i]) * SUMMARY_RATIO)
-        
-        text = tokenized_text[slice_i]
-        prompt = create_summary_prompt(wc, tokenizer.decode(text))
-        response = get_completion(prompt)
-
-        prompt = create_markdown_prompt(response, i == 0)
-        response = get_completion(prompt)
-
-        print(response)
-        
-        results.append(response)
+    results = await summarize_transcript(tokenized_text, slices, on_section=on_section)
 
     results_string = "\n\n".join(results)
     filename = f'/tmp/summary_{video_id}.pdf'
-    markdown_to_pdf(results_string, filename)
+    await asyncio.to_thread(markdown_to_pdf, results_string, filename)
 
     return filename
+
+
+def generate_summary_pdf(transcript_text, video_id):
+    from async_runtime import run
+    return run(agenerate_summary_pdf(transcript_text, video_id))
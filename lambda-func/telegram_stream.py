@@ -0,0 +1,80 @@
+import os
+import time
+
+from async_runtime import to_thread
+
+TELEGRAM_EDIT_INTERVAL = float(os.environ.get('TELEGRAM_EDIT_INTERVAL', '1.0'))  # seconds between edits of a message
+TELEGRAM_MESSAGE_LIMIT = 4096  # characters in one message
+PLACEHOLDER_TEXT = '…'
+
+
+class StreamingReply:
+    """
+    Replies to a message with a placeholder right away and edits it as the text of the answer arrives.
+
+    The first text replaces the placeholder at once, later edits are sent at most every TELEGRAM_EDIT_INTERVAL
+    seconds and the rest of the text waits for the next edit or for finish. Text beyond TELEGRAM_MESSAGE_LIMIT
+    continues in a new message. If the answer fails, fail removes the placeholder, so the chat is not left with "…".
+    """
+
+    def __init__(self, bot, chat_id, reply_to_message_id=None, edit_interval=TELEGRAM_EDIT_INTERVAL):
+        self.bot = bot
+        self.chat_id = chat_id
+        self.reply_to_message_id = reply_to_message_id
+        self.edit_interval = edit_interval
+        self.message_id = None
+        self.text = ''  # the text of the current message
+        self.sent_text = PLACEHOLDER_TEXT  # the text the current message shows
+        self.last_edit_at = 0.0
+        self.edits = 0
+
+    async def start(self):
+        """Sends the placeholder message."""
+        message = await to_thread(
+            self.bot.send_message, self.chat_id, PLACEHOLDER_TEXT, reply_to_message_id=self.reply_to_message_id
+        )
+        self.message_id = message.message_id
+        self.last_edit_at = time.monotonic()
+
+    async def feed(self, delta):
+        """Adds text to the answer, editing the message if the last edit is old enough."""
+        if len(self.text) + len(delta) > TELEGRAM_MESSAGE_LIMIT:
+            # Complete the current message and continue in a new one
+            await self._edit()
+            self.text = ''
+            self.sent_text = PLACEHOLDER_TEXT
+            self.reply_to_message_id = None
+            await self.start()
+        self.text += delta
+        # Replace the placeholder with the first text at once, then edit at most every edit_interval
+        if self.sent_text == PLACEHOLDER_TEXT or time.monotonic() - self.last_edit_at >= self.edit_interval:
+            await self._edit()
+
+    async def finish(self):
+        """Sends the complete text."""
+        await self._edit()
+
+    async def fail(self):
+        """
+        Cleans up after the answer failed: a message that still shows the placeholder is deleted, and one that shows
+        part of the answer gets the text that arrived since its last edit. Errors doing so are only logged, so they
+        do not hide the error of the answer.
+        """
+        if self.message_id is None:
+            return
+        try:
+            if self.sent_text == PLACEHOLDER_TEXT:
+                await to_thread(self.bot.delete_message, self.chat_id, self.message_id)
+            else:
+                await self._edit()
+        except Exception as e:
+            print(f"Could not clean up the streamed reply: {e}")
+
+    async def _edit(self):
+        # Telegram rejects edits that do not change the message
+        if not self.text.strip() or self.text == self.sent_text:
+            return
+        await to_thread(self.bot.edit_message_text, self.text, chat_id=self.chat_id, message_id=self.message_id)
+        self.sent_text = self.text
+        self.last_edit_at = time.monotonic()
+        self.edits += 1
@@ -0,0 +1,90 @@
+import os
+import time
+from collections import OrderedDict
+
+from dynamodb_handler import retrieve_user_item, touch_user_item
+from user_creds_handler import decrypt_key
+
+USER_CONTEXT_CACHE_SIZE = int(os.environ.get('USER_CONTEXT_CACHE_SIZE', '1024'))
+USER_CONTEXT_TTL = int(os.environ.get('USER_CONTEXT_TTL', '600'))  # seconds a loaded context is reused
+LAST_SEEN_INTERVAL = int(os.environ.get('LAST_SEEN_INTERVAL', '300'))  # seconds between "last seen" writes
+
+
+class UserContext:
+    """What the bot needs to know about a chat before running a handler."""
+
+    def __init__(self, chat_id, openai_key=None, username=None, last_seen=0.0):
+        self.chat_id = chat_id
+        self.openai_key = openai_key  # decrypted, None if the user did not provide one
+        self.username = username
+        self.last_seen = last_seen
+        self.loaded_at = time.monotonic()
+
+
+class UserContextCache:
+    """A bounded LRU of user contexts that expire after a TTL. Lives as long as the Lambda container."""
+
+    def __init__(self, max_size=USER_CONTEXT_CACHE_SIZE, ttl=USER_CONTEXT_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.contexts = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, chat_id):
+        context = self.contexts.get(chat_id)
+        if context is None or time.monotonic() - context.loaded_at > self.ttl:
+            self.contexts.pop(chat_id, None)
+            self.misses += 1
+            return None
+        self.contexts.move_to_end(chat_id)
+        self.hits += 1
+        return context
+
+    def put(self, context):
+        self.contexts[context.chat_id] = context
+        self.contexts.move_to_end(context.chat_id)
+        while len(self.contexts) > self.max_size:
+            self.contexts.popitem(last=False)
+
+    def invalidate(self, chat_id):
+        self.contexts.pop(chat_id, None)
+
+
+user_context_cache = UserContextCache()
+
+
+def load_user_context(dynamodb_client, kms_client, kms_key_id, chat_id):
+    """Reads the user item once and decrypts their OpenAI key, if any."""
+    user_item = retrieve_user_item(dynamodb_client, chat_id)
+    encrypted_openai_creds = user_item.get('openai_key')
+    openai_key = decrypt_key(kms_client, kms_key_id, encrypted_openai_creds) if encrypted_openai_creds else None
+    return UserContext(
+        chat_id,
+        openai_key=openai_key,
+        username=user_item.get('username'),
+        last_seen=float(user_item.get('last_seen', 0)),
+    )
+
+
+def get_user_context(dynamodb_client, kms_client, kms_key_id, chat_id, username=None):
+    """
+    Returns the context of a chat, from the cache when possible.
+
+    The "last seen" time, and the username when it changed, are written at most once per LAST_SEEN_INTERVAL.
+    """
+    context = user_context_cache.get(chat_id)
+    if context is None:
+        context = load_user_context(dynamodb_client, kms_client, kms_key_id, chat_id)
+        user_context_cache.put(context)
+    print(f'User context cache: {user_context_cache.hits} hits, {user_context_cache.misses} misses')
+
+    now = time.time()
+    username_changed = username is not None and username != context.username
+    if username_changed or now - context.last_seen >= LAST_SEEN_INTERVAL:
+        touch_user_item(dynamodb_client, chat_id, now, username)
+        context.last_seen = now
+        if username is not None:
+            context.username = username
+
+    return context
@@ -0,0 +1,17 @@
+from index import run_job
+from job_queue import Job, get_job_queue, run_worker
+
+
+def handler(event, context):
+    # Run the jobs delivered by the SQS event source
+    for record in event['Records']:
+        run_job(Job.from_json(record['body']))
+
+    return {
+        'statusCode': 200
+    }
+
+
+if __name__ == '__main__':
+    # Run the jobs of a local queue, e.g. JOB_QUEUE=sqlite, until interrupted
+    run_worker(get_job_queue(), run_job, wait=True)
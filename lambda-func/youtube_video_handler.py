@@ -1,8 +1,21 @@
 from youtube_transcript_api import YouTubeTranscriptApi
+from urllib.error import HTTPError
 from urllib.parse import urlparse, parse_qs, urlencode
-from urllib.request import urlopen
+from urllib.request import Request, urlopen
+import os
+import re
 import simplejson
 
+YOUTUBE_API_KEY = os.environ.get('YOUTUBE_API_KEY')  # YouTube Data API key, reads whole playlists when set
+# Without an API key the playlist page is read, which lists only the first 100 videos of the playlist
+PLAYLIST_VIDEO_ID_RE = re.compile(r'"playlistVideoRenderer":\{"videoId":"([\w-]{11})"')
+PLAYLIST_ITEMS_URL = 'https://www.googleapis.com/youtube/v3/playlistItems'
+PLAYLIST_ITEMS_PAGE_SIZE = 50  # the most the API returns at a time
+
+
+class PlaylistUnavailableError(ValueError):
+    """Raised when the videos of a playlist cannot be read, e.g. it is private or YouTube asks for consent."""
+
 
 def retrieve_metadata(video_id):
     url = 'https://www.youtube.com/watch?v=' + video_id
@@ -19,17 +32,107 @@ def retrieve_metadata(video_id):
     return title, author
 
 
+def retrieve_playlist_video_ids(playlist_id, max_videos=None):
+    """
+    Returns the ids of the videos of a playlist in playlist order, up to max_videos. They are read with the YouTube
+    Data API if YOUTUBE_API_KEY is set, else from the playlist page, which lists the first 100 videos.
+    Raises PlaylistUnavailableError if the playlist cannot be read.
+    """
+    if YOUTUBE_API_KEY:
+        return retrieve_playlist_video_ids_from_api(playlist_id, max_videos)
+
+    url = 'https://www.youtube.com/playlist?' + urlencode({'list': playlist_id})
+    request = Request(url, headers={'User-Agent': 'Mozilla/5.0', 'Accept-Language': 'en-US,en'})
+    page = urlopen(request).read().decode('utf-8')
+    video_ids = list(dict.fromkeys(PLAYLIST_VIDEO_ID_RE.findall(page)))
+    if not video_ids:
+        # A consent or sign-in page, or a private, deleted or empty playlist, has no playlist videos
+        raise PlaylistUnavailableError(f'No videos found on the page of playlist {playlist_id}')
+    return video_ids[:max_videos]
+
+
+def retrieve_playlist_video_ids_from_api(playlist_id, max_videos=None):
+    video_ids = []
+    params = {'part': 'contentDetails', 'playlistId': playlist_id, 'maxResults': PLAYLIST_ITEMS_PAGE_SIZE, 'key': YOUTUBE_API_KEY}
+    while max_videos is None or len(video_ids) < max_videos:
+        try:
+            response = simplejson.load(urlopen(PLAYLIST_ITEMS_URL + '?' + urlencode(params)))
+        except HTTPError as e:
+            # 404 for a missing or private playlist, 403 for a key without access or quota
+            raise PlaylistUnavailableError(f'Could not read playlist {playlist_id}: {e}') from e
+        video_ids.extend(item['contentDetails']['videoId'] for item in response.get('items', []))
+        if 'nextPageToken' not in response:
+            break
+        params['pageToken'] = response['nextPageToken']
+    return video_ids[:max_videos]
+
+
+def get_transcript_paths(video_id):
+    """Returns the paths of the structured .jsonl transcript of a video and of the plain .txt derived from it."""
+    return f'/tmp/transcript_{video_id}.jsonl', f'/tmp/transcript_{video_id}.txt'
+
+
+def write_transcript_segments(segments, file_path):
+    """Writes transcript segments to a JSONL file, one {"text", "start", "duration"} object per line, as they are read."""
+    with open(file_path, 'w') as f:
+        for segment in segments:
+            line = {'text': segment['text'], 'start': segment['start'], 'duration': segment['duration']}
+            f.write(simplejson.dumps(line) + '\n')
+
+
+def read_transcript_segments(file_path):
+    """Yields the segments of a JSONL transcript one at a time."""
+    with open(file_path, 'r') as f:
+        for line in f:
+            if line.strip():
+                yield simplejson.loads(line)
+
+
+def write_transcript_text(segments_path, text_path):
+    """
+    Writes the plain text of a JSONL transcript, with the segments separated by spaces. The text of each segment is
+    kept as it is, including its newlines, which the chunker prefers as chunk boundaries.
+    """
+    with open(text_path, 'w') as f:
+        for i, segment in enumerate(read_transcript_segments(segments_path)):
+            if i > 0:
+                f.write(' ')
+            f.write(segment['text'])
+    return text_path
+
+
 def generate_transcript(video_id):
+    """
+    Fetches the transcript of a video and writes it as a structured JSONL file and as plain text.
+    Returns the path of the plain text file, or None if the video has no transcript.
+    """
     try:
         transcript_result = YouTubeTranscriptApi.get_transcript(video_id)
     except:
         return
-    full_transcript = ""
-    filename = f'/tmp/transcript_{video_id}.txt'
-    with open(filename, 'w') as f:
-        for text in transcript_result:
-            t = text["text"]
-            full_transcript += t + " "
-            f.write(t)
-
-    return filename
+    segments_path, text_path = get_transcript_paths(video_id)
+    write_transcript_segments(transcript_result, segments_path)
+
+    return write_transcript_text(segments_path, text_path)
+
+
+def open_cached_transcript_file(artifacts, video_id, mode='r'):
+    """
+    Opens the plain text transcript of a video, from an artifact cache or generated. A generated transcript is put
+    into the cache both as structured .jsonl and as .txt. Returns None if there is no transcript.
+    """
+    file_name = f'transcript_{video_id}.txt'
+    file = artifacts.open_file(video_id, file_name, mode)
+    if file:
+        print(f'File {file_name} found in cache. Skip generating.')
+        return file
+    print(f'No file {file_name} found in cache. Start generating.')
+
+    file_path = generate_transcript(video_id)
+    if not file_path:
+        print(f"Transcript could not be retrieved from provided link.")
+        return
+    segments_path, _ = get_transcript_paths(video_id)
+    artifacts.put_file(video_id, segments_path)
+    artifacts.put_file(video_id, file_path)
+    return artifacts.open_file(video_id, file_name, mode)